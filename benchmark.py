@@ -0,0 +1,307 @@
+import argparse
+import ast
+import gc
+import glob
+import json
+import os
+import platform
+import re
+import shutil
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from utils import load_data, save_outputs, get_data_name
+from inference.model_map import MODELS
+from inference.tool_parsers import TOOL_PARSERS, format_tool_call, parse_tool_output
+import get_metric
+from get_metric import check_tool_call_structer, get_validator, score_outputs
+from eval_from_local import get_handler
+
+# The prompt settings of a time-stamped run, the most expensive to render
+CONFIG = dict(time_elapsed_level=0, use_time_stamp=True, use_special_sys_prompt_naive=False, use_special_sys_prompt_rule=False)
+METRIC_ARGS = SimpleNamespace(print_logs=False, judge=False)
+CALIBRATION_PATTERN = re.compile(r"\[(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2}):(\d{2})\]")
+
+
+def make_synthetic_data(samples, scale, directory):
+    """
+    Write an enlarged dataset of every real sample repeated scale times (with distinct ids), as
+    a JSON file and a JSONL file.
+    Returns:
+        (JSON path, JSONL path)
+    """
+    enlarged = [dict(sample, id=f"{sample['id']}#{k}") for k in range(scale) for sample in samples]
+    json_path = os.path.join(directory, "synthetic.json")
+    with open(json_path, "w") as f:
+        json.dump(enlarged, f)
+    jsonl_path = os.path.join(directory, "synthetic.jsonl")
+    with open(jsonl_path, "w") as f:
+        for sample in enlarged:
+            f.write(json.dumps(sample) + "\n")
+    return json_path, jsonl_path
+
+
+def reference_tool_calls(sample):
+    """(name, arguments) of the tool calls made in a sample's history; a few histories write the arguments as a Python literal."""
+    calls = []
+    for message in sample["history"]:
+        for tool_call in message.get("tool_calls") or []:
+            arguments = tool_call["function"]["arguments"]
+            if isinstance(arguments, str):
+                try:
+                    arguments = json.loads(arguments)
+                except ValueError:
+                    arguments = ast.literal_eval(arguments)
+            calls.append((tool_call["function"]["name"], arguments))
+    return calls
+
+
+def make_model_outputs(parser_name, samples):
+    """
+    Raw model outputs in a parser's syntax: every tool call of the histories as the model would
+    write it, and one text answer per sample, with each sample's name -> parameter schema map.
+    """
+    outputs = []
+    for sample in samples:
+        name_to_param = {function["function"]["name"]: function["function"]["parameters"] for function in sample["function"]}
+        for name, arguments in reference_tool_calls(sample):
+            if parser_name == "repr":
+                # str() of an OpenAI tool call list, as saved by earlier versions of the API handlers
+                text = f"[ChatCompletionMessageToolCall(id='call_0', function=Function(arguments={json.dumps(arguments)!r}, name={name!r}), type='function')]"
+            else:
+                text = format_tool_call(parser_name, name, arguments)
+            outputs.append((text, name_to_param))
+        outputs.append(("I can help with that. Could you tell me a bit more about what you need?", name_to_param))
+    return outputs
+
+
+def bench_load_data(path):
+    return lambda: load_data(path)
+
+
+def bench_format_input(handler, samples):
+    def run():
+        for sample in samples:
+            handler.format_input(sample["history"], tools=sample.get("function"), **CONFIG)
+    return run
+
+
+def bench_parse(parser_name, outputs):
+    def run():
+        for text, name_to_param in outputs:
+            record = parse_tool_output(parser_name, text)
+            if record["decision"] == "tool":
+                check_tool_call_structer(record, name_to_param, METRIC_ARGS)
+    return run
+
+
+def bench_validate(pairs):
+    def run():
+        for schema, arguments in pairs:
+            get_validator(schema).validate(arguments)
+    return run
+
+
+def bench_compile_schemas(schemas):
+    def run():
+        get_metric._validators.clear()
+        for schema in schemas:
+            get_validator(schema)
+    return run
+
+
+def bench_eval_to_metric(model, samples, output_dir):
+    """Render, generate with the fake engine, save the outputs, read them back and score them, as eval_from_local.py and get_metric.py do."""
+    input_by_id = {sample["id"]: sample for sample in samples}
+    output_path = os.path.join(output_dir, f"{model.split('/')[-1]}.json")
+
+    def run():
+        handler = get_handler(model, model_path=model, engine="fake")
+        rendered = [(sample["id"], prompt) for sample, prompt in zip(samples, handler.render_many(samples, CONFIG)) if not isinstance(prompt, Exception)]
+        outputs = handler.run_inference([prompt for _, prompt in rendered])
+        save_outputs(output_path, [sample_id for sample_id, _ in rendered], outputs)
+        with open(output_path, "r") as f:
+            output_data = json.load(f)
+        score_outputs(output_data, input_by_id, model, METRIC_ARGS)
+    return run
+
+
+def collect_benchmarks(data_files, scale, work_dir):
+    """
+    Every benchmark, as (name, function, number of operations per call, operation unit).
+    """
+    samples = [sample for path in data_files for sample in load_data(path)]
+    synthetic_json, synthetic_jsonl = make_synthetic_data(samples, scale, work_dir)
+    synthetic = load_data(synthetic_json)
+    benchmarks = []
+    for path in data_files:
+        benchmarks.append((f"load_data[{get_data_name(path)}]", bench_load_data(path), len(load_data(path)), "samples"))
+    benchmarks.append((f"load_data[synthetic_x{scale}.json]", bench_load_data(synthetic_json), len(synthetic), "samples"))
+    benchmarks.append((f"load_data[synthetic_x{scale}.jsonl]", bench_load_data(synthetic_jsonl), len(synthetic), "samples"))
+
+    # One handler per template in templates/
+    handlers = {}
+    for model, spec in MODELS.items():
+        if spec.engine != "api" and spec.template not in handlers:
+            handlers[spec.template] = get_handler(model, model_path=model, engine=None)
+    for template, handler in sorted(handlers.items()):
+        # Samples a template rejects (e.g. parallel tool calls for Llama) are skipped, as the eval scripts do
+        accepted = [sample for sample, prompt in zip(samples, handler.render_many(samples, CONFIG)) if not isinstance(prompt, Exception)]
+        benchmarks.append((f"format_input[{template}]", bench_format_input(handler, accepted), len(accepted), "prompts"))
+
+    for parser_name in TOOL_PARSERS:
+        outputs = make_model_outputs(parser_name, samples)
+        benchmarks.append((f"parse_and_check[{parser_name}]", bench_parse(parser_name, outputs), len(outputs), "outputs"))
+
+    pairs = []
+    for sample in samples:
+        name_to_param = {function["function"]["name"]: function["function"]["parameters"] for function in sample["function"]}
+        pairs.extend((name_to_param[name], arguments) for name, arguments in reference_tool_calls(sample))
+    schemas = list({json.dumps(schema, sort_keys=True): schema for schema, _ in pairs}.values())
+    benchmarks.append(("jsonschema_validate", bench_validate(pairs), len(pairs), "tool calls"))
+    benchmarks.append(("jsonschema_compile", bench_compile_schemas(schemas), len(schemas), "schemas"))
+
+    # End to end for one local model per output syntax
+    models = {}
+    for model, spec in MODELS.items():
+        if spec.engine != "api":
+            models.setdefault(spec.tool_parser, model)
+    for parser_name, model in models.items():
+        benchmarks.append((f"eval_to_metric[{parser_name}]", bench_eval_to_metric(model, synthetic, work_dir), len(synthetic), "samples"))
+    return benchmarks
+
+
+def measure(function, repeat, min_time=0.2):
+    """
+    Best time per call over repeat timed samples, after a warm-up call; like timeit, each sample
+    calls the function as many times as it takes to last at least min_time, so fast benchmarks
+    are not dominated by timer and scheduling noise. The peak Python memory is measured on one
+    more call traced separately (tracing slows the code down, so it is kept out of the timings).
+    Returns:
+        (seconds per call, peak bytes)
+    """
+    start = time.perf_counter()
+    function()
+    number = max(1, int(min_time / max(time.perf_counter() - start, 1e-9)) + 1)
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        times.append((time.perf_counter() - start) / number)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(times), peak
+
+
+def calibration_loop():
+    """Fixed pure-Python workload (JSON round trips, regex matching and dict building) that the throughputs are normalized by."""
+    record = {"name": "calibration", "arguments": {"values": list(range(50)), "text": "[2024-01-01 10:00:00] calibration " * 8}}
+    for _ in range(200):
+        decoded = json.loads(json.dumps(record))
+        {key: len(str(value)) for key, value in decoded["arguments"].items()}
+        CALIBRATION_PATTERN.findall(decoded["arguments"]["text"])
+
+
+def relative_change(result, baseline, calibration, baseline_calibration):
+    """Change of a result's throughput against its baseline, each normalized by the calibration loop's throughput on its machine."""
+    return (result["ops_per_sec"] / calibration) / (baseline["ops_per_sec"] / baseline_calibration) - 1
+
+
+def compare(result, baseline, threshold, memory_threshold, calibration, baseline_calibration, memory_slack_mb=1.0):
+    """
+    Regressions of a result against its baseline: normalized throughput (see relative_change)
+    more than threshold below it, or peak memory more than memory_threshold (and memory_slack_mb)
+    above it.
+    Returns:
+        List of regression descriptions
+    """
+    regressions = []
+    change = relative_change(result, baseline, calibration, baseline_calibration)
+    if change < -threshold:
+        regressions.append(f"normalized throughput {change:+.1%}")
+    if result["peak_mb"] > baseline["peak_mb"] * (1 + memory_threshold) + memory_slack_mb:
+        regressions.append(f"peak memory {result['peak_mb'] - baseline['peak_mb']:+.1f} MB")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the evaluation pipeline (data loading, prompt rendering, output parsing, schema validation and eval to metric with the fake engine) against stored baselines.")
+    parser.add_argument("--data", type=str, nargs="+", default=None, help="Data files to benchmark on (defaults to every data/*.json).")
+    parser.add_argument("--scale", type=int, default=10, help="How many times every sample is repeated in the synthetic enlarged dataset.")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed samples per benchmark; the best one counts.")
+    parser.add_argument("--min_time", type=float, default=0.2, help="Seconds each timed sample lasts at least (fast benchmarks are called several times per sample).")
+    parser.add_argument("--filter", type=str, nargs="+", default=None, help="Only run the benchmarks whose name contains one of these strings.")
+    parser.add_argument("--baseline", type=str, default="benchmarks/baseline.json", help="Local baseline to compare against; recorded by the first run if it does not exist.")
+    parser.add_argument("--save_baseline", action="store_true", help="Store the results as the new baseline instead of comparing against it.")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Fail when a benchmark's throughput, normalized by the calibration loop, drops by more than this fraction of its baseline.")
+    parser.add_argument("--memory_threshold", type=float, default=0.25, help="Fail when a benchmark's peak memory grows by more than this fraction of its baseline (plus 1 MB).")
+    parser.add_argument("--output", type=str, default=None, help="Also save the results as JSON.")
+    args = parser.parse_args()
+    data_files = args.data or sorted(glob.glob("data/*.json"))
+    work_dir = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        benchmarks = collect_benchmarks(data_files, args.scale, work_dir)
+        if args.filter:
+            benchmarks = [benchmark for benchmark in benchmarks if any(part in benchmark[0] for part in args.filter)]
+        baseline = None
+        if not args.save_baseline and os.path.exists(args.baseline):
+            with open(args.baseline, "r") as f:
+                baseline = json.load(f)
+            if baseline.get("scale") != args.scale:
+                print(f"Warning: the baseline was recorded with --scale {baseline.get('scale')}, synthetic data benchmarks are not comparable")
+        calibration = 1 / measure(calibration_loop, args.repeat, args.min_time)[0]
+        # Baselines from before the calibration loop was added are compared in absolute terms
+        baseline_calibration = (baseline or {}).get("calibration", calibration)
+        print(f"Calibration loop: {calibration:.1f} ops/s" + (f" (baseline {baseline_calibration:.1f} ops/s)" if baseline else ""))
+        results = {}
+        failed = []
+        print(f"{'benchmark':<44} {'ops/s':>12} {'peak MB':>9} {'baseline ops/s':>15} {'change':>8}")
+        for name, function, num_ops, unit in benchmarks:
+            seconds, peak = measure(function, args.repeat, args.min_time)
+            result = results[name] = {"ops_per_sec": num_ops / seconds, "peak_mb": peak / 2 ** 20, "seconds": seconds, "ops": num_ops, "unit": unit}
+            reference = (baseline or {}).get("results", {}).get(name)
+            regressions = compare(result, reference, args.threshold, args.memory_threshold, calibration, baseline_calibration) if reference else []
+            if regressions:
+                failed.append((name, regressions))
+            line = f"{name:<44} {result['ops_per_sec']:>12.1f} {result['peak_mb']:>9.2f}"
+            if reference:
+                line += f" {reference['ops_per_sec']:>15.1f} {relative_change(result, reference, calibration, baseline_calibration):>+8.1%}"
+            print(line + ("  REGRESSION: " + ", ".join(regressions) if regressions else ""))
+        report = {
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "machine": f"{platform.system()} {platform.machine()}, {os.cpu_count()} CPUs",
+            "scale": args.scale,
+            "repeat": args.repeat,
+            "calibration": calibration,
+            "results": results,
+        }
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=4)
+        if args.save_baseline or baseline is None:
+            if os.path.dirname(args.baseline) and not os.path.exists(os.path.dirname(args.baseline)):
+                os.makedirs(os.path.dirname(args.baseline))
+            if args.filter and os.path.exists(args.baseline):
+                # Refresh only the benchmarks that were run
+                with open(args.baseline, "r") as f:
+                    report["results"] = {**json.load(f)["results"], **results}
+            with open(args.baseline, "w") as f:
+                json.dump(report, f, indent=4)
+            print(f"Baseline saved to {args.baseline}")
+    finally:
+        shutil.rmtree(work_dir)
+    if failed:
+        print(f"{len(failed)} benchmarks regressed past the thresholds (throughput {args.threshold:.0%}, memory {args.memory_threshold:.0%}):")
+        for name, regressions in failed:
+            print(f"  - {name}: {', '.join(regressions)}")
+        raise SystemExit(1)
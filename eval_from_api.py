@@ -1,28 +1,18 @@
-import os
-import json
 from inference.model_handler import Base_Handler
-import importlib
-from utils import load_data
+from utils import iter_data, parse_shard_args, shard_samples, save_shard_config, get_data_name, get_output_path, get_checkpoint_path, load_checkpoint, Checkpoint_Writer, finalize_outputs, load_budget, resolve_max_tokens, get_trace_path, get_batch_dir
 import argparse
-from inference.model_map import MODEL_TO_HANDLER
+from inference.model_map import MODELS
+from inference.response_cache import Response_Cache
+from inference.tool_parsers import is_error
+from inference.forecast import dry_run
+from inference.telemetry import Telemetry_Trace
 
-def get_handler(handler_name: str, **kwargs) -> Base_Handler:
-    module = importlib.import_module(f"inference.api.{handler_name}")
-    handler_class = None
-    from inference.model_handler import Base_Handler
-    for attr in dir(module):
-        obj = getattr(module, attr)
-        if (
-            isinstance(obj, type)
-            and issubclass(obj, Base_Handler)
-            and obj is not Base_Handler
-            and attr.lower().endswith("_handler")
-        ):
-            handler_class = obj
-            break
-    if handler_class is None:
-        raise ValueError(f"No handler class found in {handler_name}")
-    return handler_class(**kwargs)
+def get_handler(model: str, **kwargs) -> Base_Handler:
+    """Instantiate the handler registered for a model code in inference.model_map.MODELS."""
+    spec = MODELS.get(model)
+    if spec is None:
+        raise ValueError(f"Unknown model code: {model}")
+    return spec.load_handler()(**kwargs)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Evaluate API-based LLM function calling.")
@@ -33,39 +23,118 @@ if __name__ == "__main__":
     parser.add_argument("--use_special_sys_prompt_naive", action="store_true", help="Whether to use special system prompt (naive).")
     parser.add_argument("--use_special_sys_prompt_rule", action="store_true", help="Whether to use special system prompt (emperical rule).")
     parser.add_argument("--output_dir", type=str, default="outputs", help="Directory to save output JSON files.")
+    parser.add_argument("--requests_per_minute", type=float, default=None, help="Request rate limit (defaults to the handler's provider limit).")
+    parser.add_argument("--tokens_per_minute", type=float, default=None, help="Prompt token rate limit (defaults to the handler's provider limit).")
+    parser.add_argument("--max_concurrency", type=int, default=None, help="Upper bound for the adaptive number of concurrent requests.")
+    parser.add_argument("--max_retries", type=int, default=None, help="Retries per request on 429, 5xx and timeouts.")
+    parser.add_argument("--deadline", type=float, default=None, help="Overall deadline for the run in seconds; unfinished requests are reported as errors.")
+    parser.add_argument("--hedge_percentile", type=float, default=None, help="Send a duplicate of a request once it runs longer than this percentile of the run's latencies so far, e.g. 95, and keep the first response (off by default).")
+    parser.add_argument("--hedge_budget", type=float, default=None, help="With --hedge_percentile, largest share of requests that are duplicated (default 0.05).")
+    parser.add_argument("--hedge_min_samples", type=int, default=None, help="With --hedge_percentile, successful requests needed before the latency threshold is trusted (default 20).")
+    parser.add_argument("--response_cache", type=str, default=None, help="Path of a SQLite response cache; requests already in it are not sent again.")
+    parser.add_argument("--response_cache_max_mb", type=float, default=None, help="Evict least recently used cache entries beyond this size.")
+    parser.add_argument("--resume", action="store_true", help="Resume an interrupted run from its checkpoint, skipping samples that already have an output.")
+    parser.add_argument("--batch", action="store_true", help="Submit the requests through the OpenAI Batch API instead of synchronous chat completions (OpenAI models only).")
+    parser.add_argument("--batch_poll_interval", type=float, default=30, help="Seconds between batch status checks.")
+    parser.add_argument("--base_url", type=str, default=None, help="Override the API base URL, e.g. http://localhost:8000/v1 (OpenAI, DeepSeek) or http://localhost:8000 (Cohere) for mock_api_server.py.")
+    parser.add_argument("--shard", type=str, default=None, help="Only run shard i of N of the data file, given as i/N (0-based), taking every N-th sample.")
+    parser.add_argument("--num_shards", type=int, default=None, help="Split the data file into this many length-balanced shards (same split on every node); use with --shard_index and merge with merge_shards.py.")
+    parser.add_argument("--shard_index", type=int, default=None, help="Which of the --num_shards shards to run (0-based).")
+    parser.add_argument("--ids", type=str, nargs="+", default=None, help="Only run the samples with these ids.")
+    parser.add_argument("--max_tokens", type=int, default=None, help="Generation budget per request (defaults to the budget file, then the provider's default).")
+    parser.add_argument("--budget_file", type=str, default=None, help="JSON file of generation budgets per model and data file (see utils.load_budget).")
+    parser.add_argument("--dry_run", action="store_true", help="Only format and tokenize the requests and report token counts, samples exceeding the context window and the projected cost; nothing is sent.")
+    parser.add_argument("--expected_output_tokens", type=float, default=None, help="With --dry_run, expected output tokens per request (defaults to a previous run's outputs).")
+    parser.add_argument("--input_price", type=float, default=None, help="USD per million prompt tokens, for the dry run forecast and the telemetry spend (defaults to the model's list price).")
+    parser.add_argument("--output_price", type=float, default=None, help="USD per million output tokens, for the dry run forecast and the telemetry spend (defaults to the model's list price).")
+    parser.add_argument("--cached_input_price", type=float, default=None, help="USD per million prompt tokens served from the provider's prompt cache, for the telemetry spend (defaults to the model's list price).")
+    parser.add_argument("--no_trace", action="store_true", help="Do not write the per-request telemetry trace (<output>-trace.jsonl) and summary.")
     args = parser.parse_args()
     assert not (args.use_special_sys_prompt_naive and args.use_special_sys_prompt_rule), "Cannot use both special sys prompts."
     use_time_stamp = True if args.use_time_stamp else False
-    handler_name = MODEL_TO_HANDLER.get(args.model)
-    if handler_name is None:
-        raise ValueError(f"Unknown model code: {args.model}")
-    data = load_data(args.data)
+    shard, balanced = parse_shard_args(args.shard, args.num_shards, args.shard_index)
+    planned = shard_samples(args.data, shard, balanced, ids=args.ids) if shard else None
+    data = iter_data(args.data, ids=[sample_id for _, sample_id in planned] if shard else args.ids)
     model_name = args.model
     if "-FC" in model_name:
         model_name = model_name.replace("-FC", "")
-    handler = get_handler(handler_name, model_name=model_name)
+    engine_config = {
+        "requests_per_minute": args.requests_per_minute,
+        "tokens_per_minute": args.tokens_per_minute,
+        "max_concurrency": args.max_concurrency,
+        "max_retries": args.max_retries,
+        "deadline": args.deadline,
+        "hedge_percentile": args.hedge_percentile,
+        "hedge_budget": args.hedge_budget,
+        "hedge_min_samples": args.hedge_min_samples,
+    }
+    output_path = get_output_path(args.output_dir, args.model, args.data, args.time_elapsed_level, use_time_stamp, shard=shard)
+    handler_kwargs = {}
+    if args.base_url:
+        handler_kwargs["base_url"] = args.base_url
+    if args.batch:
+        if MODELS[args.model].handler_name != "openai":
+            raise ValueError("--batch is only supported for OpenAI models.")
+        handler_kwargs.update(use_batch=True, batch_dir=get_batch_dir(output_path), poll_interval=args.batch_poll_interval)
+    handler = get_handler(args.model, model_name=model_name, engine_config=engine_config, **handler_kwargs)
+    budget = load_budget(args.budget_file) if args.budget_file else {}
+    handler.set_max_tokens(args.max_tokens or resolve_max_tokens(budget, args.model, args.data, handler.max_tokens))
+    if args.response_cache:
+        handler.response_cache = Response_Cache(args.response_cache, max_bytes=args.response_cache_max_mb * 2 ** 20 if args.response_cache_max_mb else None)
+    checkpoint_path = get_checkpoint_path(output_path)
+    # On resume, samples that already have an output are skipped; failed ones are sent again
+    finished = {k: v for k, v in load_checkpoint(checkpoint_path).items() if not is_error(v)} if args.resume else {}
+    if finished:
+        print(f"Resuming: {len(finished)} samples already finished in {checkpoint_path}")
+    if shard:
+        config = dict(
+            time_elapsed_level=args.time_elapsed_level,
+            use_time_stamp=use_time_stamp,
+            use_special_sys_prompt_naive=args.use_special_sys_prompt_naive,
+            use_special_sys_prompt_rule=args.use_special_sys_prompt_rule
+        )
+        save_shard_config(output_path, {
+            "model": args.model, "data": get_data_name(args.data), "config": config, "handler": handler.cache_identity(),
+            "partition": "balanced" if balanced else "round_robin", "num_shards": shard[1], "shard_index": shard[0], "samples": planned,
+        })
     formatted_prompts = []
     sample_ids = []
+    all_sample_ids = []
     for sample in data:
+        all_sample_ids.append(sample.get('id', 'N/A'))
+        if sample.get('id', 'N/A') in finished:
+            continue
         history = sample["history"]
         tools = sample.get("function", None)
         formatted = handler.format_input(history, tools=tools, time_elapsed_level=args.time_elapsed_level, use_time_stamp=use_time_stamp, use_special_sys_prompt_naive=args.use_special_sys_prompt_naive, use_special_sys_prompt_rule=args.use_special_sys_prompt_rule)
         formatted_prompts.append(formatted)
         sample_ids.append(sample.get('id', 'N/A'))
-    outputs = handler.run_inference(formatted_prompts)
+    if args.dry_run:
+        dry_run(handler, MODELS[args.model], f"{args.model} on {args.data}", sample_ids, formatted_prompts, output_path=output_path,
+                expected_output_tokens=args.expected_output_tokens, input_price=args.input_price, output_price=args.output_price)
+        raise SystemExit
+    # Batch API results arrive all at once, without per-request timings
+    trace = None
+    if not args.no_trace and not args.batch:
+        spec = MODELS[args.model]
+        trace = Telemetry_Trace(get_trace_path(output_path), model=args.model,
+                                input_price=args.input_price if args.input_price is not None else spec.input_price,
+                                output_price=args.output_price if args.output_price is not None else spec.output_price,
+                                cached_input_price=args.cached_input_price if args.cached_input_price is not None else spec.cached_input_price)
+        handler.engine.trace = trace
+    # Stream each output to the checkpoint as soon as it arrives
+    with Checkpoint_Writer(checkpoint_path, resume=args.resume) as checkpoint:
+        outputs = handler.run_inference(formatted_prompts, on_result=lambda i, output: checkpoint.write(sample_ids[i], output))
+    if handler.response_cache is not None:
+        print(handler.response_cache.summary())
+    if trace is not None:
+        trace.close()
+        if trace.records:
+            print(trace.format_summary())
     # for idx, text in enumerate(outputs):
     #     print(f"Sample ID: {sample_ids[idx]}")
     #     print(f"Output: {text}\n")
 
     # save outputs in json format
-    output_data = [{"id": sample_ids[i], "output": outputs[i]} for i in range(len(outputs))]
-    if use_time_stamp:
-        output_file = f"{args.model.replace('/', '_')}-{args.data.split('/')[-1][:-5]}-{args.time_elapsed_level}.json"
-    else:
-        output_file = f"{args.model.replace('/', '_')}-{args.data.split('/')[-1][:-5]}-notime.json"
-
-    if not os.path.exists(os.path.join(args.output_dir, args.model.replace('/', '_'))):
-        os.makedirs(os.path.join(args.output_dir, args.model.replace('/', '_')))
-    with open(os.path.join(args.output_dir, args.model.replace('/', '_'), output_file), 'w') as f:
-        json.dump(output_data, f, indent=4)
-    print(f"Outputs saved to {output_file}")
+    finalize_outputs(checkpoint_path, output_path, all_sample_ids)
+    print(f"Outputs saved to {output_path}")
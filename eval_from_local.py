@@ -1,28 +1,18 @@
-import os
-import json
 from inference.model_handler import Base_Handler
-import importlib
-from utils import load_data
+from utils import iter_data, parse_shard_args, shard_samples, save_shard_config, get_data_name, iter_chunks, get_output_path, get_checkpoint_path, load_checkpoint, Checkpoint_Writer, finalize_outputs, get_propensity_path, save_outputs, load_budget, resolve_max_tokens
 import argparse
-from inference.model_map import MODEL_TO_HANDLER
+from inference.model_map import MODELS
+from inference.response_cache import Response_Cache
+from inference.prompt_cache import Prompt_Cache
+from inference.tool_parsers import is_error
+from inference.forecast import dry_run
 
-def get_handler(handler_name: str, **kwargs) -> Base_Handler:
-    module = importlib.import_module(f"inference.local.{handler_name}")
-    handler_class = None
-    from inference.model_handler import Base_Handler
-    for attr in dir(module):
-        obj = getattr(module, attr)
-        if (
-            isinstance(obj, type)
-            and issubclass(obj, Base_Handler)
-            and obj is not Base_Handler
-            and attr.lower().endswith("_handler")
-        ):
-            handler_class = obj
-            break
-    if handler_class is None:
-        raise ValueError(f"No handler class found in {handler_name}")
-    return handler_class(**kwargs)
+def get_handler(model: str, **kwargs) -> Base_Handler:
+    """Instantiate the handler registered for a model code in inference.model_map.MODELS."""
+    spec = MODELS.get(model)
+    if spec is None:
+        raise ValueError(f"Unknown model code: {model}")
+    return spec.load_handler()(**kwargs)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Evaluate local LLM function calling.")
@@ -33,50 +23,109 @@ if __name__ == "__main__":
     parser.add_argument("--use_special_sys_prompt_naive", action="store_true", help="Whether to use special system prompt.")
     parser.add_argument("--use_special_sys_prompt_rule", action="store_true", help="Whether to use special system prompt (emperical rule).")
     parser.add_argument("--output_dir", type=str, default="outputs", help="Directory to save output JSON files.")
+    parser.add_argument("--enable_prefix_caching", action="store_true", help="Enable vllm automatic prefix caching, submit prompts grouped by shared prefix and report the cache hit rate.")
+    parser.add_argument("--render_workers", type=int, default=1, help="Number of processes used to render prompts.")
+    parser.add_argument("--engine", type=str, default="vllm", choices=["vllm", "fake"], help="Inference engine. 'fake' returns scripted outputs on CPU, for running and profiling the pipeline without GPUs.")
+    parser.add_argument("--data_parallel_size", type=int, default=1, help="Run this many engine replicas, each in its own process on its own GPUs, and split the prompts between them (one replica if there are not enough GPUs).")
+    parser.add_argument("--gpus_per_replica", type=int, default=None, help="With --data_parallel_size, GPUs (tensor parallel size) of each replica; defaults to an even split of the visible GPUs.")
+    parser.add_argument("--fake_tool_call_rate", type=float, default=0.5, help="Share of prompts the fake engine answers with a tool call.")
+    parser.add_argument("--fake_latency", type=float, default=0.0, help="Seconds the fake engine spends per generate call.")
+    parser.add_argument("--fake_tokens_per_second", type=float, default=None, help="Decode throughput of the fake engine (unlimited by default).")
+    parser.add_argument("--response_cache", type=str, default=None, help="Path of a SQLite response cache; requests already in it are not sent again.")
+    parser.add_argument("--response_cache_max_mb", type=float, default=None, help="Evict least recently used cache entries beyond this size.")
+    parser.add_argument("--prompt_cache", type=str, default=None, help="Directory of an on-disk cache of rendered prompts and token ids; prompts already in it are neither rendered nor tokenized again.")
+    parser.add_argument("--resume", action="store_true", help="Resume an interrupted run from its checkpoint, skipping samples that already have an output.")
+    parser.add_argument("--stream_batch_size", type=int, default=64, help="Number of prompts per vllm micro-batch written to the checkpoint.")
+    parser.add_argument("--score_propensity", action="store_true", help="Instead of generating, score each prompt's tool call propensity from the next-token distribution and save it to <output>-propensity.json.")
+    parser.add_argument("--decision_only", action="store_true", help="Stop text answers as soon as it is clear the model is not calling a tool; tool calls are still generated in full (for attempt-rate metrics).")
+    parser.add_argument("--decision_chars", type=int, default=None, help="With --decision_only, for parsers that find a tool call anywhere in the reply (qwen, deepseek_distill), cut a text answer after this many characters without a tool call opener. By default such answers are generated to the end, so the decision matches a full run.")
+    parser.add_argument("--shard", type=str, default=None, help="Only run shard i of N of the data file, given as i/N (0-based), taking every N-th sample.")
+    parser.add_argument("--num_shards", type=int, default=None, help="Split the data file into this many length-balanced shards (same split on every node); use with --shard_index and merge with merge_shards.py.")
+    parser.add_argument("--shard_index", type=int, default=None, help="Which of the --num_shards shards to run (0-based).")
+    parser.add_argument("--ids", type=str, nargs="+", default=None, help="Only run the samples with these ids.")
+    parser.add_argument("--max_tokens", type=int, default=None, help="Generation budget per sample (defaults to the budget file, then the handler's max_tokens).")
+    parser.add_argument("--budget_file", type=str, default=None, help="JSON file of generation budgets per model and data file (see utils.load_budget).")
+    parser.add_argument("--dry_run", action="store_true", help="Only render and tokenize the prompts and report token counts, samples exceeding the context window and the projected generation time; nothing is generated.")
+    parser.add_argument("--calibrate", type=int, default=0, help="With --dry_run, generate this many prompts to measure throughput and output length (loads the engine).")
+    parser.add_argument("--expected_output_tokens", type=float, default=None, help="With --dry_run, expected output tokens per sample (defaults to the calibration, then a previous run's outputs).")
+    parser.add_argument("--tokens_per_second", type=float, default=None, help="With --dry_run, measured output tokens per second of the model, for the generation time forecast.")
     args = parser.parse_args()
     assert not (args.use_special_sys_prompt_naive and args.use_special_sys_prompt_rule), "Cannot use both special sys prompts."
     use_time_stamp = True if args.use_time_stamp else False
-    handler_name = MODEL_TO_HANDLER.get(args.model)
-    if handler_name is None:
-        raise ValueError(f"Unknown model code: {args.model}")
-    handler = get_handler(handler_name, model_path=args.model)
-    data = load_data(args.data)
+    engine_config = {"data_parallel_size": args.data_parallel_size, "gpus_per_replica": args.gpus_per_replica}
+    if args.engine == "fake":
+        engine_config.update({"tool_call_rate": args.fake_tool_call_rate, "latency": args.fake_latency, "tokens_per_second": args.fake_tokens_per_second})
+    # A dry run only needs the engine to calibrate
+    engine = None if args.dry_run and not args.calibrate else args.engine
+    handler = get_handler(args.model, model_path=args.model, enable_prefix_caching=args.enable_prefix_caching, engine=engine, engine_config=engine_config)
+    budget = load_budget(args.budget_file) if args.budget_file else {}
+    handler.set_max_tokens(args.max_tokens or resolve_max_tokens(budget, args.model, args.data, handler.max_tokens))
+    handler.stream_batch_size = args.stream_batch_size
+    handler.decision_only = args.decision_only
+    handler.decision_chars = args.decision_chars
+    if args.response_cache:
+        handler.response_cache = Response_Cache(args.response_cache, max_bytes=args.response_cache_max_mb * 2 ** 20 if args.response_cache_max_mb else None)
+    if args.prompt_cache:
+        handler.prompt_cache = Prompt_Cache(args.prompt_cache)
+    shard, balanced = parse_shard_args(args.shard, args.num_shards, args.shard_index)
+    planned = shard_samples(args.data, shard, balanced, ids=args.ids) if shard else None
+    output_path = get_output_path(args.output_dir, args.model, args.data, args.time_elapsed_level, use_time_stamp, shard=shard)
+    checkpoint_path = get_checkpoint_path(output_path)
+    # On resume, samples that already have an output are skipped; failed ones are generated again
+    finished = {k: v for k, v in load_checkpoint(checkpoint_path).items() if not is_error(v)} if args.resume else {}
+    if finished:
+        print(f"Resuming: {len(finished)} samples already finished in {checkpoint_path}")
     # Prepare all formatted prompts in a batch
+    config = dict(
+        time_elapsed_level=args.time_elapsed_level,
+        use_time_stamp=use_time_stamp,
+        use_special_sys_prompt_naive=args.use_special_sys_prompt_naive,
+        use_special_sys_prompt_rule=args.use_special_sys_prompt_rule
+    )
+    if shard:
+        save_shard_config(output_path, {
+            "model": args.model, "data": get_data_name(args.data), "config": config, "handler": handler.cache_identity(),
+            "partition": "balanced" if balanced else "round_robin", "num_shards": shard[1], "shard_index": shard[0], "samples": planned,
+        })
+    # Samples are streamed from the data file in chunks, so only the rendered prompts are kept in memory
+    all_sample_ids = []
     formatted_prompts = []
     sample_ids = []
-    for sample in data:
-        history = sample["history"]
-        # Pass the 'function' field as tools to the template, and set a default date_string
-        tools = sample.get("function", None)
-        try:
-            formatted = handler.format_input(
-                history,
-                tools=tools,
-                time_elapsed_level=args.time_elapsed_level,
-                use_time_stamp=use_time_stamp,
-                use_special_sys_prompt_naive=args.use_special_sys_prompt_naive,
-                use_special_sys_prompt_rule=args.use_special_sys_prompt_rule
-            )
+    for chunk in iter_chunks(iter_data(args.data, ids=[sample_id for _, sample_id in planned] if shard else args.ids), 1024):
+        all_sample_ids.extend(sample.get('id', 'N/A') for sample in chunk)
+        chunk = [sample for sample in chunk if sample.get('id', 'N/A') not in finished]
+        for sample, formatted in zip(chunk, handler.render_many(chunk, config, num_workers=args.render_workers)):
+            if isinstance(formatted, Exception):
+                print(f"Error formatting sample {sample.get('id', 'N/A')}: {formatted}")
+                continue
             formatted_prompts.append(formatted)
             sample_ids.append(sample.get('id', 'N/A'))
-        except Exception as e:
-            print(f"Error formatting sample {sample.get('id', 'N/A')}: {e}")
-            continue
-    
-    # Batch inference with vllm using handler's run_inference
-    outputs = handler.run_inference(formatted_prompts)
+
+    if args.dry_run:
+        dry_run(handler, MODELS[args.model], f"{args.model} on {args.data}", sample_ids, formatted_prompts, engine=args.engine, output_path=output_path,
+                expected_output_tokens=args.expected_output_tokens, tokens_per_second=args.tokens_per_second, calibrate=args.calibrate)
+        raise SystemExit
+
+    if args.score_propensity:
+        scores = handler.score_propensity(formatted_prompts)
+        propensity_path = get_propensity_path(output_path)
+        save_outputs(propensity_path, sample_ids, scores)
+        mean = sum(score["propensity"] for score in scores) / len(scores) if scores else 0
+        print(f"Mean tool call propensity: {mean:.4f} over {len(scores)} samples")
+        print(f"Propensity scores saved to {propensity_path}")
+        raise SystemExit
+
+    # Batch inference with vllm using handler's run_inference, streaming each micro-batch to the checkpoint
+    with Checkpoint_Writer(checkpoint_path, resume=args.resume) as checkpoint:
+        outputs = handler.run_inference(formatted_prompts, on_result=lambda i, output: checkpoint.write(sample_ids[i], output))
+    if handler.response_cache is not None:
+        print(handler.response_cache.summary())
+    if handler.prompt_cache is not None:
+        print(handler.prompt_cache.summary())
     # for idx, text in enumerate(outputs):
     #     print(f"Sample ID: {sample_ids[idx]}")
     #     print(f"Output: {text}\n")
     
     # save outputs in json format
-    output_data = [{"id": sample_ids[i], "output": outputs[i]} for i in range(len(outputs))]
-    if use_time_stamp:
-        output_file = f"{args.model.split('/')[-1]}-{args.data.split('/')[-1][:-5]}-{args.time_elapsed_level}.json"
-    else:
-        output_file = f"{args.model.split('/')[-1]}-{args.data.split('/')[-1][:-5]}-notime.json"
-    if not os.path.exists(os.path.join(args.output_dir, args.model.split('/')[-1])):
-        os.makedirs(os.path.join(args.output_dir, args.model.split('/')[-1]))
-    with open(os.path.join(args.output_dir, args.model.split('/')[-1], output_file), 'w') as f:
-        json.dump(output_data, f, indent=4)
-    print(f"Outputs saved to {output_file}")
+    finalize_outputs(checkpoint_path, output_path, all_sample_ids)
+    print(f"Outputs saved to {output_path}")
@@ -1,162 +1,56 @@
 import argparse
 
+import csv
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
 import jsonschema
 
-from inference.model_map import MODEL_TO_TOOLCALL_SIGNATURE
+from inference.model_map import MODELS
+from inference.tool_parsers import parse_tool_output, is_error
+from inference.response_cache import Response_Cache
 import os, json
-from openai import OpenAI
+from utils import iter_data, load_data, resolve_data_path, get_data_name
+
 
-client = OpenAI()
-def LLM_as_judge(history, name, parameters, functions):
+def get_tool_parser(model):
+    """
+    Name of the tool parser for a model's raw text, used to read outputs saved as plain strings
+    by earlier versions: the local handler's tool_parser, or "repr" for API models (SDK reprs).
     """
-    Evaluates if the assistant's last tool call is logically correct
-    based on the conversation history and available functions.
+    return MODELS[model].tool_parser
 
-    Args:
-        history (list): A list of dictionaries representing the conversation
-                        history (e.g., [{'role': 'user', 'content': '...'}, ...]).
-        name (str): The last assistant message tool name.
-        parameters (dict): The last assistant message tool parameters.
-        functions (list): A list of dictionaries describing the available tools
-                          (in OpenAI's function/tool format).
 
-    Returns:
-        bool: True if the tool call is judged as correct, False otherwise.
-              Returns False if an error occurs during the API call or parsing.
-    """
-    history_str = json.dumps(history, indent=4)
-    functions_str = json.dumps(functions, indent=4)
-    # 2. Define the system prompt for the LLM judge.
-    # This prompt instructs the LLM on its role, the context it will receive,
-    # and how it should format its response.
-    prompt = f"""
-        You are an expert evaluator of AI assistant responses. Your task is to determine if an AI assistant has chosen the correct tool and parameters to respond to a user's request based on the provided conversation history and the available tools.
-
-        You must focus solely on the **logical correctness** and **appropriateness** of the tool call. You should assume that the tool call's syntax (function name, parameter types, etc.) has already been validated and is correct. Your evaluation should be based on whether the call makes sense in the context of the conversation.
-
-        **Context:**
-        ***
-        **Available Tools:**
-        ```json
-        {functions_str}
-        ```
-        ***
-        **Conversation History:**
-        ```
-        {history_str}
-        ```
-        ***
-        **Assistant's Tool Call to Evaluate:**
-        tool name: {name}
-        tool parameters: {json.dumps(parameters, indent=4)}
-        ***
-
-        **Evaluation Task:**
-
-        1.  **Analyze the Conversation History:** Understand the user's most recent request and the overall goal of the conversation.
-        2.  **Examine the Assistant's Tool Call:** Look at the specific tool chosen and the values of the parameters provided.
-        3.  **Assess Logical Correctness:**
-            { "- Is the chosen tool the most logical one to address the user's last message?" if len(functions)>1  else ""}
-            { "- Would another tool have been more appropriate?" if len(functions)>1  else ""}
-            - Are the parameter values correctly extracted or inferred from the conversation?
-
-        **Final Decision:**
-
-        Based on your analysis, is the assistant's tool call the correct and logical choice in this situation?
-
-        Respond with a JSON object containing two keys, first reason key then is_correct key.
-        - "reason": a brief, one-sentence explanation for your decision.
-        - "is_correct": a boolean value (true or false).
-        
-        example output:
-        ```json
-        {{"reason": "The assistant chose the correct tool and parameters.", "is_correct": true}}
-        ```
-        
-        start outputting now.
-        """
-
-    messages = [
-        {"role": "system",
-         "content": "You are an expert evaluator of AI assistant tool calls. Respond only in JSON format."},
-        {"role": "user", "content": prompt}
-    ],
-    # 3. Call the LLM with the constructed prompt.
-    # We use JSON mode to ensure the output is a valid JSON object.
-    response = client.responses.create(
-        model="gpt-4o",
-        input=prompt,
-        temperature=0.0, # Use a low temperature for objective evaluation
-    )
-
-    # 4. Parse the response and return the decision.
-    judge_response_str = response.output_text.strip().strip("`")
-    if judge_response_str.startswith("json"):
-        judge_response_str = judge_response_str[4:].strip().strip("`").strip()
-    judge_response_json = json.loads(judge_response_str)
-    if args.print_logs:
-        print(f"Judge's Reason: {judge_response_json.get('reason', 'No reason provided.')}")
-        print(f"Judge's Decision: {judge_response_json.get('is_correct', 'No decision provided.')}")
-    return  judge_response_json.get("is_correct", True)
-
-
-
-def check_tool_call_structer(out, name_to_param, args):
+_validators = {}
+
+
+def get_validator(schema):
+    """jsonschema validator for a function's parameter schema, checked and compiled once per distinct schema."""
+    key = json.dumps(schema, sort_keys=True)
+    validator = _validators.get(key)
+    if validator is None:
+        validator_class = jsonschema.validators.validator_for(schema)
+        validator_class.check_schema(schema)
+        validator = _validators[key] = validator_class(schema)
+    return validator
+
+
+def check_tool_call_structer(record, name_to_param, args):
     correct_params = None
     name = None
     parameters = None
     try:
-        if "meta-llam" in args.model:
-            function_call = json.loads(out)
-            name = function_call['name']
-            parameters = json.loads(function_call['parameters'])
-
-        if "Qwen" in args.model:
-            out = out.split("<tool_call>")[1].split("</tool_call>")[0].strip()
-            function_call = json.loads(out)
-            name = function_call['name']
-            parameters = function_call['arguments']
-
-        if "Ministral" in args.model:
-            function_call = json.loads(out)[0]
-            name = function_call['name']
-            parameters = json.loads(function_call['arguments'])
-
-        if "deepseek-ai/DeepSeek-R1-Distill-Llama-8B" in args.model:
-            out = out.split("<｜tool▁call▁begin｜>function<｜tool▁sep｜>")[1].split("<｜tool▁call▁end｜>")[0]
-            name = out.split("```json")[0].strip()
-            parameters = json.loads(out.split("```json")[1].strip().rstrip("`"))
-
-        if "o4" in args.model or "o3" in args.model or "gpt" in args.model or "deepseek-chat" in args.model:
-            class ChatCompletionMessageToolCall:
-                def __init__(self, **kwargs):
-                    self.id = kwargs.get('id')
-                    self.function = kwargs.get('function')
-                    self.type = kwargs.get('type')
-
-            class Function:
-                def __init__(self, **kwargs):
-                    self.arguments = kwargs.get('arguments')
-                    self.name = kwargs.get('name')
-
-            safe_scope = {
-                'ChatCompletionMessageToolCall': ChatCompletionMessageToolCall,
-                'Function': Function
-            }
-
-            # Evaluate the string within the safe scope
-            parsed_data = eval(out, {"__builtins__": None}, safe_scope)
-            tool_call = parsed_data[0]
-
-            function_obj = tool_call.function
-            name = function_obj.name
-            parameters = json.loads(function_obj.arguments)
+        if record.get("parse_error"):
+            raise Exception(record["parse_error"])
+        tool_call = record["tool_calls"][0]
+        name = tool_call["name"]
+        parameters = tool_call["arguments"]
 
         if name not in name_to_param:
             raise Exception(f"Unexpected tool name {name} found in output.")
 
         correct_params = name_to_param[name]
-        jsonschema.validate(instance=parameters, schema=correct_params)
+        get_validator(correct_params).validate(parameters)
         for parameter in parameters:
             if parameter not in correct_params['properties']:
                 raise Exception(f"Unexpected parameter {parameter} found in output.")
@@ -171,7 +65,7 @@ def check_tool_call_structer(out, name_to_param, args):
             print(f"Error processing output: {e}")
             try:
                 print("error:", e)
-                print(f"Output: {out}")
+                print(f"Output: {record['text']}")
                 print(f"name: {name}")
                 print(f"parameters: {parameters}")
                 print(f"Correct correct_params: {json.dumps(correct_params, indent=4)}")
@@ -182,58 +76,46 @@ def check_tool_call_structer(out, name_to_param, args):
         correct_used = False
     return correct_used, name, parameters
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Get tool call rate.")
-    parser.add_argument("--data", type=str, default="final_2_elapse_2", help="data name")
-    parser.add_argument("--model", type=str, default="meta-llama/Llama-3.1-8B-Instruct", help="Model code (will be mapped to handler).")
-    parser.add_argument("--time_elapsed_level", type=int, default=0, choices=[0, 1, 2], help="Time elapsed level for adding time stamp to each message. 0: small change, 1: medium change, 2: large change.")
-    parser.add_argument("--use_time_stamp", action="store_true", help="Whether to use time stamp in the prompt.")
-    parser.add_argument("--print_logs", action="store_true", help="Print logs for debugging/seeing the problem with the model.")
-    parser.add_argument("--output_dir", type=str, default="outputs3", help="Directory containing the output files.")
-    args = parser.parse_args()
-    tool_call_signatures = MODEL_TO_TOOLCALL_SIGNATURE.get(args.model)
-    if tool_call_signatures is None:
-        raise ValueError(f"Unknown model code: {args.model}")
-    print()
-    with open(f"{args.data}.json", "r") as f:
-        input_data = json.load(f)
-    id_to_location = {input_d["id"]:i for i, input_d in enumerate(input_data)}
-    if args.use_time_stamp:
-        output_file = f"{args.model.split('/')[-1]}-{args.data.split('/')[-1]}-{args.time_elapsed_level}.json"
-    else:
-        output_file = f"{args.model.split('/')[-1]}-{args.data.split('/')[-1]}-notime.json"
-    
-    # load the json file
-    with open(os.path.join(args.output_dir, args.model.split('/')[-1], output_file), "r") as f:
-        output_data = json.load(f)
-    if args.use_time_stamp:
-        print(f"Processing {args.model} on {args.data} with time elapsed level {args.time_elapsed_level}")
-    else:
-        print(f"Processing {args.model} on {args.data} without time elapsed")
+
+def score_outputs(output_data, input_by_id, model, args):
+    """
+    Count tool call attempts and correct attempts in one output file.
+    Args:
+        output_data: List of {"id", "output"} dicts as saved by the eval scripts
+        input_by_id: Dict of sample id -> input sample
+        model: Model code, used to parse outputs saved as plain strings
+        args: Parsed arguments (print_logs, judge)
+    Returns:
+        Dict with total (excluding failed), attempted, correct_attempted and failed counts, and with --judge
+        the judge_items (structurally correct tool calls) to be judged by judge_results
+    """
     attempted = 0
     correct_attempted = 0
-    llm_as_judge_corrects = 0
     failed = 0
+    judge_items = []
+    tool_parser = None
     for output in output_data:
-        out = output['output']
-        inp = input_data[id_to_location[output['id']]]
+        record = output['output']
+        if isinstance(record, str):
+            # Output saved as a plain string by an earlier version
+            tool_parser = tool_parser or get_tool_parser(model)
+            record = parse_tool_output(tool_parser, record)
+        inp = input_by_id[output['id']]
         functions_sig = inp['function']
         name_to_param = {function["function"]['name']: function["function"]["parameters"] for function in functions_sig }
 
-        if out == "" or "[ERROR]" in out:
+        if is_error(record):
             failed += 1
             continue
-        used = all(sig in out for sig in tool_call_signatures.split('<AND>'))
+        used = record["decision"] == "tool"
 
         if used:
-            correct_used, name, parameters = check_tool_call_structer(out, name_to_param, args)
-            # if correct_used:
-            #     correct_params = LLM_as_judge(inp['history'], name, parameters, inp['function'])
-            # else:
-            #     correct_params = False
+            correct_used, name, parameters = check_tool_call_structer(record, name_to_param, args)
+            # Only tool calls that pass the structural checks are sent to the judge
+            if correct_used and args.judge:
+                judge_items.append({"history": inp['history'], "name": name, "parameters": parameters, "functions": inp['function']})
         else:
             correct_used = False
-            correct_params = False
 
 
 
@@ -241,21 +123,199 @@ if __name__ == "__main__":
             attempted += 1
         if correct_used:
             correct_attempted += 1
-        # if correct_params:
-        #     llm_as_judge_corrects +=1
-        # if correct_used and correct_params:
-        #     correct_attempted += 1
-    
+
     total = len(output_data) - failed
+    counts = {"total": total, "attempted": attempted, "correct_attempted": correct_attempted, "failed": failed}
+    if args.judge:
+        counts["judge_items"] = judge_items
+    return counts
+
+
+def get_judge(args):
+    from inference.judge import LLM_Judge
+    cache = Response_Cache(args.judge_cache) if args.judge_cache else None
+    engine_config = {"requests_per_minute": args.judge_requests_per_minute, "max_concurrency": args.judge_max_concurrency}
+    return LLM_Judge(args.judge_model, base_url=args.judge_base_url, cache=cache, engine_config=engine_config)
+
+
+def judge_results(results, judge, args):
+    """
+    Judge the structurally correct tool calls of every result in one concurrent run, and add
+    llm_as_judge_corrects (tool calls judged correct) and judge_failed to each result.
+    """
+    items = [item for result in results for item in result["judge_items"]]
+    verdicts = iter(judge.judge_many(items))
+    for result in results:
+        result["llm_as_judge_corrects"] = 0
+        result["judge_failed"] = 0
+        for item in result.pop("judge_items"):
+            verdict = next(verdicts)
+            if verdict is None:
+                result["judge_failed"] += 1
+                continue
+            if args.print_logs:
+                print(f"Judge's Reason: {verdict['reason']}")
+                print(f"Judge's Decision: {verdict['is_correct']}")
+            if verdict["is_correct"]:
+                result["llm_as_judge_corrects"] += 1
+    if judge.cache is not None:
+        print(judge.cache.summary())
+
+
+@lru_cache(maxsize=None)
+def load_inputs(data_path):
+    """Input samples of a data file by id, read once per process."""
+    return {sample["id"]: sample for sample in iter_data(data_path)}
+
+
+def find_runs(output_dir, data_dir):
+    """
+    Find every finished output file under output_dir, including the naive/rule subdirectories
+    written by sweep_from_local.py. Shard outputs, checkpoints and propensity scores are skipped.
+    Args:
+        output_dir: Directory containing <model_dir>/<model_dir>-<data>-<level|notime>.json files
+        data_dir: Directory containing the data files the outputs were generated from
+    Returns:
+        List of dicts with variant, model, data, level, output_path and data_path
+    """
+    model_dirs = {}
+    for model in MODELS:
+        model_dirs.setdefault(model.split('/')[-1], model)
+    runs = []
+    for root, _, files in os.walk(output_dir):
+        model_dir = os.path.basename(root)
+        if model_dir not in model_dirs:
+            continue
+        variant = os.path.relpath(os.path.dirname(root), output_dir)
+        for file in sorted(files):
+            if not file.endswith(".json") or not file.startswith(f"{model_dir}-") or "-shard" in file or file.endswith(("-propensity.json", "-elapsed_curve.json")):
+                continue
+            data_name, level = file[len(model_dir) + 1:-len(".json")].rsplit("-", 1)
+            try:
+                data_path = resolve_data_path(os.path.join(data_dir, data_name))
+            except FileNotFoundError:
+                print(f"Skipping {os.path.join(root, file)}: no data file {data_name} in {data_dir}")
+                continue
+            runs.append({
+                "variant": "none" if variant == "." else variant,
+                "model": model_dirs[model_dir],
+                "data": data_name,
+                "level": level,
+                "output_path": os.path.join(root, file),
+                "data_path": data_path,
+            })
+    return runs
+
+
+def score_run(run, args):
+    with open(run["output_path"], "r") as f:
+        output_data = json.load(f)
+    return dict(run, **score_outputs(output_data, load_inputs(run["data_path"]), run["model"], args))
+
+
+def print_table(results):
+    header = ["model", "sys_prompt", "data", "elapse", "total", "attempt rate", "correct attempt rate"]
+    judged = any("llm_as_judge_corrects" in result for result in results)
+    if judged:
+        header.append("judge correct rate")
+    rows = []
+    for result in results:
+        total = result["total"]
+        rows.append([
+            MODELS[result["model"]].short_name.replace("\n", " "),
+            result["variant"], result["data"], result["level"], str(total),
+            f"{result['attempted'] / total:.2%}" if total > 0 else "-",
+            f"{result['correct_attempted'] / total:.2%}" if total > 0 else "-",
+        ])
+        if judged:
+            rows[-1].append(f"{result['llm_as_judge_corrects'] / total:.2%}" if total > 0 else "-")
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    for row in [header, ["-" * width for width in widths]] + rows:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+
+def run_all(args):
+    runs = find_runs(args.output_dir, args.data_dir)
+    if not runs:
+        print(f"No output files found under {args.output_dir}")
+        return
+    # Runs on the same data file go to the same worker where possible, so each worker reads it once
+    runs.sort(key=lambda run: (run["data_path"], run["model"], run["variant"], run["level"]))
+    if args.num_workers > 1:
+        with ProcessPoolExecutor(max_workers=args.num_workers) as executor:
+            results = list(executor.map(score_run, runs, [args] * len(runs), chunksize=max(1, len(runs) // (4 * args.num_workers))))
+    else:
+        results = [score_run(run, args) for run in runs]
+    if args.judge:
+        judge_results(results, get_judge(args), args)
+    results.sort(key=lambda result: (result["model"], result["variant"], result["data"], result["level"]))
+    print_table(results)
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["model", "variant", "data", "level", "total", "attempted", "correct_attempted", "failed", "llm_as_judge_corrects", "judge_failed"], extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(results)
+        print(f"Table saved to {args.csv}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Get tool call rate.")
+    parser.add_argument("--data", type=str, default="final_2_elapse_2", help="data name")
+    parser.add_argument("--model", type=str, default="meta-llama/Llama-3.1-8B-Instruct", help="Model code (will be mapped to handler).")
+    parser.add_argument("--time_elapsed_level", type=int, default=0, choices=[0, 1, 2], help="Time elapsed level for adding time stamp to each message. 0: small change, 1: medium change, 2: large change.")
+    parser.add_argument("--use_time_stamp", action="store_true", help="Whether to use time stamp in the prompt.")
+    parser.add_argument("--print_logs", action="store_true", help="Print logs for debugging/seeing the problem with the model.")
+    parser.add_argument("--output_dir", type=str, default="outputs3", help="Directory containing the output files.")
+    parser.add_argument("--all_runs", action="store_true", help="Score every output file under --output_dir and print one model x data x elapse level table.")
+    parser.add_argument("--data_dir", type=str, default="data", help="Directory containing the data files (--all_runs).")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help="Number of processes to score output files with (--all_runs).")
+    parser.add_argument("--csv", type=str, default=None, help="Also save the table as CSV (--all_runs).")
+    parser.add_argument("--judge", action="store_true", help="Also judge the structurally correct tool calls with an LLM.")
+    parser.add_argument("--judge_model", type=str, default="gpt-4o", help="Judge model.")
+    parser.add_argument("--judge_base_url", type=str, default=None, help="Base URL of an OpenAI-compatible judge endpoint, e.g. a local vllm server at http://localhost:8000/v1.")
+    parser.add_argument("--judge_cache", type=str, default="cache/judge.db", help="SQLite cache of judge verdicts; pass an empty string to disable.")
+    parser.add_argument("--judge_requests_per_minute", type=float, default=None, help="Judge request rate limit.")
+    parser.add_argument("--judge_max_concurrency", type=int, default=None, help="Upper bound for the number of concurrent judge requests.")
+    args = parser.parse_args()
+    if args.all_runs:
+        run_all(args)
+        raise SystemExit
+    if args.model not in MODELS:
+        raise ValueError(f"Unknown model code: {args.model}")
+    print()
+    if args.use_time_stamp:
+        output_file = f"{args.model.split('/')[-1]}-{get_data_name(args.data)}-{args.time_elapsed_level}.json"
+    else:
+        output_file = f"{args.model.split('/')[-1]}-{get_data_name(args.data)}-notime.json"
+    
+    # load the json file
+    with open(os.path.join(args.output_dir, args.model.split('/')[-1], output_file), "r") as f:
+        output_data = json.load(f)
+    # Only the input samples that have an output are parsed
+    input_data = load_data(resolve_data_path(args.data), ids={output_d["id"] for output_d in output_data})
+    input_by_id = {input_d["id"]: input_d for input_d in input_data}
+    if args.use_time_stamp:
+        print(f"Processing {args.model} on {args.data} with time elapsed level {args.time_elapsed_level}")
+    else:
+        print(f"Processing {args.model} on {args.data} without time elapsed")
+    counts = score_outputs(output_data, input_by_id, args.model, args)
+    if args.judge:
+        judge_results([counts], get_judge(args), args)
+    total = counts["total"]
+    attempted = counts["attempted"]
+    correct_attempted = counts["correct_attempted"]
     attempt_rate = attempted / total if total > 0 else 0
     correct_attempt_rate = correct_attempted / total if total > 0 else 0
-    llm_as_judge_corrects_rate = llm_as_judge_corrects / total if total > 0 else 0
     print(f"Total samples (excluding failed): {total}")
     print(f"Attempted tool calls: {attempted} out of {total}")
     print(f"Attempt rate: {attempt_rate:.4%}")
     print("------------")
     print(f"Correct Attempted tool calls: {correct_attempted} out of {total}")
     print(f"Correct Attempt rate: {correct_attempt_rate:.4%}")
-    # print("------------")
-    # print(f"Correct LLM as Judge tool calls: {llm_as_judge_corrects} out of {total}")
-    # print(f"Correct LLM as Judge rate: {llm_as_judge_corrects_rate:.4%}")
\ No newline at end of file
+    if args.judge:
+        llm_as_judge_corrects = counts["llm_as_judge_corrects"]
+        llm_as_judge_corrects_rate = llm_as_judge_corrects / total if total > 0 else 0
+        print("------------")
+        print(f"Correct LLM as Judge tool calls: {llm_as_judge_corrects} out of {total}")
+        print(f"Correct LLM as Judge rate: {llm_as_judge_corrects_rate:.4%}")
+        if counts["judge_failed"]:
+            print(f"Judge failed on {counts['judge_failed']} tool calls")
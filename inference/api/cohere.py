@@ -1,73 +1,50 @@
 import os
-from inference.model_handler import Base_Handler
-import cohere
-from inference.sys_pmts import *
+from inference.model_handler import API_Handler
+from inference.normalize import normalize_history, get_sys_prompt_mode
+from inference.tool_parsers import api_record, make_usage
 
-class Cohere_Handler(Base_Handler):
-    def __init__(self, model_name="command-r"):  # Default to Cohere's Command R model
-        super().__init__(model_name)
+class Cohere_Handler(API_Handler):
+    requests_per_minute = 500
+
+    def __init__(self, model_name="command-r", engine_config=None, base_url=None):  # Default to Cohere's Command R model
+        super().__init__(model_name, engine_config=engine_config)
         self.api_key = os.environ.get("COHERE_API_KEY")
         if not self.api_key:
             raise ValueError("COHERE_API_KEY environment variable not set.")
-        self.client = cohere.ClientV2(self.api_key)
         self.model = model_name
+        self.base_url = base_url
+
+    def create_client(self):
+        import cohere
+        return cohere.AsyncClientV2(api_key=self.api_key, **({"base_url": self.base_url} if self.base_url else {}))
 
     def format_input(self, history, tools=None, tools_in_user_message=True, date_string=None, add_generation_prompt=False, time_elapsed_level=0, use_time_stamp=False, use_special_sys_prompt_naive=False, use_special_sys_prompt_rule=False):
         """
         Format the input for Cohere chat models. Converts history to Cohere's message format and attaches tools if provided.
         Args:
-            history: List of message dicts (role/content/tool_calls/etc)
+            history: List of message dicts (role/content/tool_calls/etc) or a Normalized_History
             tools: List of tool/function definitions (if supported)
         Returns:
             Dict with 'chat_history' and optionally 'tools' for Cohere API
         """
-        chat_history = []
-        for msg in history:
-            entry = {"role": msg["role"]}
-            time_string = msg['time'] if type(msg['time']) is str else msg['time'][time_elapsed_level]
-            if msg.get("content") is not None and "tool_calls" not in msg:
-                entry["content"] = f"[{time_string}] " + msg["content"] if use_time_stamp else msg["content"]
-                if entry["role"] == "system" and use_special_sys_prompt_naive:
-                    entry["content"] = entry["content"] + NAIVE
-                elif entry["role"] == "system" and use_special_sys_prompt_rule:
-                    entry["content"] = entry["content"] + RULE
-            if "tool_calls" in msg:
-                entry["tool_calls"] = msg["tool_calls"]
-            if msg["role"] == "tool" and "tool_call_id" in msg:
-                entry["tool_call_id"] = msg["tool_call_id"]
-            chat_history.append(entry)
+        history = normalize_history(history)
+        chat_history = history.messages(time_elapsed_level, use_time_stamp, get_sys_prompt_mode(use_special_sys_prompt_naive, use_special_sys_prompt_rule))
         cohere_tools = tools if tools is not None else None
         return {"chat_history": chat_history, "tools": cohere_tools} if cohere_tools else {"chat_history": chat_history}
 
-    def run_inference(self, formatted_inputs):
-        """
-        Run batch inference using Cohere chat completions API in parallel (multithreaded).
-        Args:
-            formatted_inputs: List of dicts as returned by format_input
-        Returns:
-            List of output strings (assistant responses)
-        """
-        import concurrent.futures
-
-        def infer_one(formatted):
-            try:
-                response = self.client.chat(
-                    model=self.model,
-                    messages=formatted["chat_history"],
-                    tools=formatted.get("tools", None),
-                    tool_choice="auto"
-                )
-                response_msg = response.message if hasattr(response, "message") else None
-                if hasattr(response_msg, "content") and response_msg.content is not None:
-                    return response_msg.content[0].text
-                elif hasattr(response_msg, "tool_calls") and response_msg.tool_calls is not None:
-                    return str(response_msg.tool_calls)
-                else:
-                    return "[ERROR]"
-            except Exception as e:
-                print(f"Error during inference for sample: {formatted}\nException: {e}")
-                return f"[ERROR]: {e}"
-
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            results = list(executor.map(infer_one, formatted_inputs))
-        return results
+    async def infer_one(self, formatted):
+        response = await self.client.chat(
+            model=self.model,
+            messages=formatted["chat_history"],
+            tools=formatted.get("tools", None),
+            tool_choice=self.tool_choice,
+            **({"max_tokens": self.max_tokens} if self.max_tokens is not None else {}),
+            # Retries are handled by the engine so that they share its rate limits and backoff
+            request_options={"max_retries": 0}
+        )
+        response_msg = response.message if hasattr(response, "message") else None
+        text = response_msg.content[0].text if getattr(response_msg, "content", None) else None
+        tool_calls = [(tool_call.function.name, tool_call.function.arguments) for tool_call in getattr(response_msg, "tool_calls", None) or []]
+        tokens = getattr(getattr(response, "usage", None), "tokens", None)
+        usage = make_usage(tokens.input_tokens, tokens.output_tokens) if tokens is not None else None
+        return api_record(text, tool_calls, getattr(response, "finish_reason", None), usage)
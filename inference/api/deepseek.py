@@ -1,40 +1,34 @@
 import os
-from inference.model_handler import Base_Handler
-import openai
-from inference.sys_pmts import *
+from inference.model_handler import API_Handler
+from inference.normalize import normalize_history, get_sys_prompt_mode
+from inference.tool_parsers import openai_record
 
-class DeepSeek_Handler(Base_Handler):
-    def __init__(self, model_name="deepseek-chat"):
-        super().__init__(model_name)
+class DeepSeek_Handler(API_Handler):
+    base_url = "https://api.deepseek.com"
+
+    def __init__(self, model_name="deepseek-chat", engine_config=None, base_url=None):
+        super().__init__(model_name, engine_config=engine_config)
         self.api_key = os.environ.get("DEEPSEEK_API_KEY")
-        self.client = openai.OpenAI(api_key=self.api_key, base_url="https://api.deepseek.com")
         self.model = model_name
+        if base_url is not None:
+            self.base_url = base_url
+
+    def create_client(self):
+        import openai
+        # Retries are handled by the engine so that they share its rate limits and backoff
+        return openai.AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=0)
 
     def format_input(self, history, tools=None, tools_in_user_message=True, date_string=None, add_generation_prompt=False, time_elapsed_level=0, use_time_stamp=False, use_special_sys_prompt_naive=False, use_special_sys_prompt_rule=False):
         """
         Format the input for OpenAI chat models. Converts history to OpenAI's message format and attaches tools if provided.
         Args:
-            history: List of message dicts (role/content/tool_calls/etc)
+            history: List of message dicts (role/content/tool_calls/etc) or a Normalized_History
             tools: List of tool/function definitions (from the 'function' field in data)
         Returns:
             Dict with 'messages' and optionally 'tools' for OpenAI API
         """
-        messages = []
-        for msg in history:
-            m = {"role": msg["role"]}
-            time_string = msg['time'] if type(msg['time']) is str else msg['time'][time_elapsed_level]
-            if msg.get("content") is not None and "tool_calls" not in msg:
-                m["content"] = f"[{time_string}] " + msg["content"] if use_time_stamp else msg["content"]
-                if m["role"] == "system" and use_special_sys_prompt_naive:
-                    m["content"] = m["content"] + NAIVE
-                elif m["role"] == "system" and use_special_sys_prompt_rule:
-                    m["content"] = m["content"] + RULE
-            if "tool_calls" in msg:
-                m["tool_calls"] = msg["tool_calls"]
-            # Ensure tool messages have tool_call_id (required by OpenAI API)
-            if msg["role"] == "tool" and "tool_call_id" in msg:
-                m["tool_call_id"] = msg["tool_call_id"]
-            messages.append(m)
+        history = normalize_history(history)
+        messages = history.messages(time_elapsed_level, use_time_stamp, get_sys_prompt_mode(use_special_sys_prompt_naive, use_special_sys_prompt_rule))
         # OpenAI expects tools as a list of function dicts
         openai_tools = None
         if tools is not None:
@@ -42,38 +36,16 @@ class DeepSeek_Handler(Base_Handler):
             openai_tools = tools
         return {"messages": messages, "tools": openai_tools} if openai_tools else {"messages": messages}
 
-    def run_inference(self, formatted_inputs):
-        """
-        Run batch inference using OpenAI chat completions API in parallel.
-        Args:
-            formatted_inputs: List of dicts as returned by format_input
-        Returns:
-            List of output strings (assistant responses)
-        """
-        import concurrent.futures
-        print(f"Running with model: {self.model}")
-        def infer_one(formatted):
-            try:
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=formatted["messages"],
-                    tools=formatted.get("tools", None),
-                    tool_choice="auto"
-                )
-                choice = response.choices[0].message
-                # breakpoint()
-                # if "Please reserve a Luxury Suite for Sherlock Holmes there." in formatted["messages"][-1]["content"]:
-                #     breakpoint()
-                if hasattr(choice, "content") and choice.content is not None and choice.content != "":
-                    return choice.content
-                elif hasattr(choice, "tool_calls") and choice.tool_calls is not None:
-                    return str(choice.tool_calls)
-                else:
-                    return "[ERROR]"
-            except Exception as e:
-                print(f"Error during inference for sample: {formatted}\nException: {e}")
-                return f"[ERROR]: {e}"
+    async def infer_one(self, formatted):
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=formatted["messages"],
+            tools=formatted.get("tools", None),
+            tool_choice=self.tool_choice,
+            **({"max_tokens": self.max_tokens} if self.max_tokens is not None else {})
+        )
+        return openai_record(response.choices[0], response.usage)
 
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            results = list(executor.map(infer_one, formatted_inputs))
-        return results
+    def _run_inference(self, formatted_inputs, on_result=None):
+        print(f"Running with model: {self.model}")
+        return super()._run_inference(formatted_inputs, on_result=on_result)
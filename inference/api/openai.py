@@ -1,40 +1,39 @@
 import os
-from inference.model_handler import Base_Handler
-import openai
-from inference.sys_pmts import *
+import json
+import time
+from inference.model_handler import API_Handler
+from inference.normalize import normalize_history, get_sys_prompt_mode
+from inference.tool_parsers import openai_record, error_record
 
-class OpenAI_Handler(Base_Handler):
-    def __init__(self, model_name="gpt-4o"):
-        super().__init__(model_name)
+class OpenAI_Handler(API_Handler):
+    requests_per_minute = 500
+    tokens_per_minute = 200000
+
+    def __init__(self, model_name="gpt-4o", engine_config=None, base_url=None, use_batch=False, batch_dir="batches", poll_interval=30):
+        super().__init__(model_name, engine_config=engine_config)
         self.api_key = os.environ.get("OPENAI_API_KEY")
-        self.client = openai.OpenAI(api_key=self.api_key)
         self.model = model_name
+        self.base_url = base_url
+        self.use_batch = use_batch
+        self.batch_dir = batch_dir
+        self.poll_interval = poll_interval
+
+    def create_client(self):
+        import openai
+        # Retries are handled by the engine so that they share its rate limits and backoff
+        return openai.AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=0)
 
     def format_input(self, history, tools=None, tools_in_user_message=True, date_string=None, add_generation_prompt=False, time_elapsed_level=0, use_time_stamp=False, use_special_sys_prompt_naive=False, use_special_sys_prompt_rule=False):
         """
         Format the input for OpenAI chat models. Converts history to OpenAI's message format and attaches tools if provided.
         Args:
-            history: List of message dicts (role/content/tool_calls/etc)
+            history: List of message dicts (role/content/tool_calls/etc) or a Normalized_History
             tools: List of tool/function definitions (from the 'function' field in data)
         Returns:
             Dict with 'messages' and optionally 'tools' for OpenAI API
         """
-        messages = []
-        for msg in history:
-            m = {"role": msg["role"]}
-            time_string = msg['time'] if type(msg['time']) is str else msg['time'][time_elapsed_level]
-            if msg.get("content") is not None and "tool_calls" not in msg:
-                m["content"] = f"[{time_string}] " + msg["content"] if use_time_stamp else msg["content"]
-                if m["role"] == "system" and use_special_sys_prompt_naive:
-                    m["content"] = m["content"] + NAIVE
-                elif m["role"] == "system" and use_special_sys_prompt_rule:
-                    m["content"] = m["content"] + RULE
-            if "tool_calls" in msg:
-                m["tool_calls"] = msg["tool_calls"]
-            # Ensure tool messages have tool_call_id (required by OpenAI API)
-            if msg["role"] == "tool" and "tool_call_id" in msg:
-                m["tool_call_id"] = msg["tool_call_id"]
-            messages.append(m)
+        history = normalize_history(history)
+        messages = history.messages(time_elapsed_level, use_time_stamp, get_sys_prompt_mode(use_special_sys_prompt_naive, use_special_sys_prompt_rule))
         # OpenAI expects tools as a list of function dicts
         openai_tools = None
         if tools is not None:
@@ -42,35 +41,74 @@ class OpenAI_Handler(Base_Handler):
             openai_tools = tools
         return {"messages": messages, "tools": openai_tools} if openai_tools else {"messages": messages}
 
-    def run_inference(self, formatted_inputs):
+    async def infer_one(self, formatted):
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=formatted["messages"],
+            tools=formatted.get("tools", None),
+            tool_choice=self.tool_choice,
+            **({"max_completion_tokens": self.max_tokens} if self.max_tokens is not None else {})
+        )
+        return openai_record(response.choices[0], response.usage)
+
+    def _run_inference(self, formatted_inputs, on_result=None):
+        if self.use_batch:
+            return self.run_batch_inference(formatted_inputs, on_result=on_result)
+        return super()._run_inference(formatted_inputs, on_result=on_result)
+
+    def run_batch_inference(self, formatted_inputs, on_result=None):
         """
-        Run batch inference using OpenAI chat completions API in parallel.
+        Run inference through the OpenAI Batch API: write the requests to a batch JSONL file,
+        upload it, create the batch, poll until it ends, then download the results and map them
+        back to the inputs by custom_id.
         Args:
             formatted_inputs: List of dicts as returned by format_input
+            on_result: Optional callback on_result(index, output), called once the results are downloaded
         Returns:
-            List of output strings (assistant responses)
+            List of output records, with an error record for failed requests
         """
-        import concurrent.futures
+        import openai
+        from openai.types.chat import ChatCompletion
+        client = openai.OpenAI(api_key=self.api_key, base_url=self.base_url)
+        if not os.path.exists(self.batch_dir):
+            os.makedirs(self.batch_dir)
+        batch_path = os.path.join(self.batch_dir, f"{self.model}-{int(time.time())}.jsonl")
+        with open(batch_path, "w") as f:
+            for i, formatted in enumerate(formatted_inputs):
+                body = {"model": self.model, "messages": formatted["messages"]}
+                if formatted.get("tools"):
+                    body["tools"] = formatted["tools"]
+                    body["tool_choice"] = self.tool_choice
+                if self.max_tokens is not None:
+                    body["max_completion_tokens"] = self.max_tokens
+                f.write(json.dumps({"custom_id": f"request-{i}", "method": "POST", "url": "/v1/chat/completions", "body": body}) + "\n")
+        with open(batch_path, "rb") as f:
+            input_file = client.files.create(file=f, purpose="batch")
+        batch = client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+        print(f"Submitted batch {batch.id} with {len(formatted_inputs)} requests ({batch_path})")
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(self.poll_interval)
+            batch = client.batches.retrieve(batch.id)
+            counts = batch.request_counts
+            print(f"Batch {batch.id}: {batch.status}" + (f" ({counts.completed}/{counts.total} completed, {counts.failed} failed)" if counts else ""))
 
-        def infer_one(formatted):
-            try:
-                response = self.client.chat.completions.create(
-                    model=self.model,
-                    messages=formatted["messages"],
-                    tools=formatted.get("tools", None),
-                    tool_choice="auto"
-                )
-                choice = response.choices[0].message
-                if hasattr(choice, "content") and choice.content is not None and choice.content != "":
-                    return choice.content
-                elif hasattr(choice, "tool_calls") and choice.tool_calls is not None:
-                    return str(choice.tool_calls)
+        outputs = [error_record(f"batch {batch.id} {batch.status}") for _ in formatted_inputs]
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            for line in client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                i = int(record["custom_id"].split("-")[-1])
+                response = record.get("response") or {}
+                if record.get("error") or response.get("status_code") != 200:
+                    error = record.get("error") or response.get("body", {}).get("error")
+                    outputs[i] = error_record(error)
                 else:
-                    return "[ERROR]"
-            except Exception as e:
-                print(f"Error during inference for sample: {formatted}\nException: {e}")
-                return f"[ERROR]: {e}"
-
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            results = list(executor.map(infer_one, formatted_inputs))
-        return results
+                    completion = ChatCompletion.model_validate(response["body"])
+                    outputs[i] = openai_record(completion.choices[0], completion.usage)
+        if on_result is not None:
+            for i, output in enumerate(outputs):
+                on_result(i, output)
+        return outputs
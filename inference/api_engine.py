@@ -0,0 +1,325 @@
+import asyncio
+import bisect
+import email.utils
+import json
+import random
+import time
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+def get_status_code(e):
+    """HTTP status code of an SDK exception (openai and cohere both expose status_code), or None."""
+    status = getattr(e, "status_code", None)
+    if status is None and getattr(e, "response", None) is not None:
+        status = getattr(e.response, "status_code", None)
+    return status
+
+
+def get_retry_after(e):
+    """Seconds the provider asked us to wait before retrying, from the Retry-After headers, or None."""
+    headers = getattr(e, "headers", None)
+    if headers is None and getattr(e, "response", None) is not None:
+        headers = getattr(e.response, "headers", None)
+    if not headers:
+        return None
+    headers = {k.lower(): v for k, v in dict(headers).items()}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            value = headers["retry-after"]
+            try:
+                return float(value)
+            except ValueError:
+                return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def is_retryable(e):
+    """Throttling, server errors, timeouts and dropped connections are retried; anything else is final."""
+    status = get_status_code(e)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    if isinstance(e, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    name = type(e).__name__
+    return "Timeout" in name or "Connection" in name
+
+
+def estimate_tokens(payload):
+    """Rough prompt token count of a request payload, used for the tokens/minute bucket."""
+    return len(json.dumps(payload, default=str)) // 4
+
+
+class Token_Bucket:
+    """
+    Token bucket refilled at rate_per_minute, holding at most ten seconds of refill.
+    Requests larger than the bucket are let through once it is full.
+    """
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = max(1.0, rate_per_minute / 6.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def try_acquire(self, amount=1):
+        """Take amount tokens only if they are available right now (and nobody is waiting for them)."""
+        amount = min(amount, self.capacity)
+        if self.lock.locked():
+            return False
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+
+class AIMD_Limiter:
+    """
+    Concurrency limit that grows by one request per round trip while requests succeed, and is cut
+    multiplicatively on a 429 or when latency climbs well above its running average.
+    At most one cut is applied per average round trip, so a burst of 429s counts once.
+    """
+    def __init__(self, initial, maximum, minimum=1, decrease_factor=0.5, latency_factor=3.0):
+        self.limit = float(min(initial, maximum))
+        self.maximum = maximum
+        self.minimum = minimum
+        self.decrease_factor = decrease_factor
+        self.latency_factor = latency_factor
+        self.latency_ewma = None
+        self.last_decrease = 0.0
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, latency=None, throttled=False):
+        async with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self._decrease(self.decrease_factor)
+            elif latency is not None:
+                if self.latency_ewma is not None and latency > self.latency_factor * self.latency_ewma:
+                    self._decrease(0.9)
+                else:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self.latency_ewma = latency if self.latency_ewma is None else 0.9 * self.latency_ewma + 0.1 * latency
+            self.condition.notify_all()
+
+    def _decrease(self, factor):
+        now = time.monotonic()
+        if now - self.last_decrease < (self.latency_ewma or 1.0):
+            return
+        self.limit = max(self.minimum, self.limit * factor)
+        self.last_decrease = now
+
+
+class API_Engine:
+    """
+    Runs one async request per payload under request/minute and token/minute limits, with
+    AIMD concurrency control, jittered exponential backoff that honors Retry-After, and an
+    optional deadline for the whole run. When trace is set (an inference.telemetry.Telemetry_Trace),
+    every request's timings, retries, usage and error type are recorded to it.
+    With hedge_percentile set, a request still running after that percentile of the latencies
+    seen so far in the run (once hedge_min_samples requests have succeeded) is sent a second
+    time; the first successful response wins and the other request is cancelled. Hedges are
+    limited to hedge_budget of the requests sent and are only sent when the rate limits have
+    room for them right away.
+    """
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_concurrency=64, initial_concurrency=8,
+                 max_retries=6, backoff_base=1.0, backoff_max=60.0, deadline=None,
+                 hedge_percentile=None, hedge_budget=0.05, hedge_min_samples=20):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.initial_concurrency = initial_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.deadline = deadline
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = hedge_budget
+        self.hedge_min_samples = hedge_min_samples
+        self.trace = None
+
+    def run(self, call, payloads, setup=None, on_result=None):
+        """
+        Args:
+            call: Coroutine function taking one payload and returning the output string
+            payloads: List of request payloads
+            setup: Optional function called inside the event loop before the first request (e.g. to build async clients)
+            on_result: Optional callback on_result(index, output), called as each request finishes
+        Returns:
+            List of outputs aligned with payloads, "[ERROR]: ..." for requests that failed
+        """
+        return asyncio.run(self.run_async(call, payloads, setup=setup, on_result=on_result))
+
+    async def run_async(self, call, payloads, setup=None, on_result=None):
+        if setup is not None:
+            setup()
+        self.limiter = AIMD_Limiter(self.initial_concurrency, self.max_concurrency)
+        self.request_bucket = Token_Bucket(self.requests_per_minute) if self.requests_per_minute else None
+        self.token_bucket = Token_Bucket(self.tokens_per_minute) if self.tokens_per_minute else None
+        self.deadline_at = time.monotonic() + self.deadline if self.deadline else None
+        # Sorted latencies of successful calls, for the hedging threshold
+        self.latencies = []
+        self.hedge_stats = {"calls": 0, "hedged": 0, "hedge_wins": 0, "no_budget": 0, "rate_limited": 0}
+        tasks = [asyncio.create_task(self._run_indexed(i, call, payload, on_result)) for i, payload in enumerate(payloads)]
+        results = await asyncio.gather(*tasks)
+        if self.hedge_percentile is not None:
+            stats = self.hedge_stats
+            print(f"Hedging: {stats['hedged']} of {stats['calls']} calls hedged after p{self.hedge_percentile:g} latency, hedge won {stats['hedge_wins']}; "
+                  f"{stats['no_budget']} not hedged for budget, {stats['rate_limited']} for rate limits")
+        return results
+
+    async def _run_indexed(self, index, call, payload, on_result):
+        info = {"queue_wait": 0.0, "latency": None, "backoff": 0.0, "retries": 0, "attempt_errors": [], "error_type": None, "hedged": False, "hedge_won": False}
+        start = time.time()
+        result = await self._run_one(index, call, payload, info)
+        if self.trace is not None:
+            self.trace.record(index, start, time.time(), result, **info)
+        if on_result is not None:
+            on_result(index, result)
+        return result
+
+    def _remaining(self):
+        if self.deadline_at is None:
+            return None
+        return self.deadline_at - time.monotonic()
+
+    async def _acquire(self, num_tokens):
+        if self.request_bucket is not None:
+            await self.request_bucket.acquire(1)
+        if self.token_bucket is not None:
+            await self.token_bucket.acquire(num_tokens)
+        await self.limiter.acquire()
+
+    def _hedge_delay(self):
+        """Seconds after which a running call is hedged, or None while hedging is off or still learning."""
+        if self.hedge_percentile is None or len(self.latencies) < self.hedge_min_samples:
+            return None
+        from inference.forecast import percentile
+        return percentile(self.latencies, self.hedge_percentile)
+
+    def _take_hedge(self, num_tokens):
+        """Whether the hedging budget and the rate limits allow one more hedge now (and take it)."""
+        if self.hedge_stats["hedged"] + 1 > self.hedge_budget * self.hedge_stats["calls"]:
+            self.hedge_stats["no_budget"] += 1
+            return False
+        if (self.request_bucket is not None and not self.request_bucket.try_acquire(1)) or (self.token_bucket is not None and not self.token_bucket.try_acquire(num_tokens)):
+            self.hedge_stats["rate_limited"] += 1
+            return False
+        self.hedge_stats["hedged"] += 1
+        return True
+
+    async def _call(self, call, payload, num_tokens, info):
+        """
+        One attempt at a request, hedged with an identical second request if it runs longer than
+        the hedging threshold. The first successful response is returned and the other request
+        cancelled; if both fail, the first failure is raised.
+        """
+        self.hedge_stats["calls"] += 1
+        delay = self._hedge_delay()
+        if delay is None:
+            return await call(payload)
+        primary = asyncio.ensure_future(call(payload))
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if done or not self._take_hedge(num_tokens):
+                return await primary
+            info["hedged"] = True
+            tasks.append(asyncio.ensure_future(call(payload)))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            info["hedge_won"] = True
+                            self.hedge_stats["hedge_wins"] += 1
+                        return task.result()
+            raise primary.exception()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def _backoff(self, attempt, e):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        retry_after = get_retry_after(e)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    async def _run_one(self, index, call, payload, info):
+        """Send one request with retries; info collects its telemetry (see Telemetry_Trace.record)."""
+        from inference.telemetry import classify_error
+        num_tokens = estimate_tokens(payload)
+        attempt = 0
+        while True:
+            remaining = self._remaining()
+            if remaining is not None and remaining <= 0:
+                info["error_type"] = "deadline"
+                return "[ERROR]: deadline exceeded"
+            queued = time.monotonic()
+            try:
+                await asyncio.wait_for(self._acquire(num_tokens), remaining)
+            except asyncio.TimeoutError:
+                info["queue_wait"] += time.monotonic() - queued
+                info["error_type"] = "deadline"
+                return "[ERROR]: deadline exceeded"
+            start = time.monotonic()
+            info["queue_wait"] += start - queued
+            try:
+                result = await asyncio.wait_for(self._call(call, payload, num_tokens, info), self._remaining())
+            except Exception as e:
+                info["latency"] = time.monotonic() - start
+                error_type = classify_error(e)
+                info["attempt_errors"].append(error_type)
+                throttled = get_status_code(e) == 429
+                await self.limiter.release(throttled=throttled)
+                remaining = self._remaining()
+                if isinstance(e, asyncio.TimeoutError) and remaining is not None and remaining <= 0:
+                    info["error_type"] = "deadline"
+                    return "[ERROR]: deadline exceeded"
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    info["error_type"] = error_type
+                    # The payload is left out: prompts are kilobytes long and the index is enough to find it
+                    message = str(e) if len(str(e)) <= 300 else str(e)[:300] + "..."
+                    print(f"Request {index} failed ({error_type}) after {attempt + 1} attempts: {type(e).__name__}: {message}")
+                    return f"[ERROR]: {e}"
+                delay = self._backoff(attempt, e)
+                if remaining is not None and delay >= remaining:
+                    info["error_type"] = "deadline"
+                    return f"[ERROR]: deadline exceeded after {attempt + 1} attempts: {e}"
+                await asyncio.sleep(delay)
+                info["backoff"] += delay
+                attempt += 1
+                info["retries"] = attempt
+                continue
+            info["latency"] = time.monotonic() - start
+            bisect.insort(self.latencies, info["latency"])
+            await self.limiter.release(latency=info["latency"])
+            return result
@@ -0,0 +1,447 @@
+import hashlib
+import math
+import os
+import re
+import time
+import weakref
+from abc import ABC, abstractmethod
+from types import SimpleNamespace
+
+
+class Local_Engine(ABC):
+    """
+    Generation backend of the local handlers. Engines follow the subset of the vllm.LLM
+    interface the handlers use, so a vllm RequestOutput and a fake one look the same to them.
+    """
+    name = None
+
+    @classmethod
+    @abstractmethod
+    def from_handler(cls, handler, **config):
+        """Build the engine for a Local_Handler (model path, prefix caching, tool parser, ...)."""
+        pass
+
+    @abstractmethod
+    def make_sampling_params(self, temperature=0.0, max_tokens=16, logprobs=None):
+        """Sampling parameters object accepted by generate."""
+        pass
+
+    @abstractmethod
+    def generate(self, prompts, sampling_params):
+        """
+        Args:
+            prompts: List of prompt strings or {"prompt_token_ids": [...]} dicts
+            sampling_params: One sampling params object, or a list aligned with prompts
+        Returns:
+            List of request outputs (prompt_token_ids, num_cached_tokens, outputs[0].text/token_ids/finish_reason/logprobs)
+        """
+        pass
+
+    def generate_stream(self, prompts, sampling_params, chunk_size):
+        """
+        Generate in chunks of chunk_size prompts, yielding the outputs of each chunk as soon as it is done.
+        Yields:
+            (list of positions in prompts, list of request outputs aligned with them)
+        """
+        for start in range(0, len(prompts), chunk_size):
+            positions = list(range(start, min(start + chunk_size, len(prompts))))
+            params = sampling_params[start:start + chunk_size] if isinstance(sampling_params, list) else sampling_params
+            yield positions, self.generate([prompts[p] for p in positions], params)
+
+    @abstractmethod
+    def get_tokenizer(self):
+        pass
+
+    @classmethod
+    def load_tokenizer(cls, model_path):
+        """The engine's tokenizer for a model without starting the engine, for dry runs."""
+        from transformers import AutoTokenizer
+        return AutoTokenizer.from_pretrained(model_path)
+
+    @classmethod
+    def visible_devices(cls):
+        """Ids of the GPUs the engine would run on, or None for engines that do not use GPUs."""
+        return None
+
+
+class VLLM_Engine(Local_Engine):
+    """vllm offline engine over all visible GPUs (tensor parallel)."""
+    name = "vllm"
+
+    def __init__(self, model_path, enable_prefix_caching=False):
+        from vllm import LLM
+        import torch
+        self.llm = LLM(model=model_path, tensor_parallel_size=torch.cuda.device_count(), enable_prefix_caching=enable_prefix_caching)
+
+    @classmethod
+    def from_handler(cls, handler, **config):
+        return cls(handler.model_path, enable_prefix_caching=handler.enable_prefix_caching, **config)
+
+    def make_sampling_params(self, temperature=0.0, max_tokens=16, logprobs=None):
+        from vllm import SamplingParams
+        return SamplingParams(temperature=temperature, max_tokens=max_tokens, logprobs=logprobs)
+
+    def generate(self, prompts, sampling_params):
+        return self.llm.generate(prompts, sampling_params)
+
+    def get_tokenizer(self):
+        return self.llm.get_tokenizer()
+
+    @classmethod
+    def visible_devices(cls):
+        if os.environ.get("CUDA_VISIBLE_DEVICES") is not None:
+            return [device for device in os.environ["CUDA_VISIBLE_DEVICES"].split(",") if device.strip()]
+        import torch
+        return [str(i) for i in range(torch.cuda.device_count())]
+
+
+class Fake_Tokenizer:
+    """One token per character, with the code point as its id, so token ids mean the same in every process."""
+
+    def encode(self, text, add_special_tokens=False):
+        return [ord(c) for c in text]
+
+    def decode(self, token_ids, skip_special_tokens=True):
+        return "".join(chr(i) for i in token_ids)
+
+    def __call__(self, texts, add_special_tokens=False):
+        # Batch encoding, as with a Hugging Face tokenizer
+        return {"input_ids": [self.encode(text) for text in texts]}
+
+
+class Fake_Engine(Local_Engine):
+    """
+    Deterministic CPU stand-in for vllm, for running and profiling the pipeline without GPUs.
+    Each prompt gets a scripted answer chosen from a hash of the prompt: a tool call (in the
+    handler's native syntax, calling the first tool named in the prompt with empty arguments)
+    for a tool_call_rate share of prompts, and a text answer of text_tokens words otherwise.
+    Reasoning handlers get a short reasoning block first. Each generate call sleeps latency
+    seconds plus the generated tokens divided by tokens_per_second, when given.
+    """
+    name = "fake"
+
+    def __init__(self, tool_parser, reasons=False, tool_call_rate=0.5, text_tokens=64, latency=0.0, tokens_per_second=None):
+        self.tool_parser = tool_parser
+        self.reasons = reasons
+        self.tool_call_rate = tool_call_rate
+        self.text_tokens = text_tokens
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.tokenizer = Fake_Tokenizer()
+        # token ids of (prompt + generated so far) -> (script token ids, position) of requests cut at
+        # max_tokens, until they are continued
+        self.continuations = {}
+
+    @classmethod
+    def from_handler(cls, handler, **config):
+        return cls(handler.tool_parser, reasons=handler.reasons, **config)
+
+    def make_sampling_params(self, temperature=0.0, max_tokens=16, logprobs=None):
+        return SimpleNamespace(temperature=temperature, max_tokens=max_tokens, logprobs=logprobs)
+
+    def get_tokenizer(self):
+        return self.tokenizer
+
+    @classmethod
+    def load_tokenizer(cls, model_path):
+        return Fake_Tokenizer()
+
+    def script(self, prompt, tool_call):
+        from inference.tool_parsers import format_tool_call
+        if tool_call:
+            match = re.search(r'"name": ?"([^"]+)"', prompt) or re.search(r"<｜tool▁sep｜>(\S+)", prompt)
+            answer = format_tool_call(self.tool_parser, match.group(1) if match else "fake_tool", {})
+        else:
+            answer = " ".join(["This is a fake answer."] * math.ceil(self.text_tokens / 5)).split(" ")
+            answer = " ".join(answer[:self.text_tokens])
+        if self.reasons:
+            answer = "Fake reasoning.\n</think>\n\n" + answer
+        return answer
+
+    def decides_tool_call(self, prompt):
+        digest = hashlib.sha256(prompt.encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big") / 2 ** 64 < self.tool_call_rate
+
+    def generate(self, prompts, sampling_params):
+        if not isinstance(sampling_params, list):
+            sampling_params = [sampling_params] * len(prompts)
+        outputs = []
+        num_generated = 0
+        for prompt, params in zip(prompts, sampling_params):
+            if isinstance(prompt, dict):
+                prompt_token_ids = list(prompt["prompt_token_ids"])
+                continuation = self.continuations.pop(tuple(prompt_token_ids), None)
+                prompt = self.tokenizer.decode(prompt_token_ids)
+            else:
+                prompt_token_ids = self.tokenizer.encode(prompt)
+                continuation = None
+            if continuation is not None:
+                script_ids, position = continuation
+            else:
+                tool_call = self.decides_tool_call(prompt)
+                script_ids, position = self.tokenizer.encode(self.script(prompt, tool_call)), 0
+                alternative_ids = self.tokenizer.encode(self.script(prompt, not tool_call))
+            token_ids = script_ids[position:position + params.max_tokens]
+            finish_reason = "stop" if position + len(token_ids) >= len(script_ids) else "length"
+            if finish_reason == "length":
+                self.continuations[tuple(prompt_token_ids + token_ids)] = (script_ids, position + len(token_ids))
+            logprobs = None
+            if params.logprobs and continuation is None:
+                # The scripted first token gets 0.9 of the mass, the first token of the other answer the rest
+                logprobs = [{
+                    script_ids[0]: SimpleNamespace(logprob=math.log(0.9), rank=1, decoded_token=self.tokenizer.decode(script_ids[:1])),
+                    alternative_ids[0]: SimpleNamespace(logprob=math.log(0.1), rank=2, decoded_token=self.tokenizer.decode(alternative_ids[:1])),
+                }]
+            num_generated += len(token_ids)
+            completion = SimpleNamespace(text=self.tokenizer.decode(token_ids), token_ids=token_ids, finish_reason=finish_reason, logprobs=logprobs)
+            outputs.append(SimpleNamespace(prompt_token_ids=prompt_token_ids, num_cached_tokens=None, outputs=[completion]))
+        delay = self.latency + (num_generated / self.tokens_per_second if self.tokens_per_second else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+        return outputs
+
+
+ENGINES = {engine.name: engine for engine in (VLLM_Engine, Fake_Engine)}
+
+
+def portable_output(output):
+    """Copy of a request output with only the fields the handlers read, as plain picklable objects."""
+    completions = []
+    for completion in output.outputs:
+        logprobs = None
+        if completion.logprobs:
+            logprobs = [{token_id: SimpleNamespace(logprob=logprob.logprob, rank=logprob.rank, decoded_token=logprob.decoded_token) for token_id, logprob in step.items()}
+                        for step in completion.logprobs]
+        completions.append(SimpleNamespace(text=completion.text, token_ids=list(completion.token_ids), finish_reason=completion.finish_reason, logprobs=logprobs))
+    return SimpleNamespace(prompt_token_ids=list(output.prompt_token_ids or []), num_cached_tokens=getattr(output, "num_cached_tokens", None), outputs=completions)
+
+
+def _replica_main(conn, name, spec, config, devices):
+    """Worker process of a Data_Parallel_Engine: build one engine on its devices and serve generate calls until told to stop."""
+    if devices is not None:
+        # Set before the engine imports torch, so the replica only sees (and shards over) its own GPUs
+        os.environ["CUDA_VISIBLE_DEVICES"] = ",".join(devices)
+    try:
+        engine = ENGINES[name].from_handler(spec, **config)
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+        return
+    conn.send(("ready", None))
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+        prompts, sampling_params = request
+        try:
+            params = [engine.make_sampling_params(**vars(p)) for p in sampling_params]
+            conn.send(("ok", [portable_output(output) for output in engine.generate(prompts, params)]))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+def _shutdown_replicas(replicas):
+    for process, conn in replicas:
+        try:
+            conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+    for process, conn in replicas:
+        process.join(timeout=60)
+        if process.is_alive():
+            process.terminate()
+        conn.close()
+
+
+class Data_Parallel_Engine(Local_Engine):
+    """
+    Several replicas of an engine, each in its own worker process on its own subset of the
+    GPUs, with every generate call split between them. For small models one replica per GPU
+    (or per small group of GPUs) is much faster than tensor parallelism over all of them.
+    Each call is split into contiguous, length-balanced parts of the submitted order, so
+    prompts the handler grouped by shared prefix mostly stay on one replica's prefix cache,
+    and outputs are returned in input order. A continuation ({"prompt_token_ids"} of a prompt
+    plus tokens cut at max_tokens) goes back to the replica that generated those tokens.
+    generate_stream instead deals out contiguous chunks to whichever replica is free and
+    yields each chunk as it comes back, so fast replicas are not held up by slow ones.
+    """
+    name = "data_parallel"
+
+    def __init__(self, engine_name, spec, num_replicas, devices=None, **config):
+        import multiprocessing
+        context = multiprocessing.get_context("spawn")
+        self.engine_name = engine_name
+        self.model_path = spec.model_path
+        self.tokenizer = None
+        # hash of the token ids of (prompt + generated) -> replica, for requests cut at max_tokens until they are continued
+        self.routes = {}
+        self.replicas = []
+        for k in range(num_replicas):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=_replica_main, args=(child_conn, engine_name, spec, config, devices[k] if devices else None))
+            process.start()
+            child_conn.close()
+            self.replicas.append((process, parent_conn))
+        self._finalizer = weakref.finalize(self, _shutdown_replicas, self.replicas)
+        # Replicas load their models concurrently
+        errors = []
+        for k in range(num_replicas):
+            status, message = self._receive(k)
+            if status != "ready":
+                errors.append(f"replica {k}: {message}")
+        if errors:
+            self.close()
+            raise RuntimeError(f"Failed to start {engine_name} replicas: " + "; ".join(errors))
+
+    @classmethod
+    def from_handler(cls, handler, engine="vllm", num_replicas=2, devices=None, **config):
+        # Only what the engine reads from the handler is sent to the workers
+        spec = SimpleNamespace(model_path=handler.model_path, enable_prefix_caching=handler.enable_prefix_caching,
+                               tool_parser=handler.tool_parser, reasons=handler.reasons)
+        return cls(engine, spec, len(devices) if devices is not None else num_replicas, devices=devices, **config)
+
+    def _receive(self, k):
+        process, conn = self.replicas[k]
+        try:
+            return conn.recv()
+        except EOFError:
+            return "error", f"worker exited with code {process.exitcode}"
+
+    def close(self):
+        self._finalizer()
+
+    def make_sampling_params(self, temperature=0.0, max_tokens=16, logprobs=None):
+        # Built as the replica's own sampling params in the worker
+        return SimpleNamespace(temperature=temperature, max_tokens=max_tokens, logprobs=logprobs)
+
+    def get_tokenizer(self):
+        if self.tokenizer is None:
+            self.tokenizer = ENGINES[self.engine_name].load_tokenizer(self.model_path)
+        return self.tokenizer
+
+    def route(self, prompts):
+        """Replica each continuation came from (taking it out of routes), None for the other prompts."""
+        return [self.routes.pop(hash(tuple(prompt["prompt_token_ids"])), None) if isinstance(prompt, dict) else None for prompt in prompts]
+
+    def remember_routes(self, k, outputs):
+        for output in outputs:
+            if output.outputs and output.outputs[0].finish_reason == "length":
+                self.routes[hash(tuple(output.prompt_token_ids + output.outputs[0].token_ids))] = k
+
+    def assign(self, prompts):
+        """Replica of each prompt: continuations where they came from, the rest split into contiguous parts of about equal length."""
+        assignment = self.route(prompts)
+        lengths = [len(prompt["prompt_token_ids"]) if isinstance(prompt, dict) else len(prompt) for prompt in prompts]
+        free = [i for i in range(len(prompts)) if assignment[i] is None]
+        total = sum(lengths[i] for i in free)
+        done = 0
+        for i in free:
+            assignment[i] = min(len(self.replicas) - 1, int(done * len(self.replicas) / total)) if total else 0
+            done += lengths[i]
+        return assignment
+
+    def generate(self, prompts, sampling_params):
+        if not isinstance(sampling_params, list):
+            sampling_params = [sampling_params] * len(prompts)
+        assignment = self.assign(prompts)
+        queues = [[[i for i in range(len(prompts)) if assignment[i] == k]] for k in range(len(self.replicas))]
+        outputs = [None] * len(prompts)
+        for positions, chunk_outputs in self._run_chunks(prompts, sampling_params, queues, []):
+            for i, output in zip(positions, chunk_outputs):
+                outputs[i] = output
+        return outputs
+
+    def generate_stream(self, prompts, sampling_params, chunk_size):
+        if not isinstance(sampling_params, list):
+            sampling_params = [sampling_params] * len(prompts)
+        assignment = self.route(prompts)
+        free = [i for i in range(len(prompts)) if assignment[i] is None]
+        shared = [free[start:start + chunk_size] for start in range(0, len(free), chunk_size)]
+        queues = []
+        for k in range(len(self.replicas)):
+            pinned = [i for i in range(len(prompts)) if assignment[i] == k]
+            queues.append([pinned[start:start + chunk_size] for start in range(0, len(pinned), chunk_size)])
+        yield from self._run_chunks(prompts, sampling_params, queues, shared)
+
+    def _run_chunks(self, prompts, sampling_params, queues, shared):
+        """
+        Run chunks of prompt positions on the replicas: each replica works through its own queue,
+        then takes chunks from shared, getting its next chunk as soon as it returns one.
+        Yields:
+            (positions, outputs) of each chunk in the order the replicas finish them
+        """
+        from multiprocessing.connection import wait
+        busy = {}
+
+        def dispatch(k):
+            while queues[k] or shared:
+                chunk = queues[k].pop(0) if queues[k] else shared.pop(0)
+                if chunk:
+                    conn = self.replicas[k][1]
+                    conn.send(([prompts[i] for i in chunk], [sampling_params[i] for i in chunk]))
+                    busy[conn] = (k, chunk)
+                    return
+
+        errors = []
+        try:
+            for k in range(len(self.replicas)):
+                dispatch(k)
+            while busy:
+                for conn in wait(list(busy)):
+                    k, chunk = busy.pop(conn)
+                    status, result = self._receive(k)
+                    if status != "ok":
+                        # The failed replica takes no more chunks; its own queue is reported below
+                        errors.append(f"replica {k}: {result}")
+                        continue
+                    self.remember_routes(k, result)
+                    dispatch(k)
+                    yield chunk, result
+        finally:
+            # A consumer that stops early leaves replies in the pipes; read them so the next call gets its own
+            for conn, (k, _) in busy.items():
+                self._receive(k)
+        unfinished = sum(len(chunk) for queue in queues for chunk in queue) + sum(len(chunk) for chunk in shared)
+        if unfinished:
+            errors.append(f"{unfinished} prompts not generated")
+        if errors:
+            raise RuntimeError("Generation failed on " + "; ".join(errors))
+
+
+def plan_replica_devices(devices, data_parallel_size, gpus_per_replica=None):
+    """
+    Split the visible GPUs between data parallel replicas.
+    Args:
+        devices: Visible GPU ids, or None for engines that do not use GPUs
+        data_parallel_size: Requested number of replicas
+        gpus_per_replica: GPUs (tensor parallel size) of each replica; defaults to an even split
+    Returns:
+        List of GPU id lists, one per replica (fewer replicas than requested if there are not
+        enough GPUs), or None for engines that do not use GPUs
+    """
+    if devices is None:
+        return None
+    if gpus_per_replica is None:
+        gpus_per_replica = max(1, len(devices) // data_parallel_size)
+    num_replicas = min(data_parallel_size, len(devices) // gpus_per_replica)
+    if num_replicas < data_parallel_size:
+        print(f"Only {len(devices)} GPUs visible: running {max(1, num_replicas)} of {data_parallel_size} replicas with {gpus_per_replica} GPUs each")
+    return [devices[k * gpus_per_replica:(k + 1) * gpus_per_replica] for k in range(max(1, num_replicas))]
+
+
+def make_engine(name, handler, data_parallel_size=1, gpus_per_replica=None, **config):
+    """
+    Build the engine registered under name for a Local_Handler; config is passed to the engine.
+    With data_parallel_size > 1 (and enough GPUs for more than one replica), the engine runs as
+    that many Data_Parallel_Engine replicas of gpus_per_replica GPUs each.
+    """
+    if name not in ENGINES:
+        raise ValueError(f"Unknown engine {name}; choose from {', '.join(ENGINES)}")
+    if data_parallel_size > 1:
+        devices = plan_replica_devices(ENGINES[name].visible_devices(), data_parallel_size, gpus_per_replica)
+        if devices is None or len(devices) > 1:
+            return Data_Parallel_Engine.from_handler(handler, engine=name, num_replicas=data_parallel_size, devices=devices, **config)
+        # A single replica fits: run one ordinary engine in this process instead
+    return ENGINES[name].from_handler(handler, **config)
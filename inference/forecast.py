@@ -0,0 +1,228 @@
+import json
+import math
+import os
+import time
+
+
+def api_prompt_text(formatted):
+    """Text an API request's prompt is made of: each message's role, content and tool calls, and the tool definitions."""
+    parts = []
+    for message in formatted.get("messages", formatted.get("chat_history", [])):
+        parts.append(message.get("role", ""))
+        if isinstance(message.get("content"), str):
+            parts.append(message["content"])
+        elif message.get("content") is not None:
+            parts.append(json.dumps(message["content"]))
+        if message.get("tool_calls"):
+            parts.append(json.dumps(message["tool_calls"]))
+    if formatted.get("tools"):
+        parts.append(json.dumps(formatted["tools"]))
+    return "\n".join(parts)
+
+
+def get_tiktoken_encoding(model_name):
+    """tiktoken encoding of an OpenAI model, or None when tiktoken is not installed."""
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_prompt_tokens(handler, formatted_inputs, engine="vllm"):
+    """
+    Prompt token counts of formatted inputs, tokenized in batches.
+    Local prompts are tokenized with the model's tokenizer as loaded by the engine (a fast
+    Hugging Face tokenizer for vllm). OpenAI prompts are tokenized with tiktoken plus the
+    per-message overhead of the chat format; other providers, and OpenAI without tiktoken,
+    get the same rough estimate the rate limiter uses.
+    Args:
+        handler: Handler the inputs were formatted by
+        formatted_inputs: List of formatted inputs as returned by format_input
+        engine: Local engine name, for local handlers
+    Returns:
+        (list of token counts aligned with formatted_inputs, name of the tokenizer used)
+    """
+    from inference.model_handler import Local_Handler
+    if isinstance(handler, Local_Handler):
+        from inference.engines import ENGINES
+        tokenizer = ENGINES[engine].load_tokenizer(handler.model_path)
+        counts = []
+        for start in range(0, len(formatted_inputs), 1024):
+            counts.extend(len(ids) for ids in tokenizer(formatted_inputs[start:start + 1024], add_special_tokens=False)["input_ids"])
+        return counts, f"{engine} tokenizer of {handler.model_path}"
+    encoding = get_tiktoken_encoding(handler.model_name) if type(handler).__name__ == "OpenAI_Handler" else None
+    if encoding is not None:
+        counts = [len(ids) for ids in encoding.encode_batch([api_prompt_text(formatted) for formatted in formatted_inputs], disallowed_special=())]
+        # Every message costs 3 tokens of framing, and the reply is primed with 3 more
+        return [count + 3 * len(formatted["messages"]) + 3 for count, formatted in zip(counts, formatted_inputs)], f"tiktoken {encoding.name}"
+    from inference.api_engine import estimate_tokens
+    return [estimate_tokens(formatted) for formatted in formatted_inputs], "estimated at 4 characters per token"
+
+
+def percentile(sorted_values, q):
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return 0
+    return sorted_values[max(1, math.ceil(q / 100 * len(sorted_values))) - 1]
+
+
+def mean_completion_tokens(output_path):
+    """Mean completion tokens per sample of a previous run's outputs, or None if there is no such run or it has no usage."""
+    if not os.path.exists(output_path):
+        return None
+    with open(output_path, "r") as f:
+        outputs = json.load(f)
+    counts = [item["output"]["usage"]["completion_tokens"] for item in outputs
+              if isinstance(item["output"], dict) and item["output"].get("usage") and item["output"]["usage"].get("completion_tokens") is not None]
+    return sum(counts) / len(counts) if counts else None
+
+
+def calibrate_throughput(handler, prompts, num_samples):
+    """
+    Measure generation throughput by running num_samples of the prompts (spread over the list)
+    through the handler's engine as one batch.
+    Returns:
+        (output tokens per second, mean output tokens per sample)
+    """
+    step = max(1, len(prompts) // num_samples)
+    sample = prompts[::step][:num_samples]
+    start = time.perf_counter()
+    results, _ = handler.generate(sample)
+    elapsed = time.perf_counter() - start
+    completion_tokens = sum(usage["completion_tokens"] for _, _, usage in results if usage)
+    return completion_tokens / elapsed if elapsed > 0 else float("inf"), completion_tokens / max(1, len(sample))
+
+
+def forecast(sample_ids, prompt_tokens, max_tokens, context_window=None, expected_output_tokens=None,
+             input_price=None, output_price=None, tokens_per_second=None, num_longest=5):
+    """
+    Forecast the size of a run from its prompt token counts.
+    Output tokens, cost and generation time are given as an upper bound (every sample uses its
+    whole max_tokens budget) and, when expected_output_tokens is known, as an expected value.
+    Args:
+        sample_ids: List of sample ids
+        prompt_tokens: List of prompt token counts aligned with sample_ids
+        max_tokens: Generation budget per sample (None if left to the provider)
+        context_window: Prompt plus generated tokens the model accepts
+        expected_output_tokens: Expected output tokens per sample
+        input_price: USD per million prompt tokens
+        output_price: USD per million output tokens
+        tokens_per_second: Output tokens generated per second over a whole batch
+        num_longest: Number of longest samples to list
+    Returns:
+        Dict forecast
+    """
+    num_samples = len(prompt_tokens)
+    sorted_tokens = sorted(prompt_tokens)
+    total = sum(prompt_tokens)
+    output_tokens = {"max": num_samples * max_tokens if max_tokens is not None else None,
+                     "expected": num_samples * expected_output_tokens if expected_output_tokens is not None else None}
+    result = {
+        "num_samples": num_samples,
+        "prompt_tokens": {
+            "total": total,
+            "mean": total / num_samples if num_samples else 0,
+            "p50": percentile(sorted_tokens, 50),
+            "p90": percentile(sorted_tokens, 90),
+            "p99": percentile(sorted_tokens, 99),
+            "max": sorted_tokens[-1] if sorted_tokens else 0,
+        },
+        "longest": sorted(zip(sample_ids, prompt_tokens), key=lambda pair: -pair[1])[:num_longest],
+        "max_tokens": max_tokens,
+        "context_window": context_window,
+        "over_context": [],
+        "output_tokens": output_tokens,
+        "cost": None,
+        "generation_seconds": None,
+        "tokens_per_second": tokens_per_second,
+    }
+    if context_window is not None:
+        result["over_context"] = [(sample_id, tokens) for sample_id, tokens in zip(sample_ids, prompt_tokens) if tokens + (max_tokens or 0) > context_window]
+    if input_price is not None and output_price is not None:
+        result["cost"] = {key: (total * input_price + value * output_price) / 1e6 if value is not None else None for key, value in output_tokens.items()}
+    if tokens_per_second:
+        result["generation_seconds"] = {key: value / tokens_per_second if value is not None else None for key, value in output_tokens.items()}
+    return result
+
+
+def format_duration(seconds):
+    hours, rest = divmod(int(round(seconds)), 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{seconds:02d}s"
+
+
+def print_forecast(result, title, tokenizer_name):
+    """Print a forecast as returned by forecast()."""
+    tokens = result["prompt_tokens"]
+    print(f"Dry run: {title} ({result['num_samples']} samples)")
+    print(f"  Prompt tokens ({tokenizer_name}): total {tokens['total']}, mean {tokens['mean']:.1f}, "
+          f"p50 {tokens['p50']}, p90 {tokens['p90']}, p99 {tokens['p99']}, max {tokens['max']}")
+    if result["longest"]:
+        print("  Longest samples: " + ", ".join(f"{sample_id} ({count})" for sample_id, count in result["longest"]))
+    print(f"  Generation budget: max_tokens {result['max_tokens'] if result['max_tokens'] is not None else 'provider default'}, "
+          f"context window {result['context_window'] or 'unknown'}")
+    if result["over_context"]:
+        print(f"  WARNING: {len(result['over_context'])} samples do not fit the context window with the full budget: "
+              + ", ".join(f"{sample_id} ({count})" for sample_id, count in result["over_context"][:10])
+              + (" ..." if len(result["over_context"]) > 10 else ""))
+
+    def bounds(values, fmt):
+        parts = []
+        if values["max"] is not None:
+            parts.append(f"at most {fmt(values['max'])}")
+        if values["expected"] is not None:
+            parts.append(f"expected {fmt(values['expected'])}")
+        return ", ".join(parts)
+
+    if any(value is not None for value in result["output_tokens"].values()):
+        print(f"  Output tokens: {bounds(result['output_tokens'], lambda count: f'{count:.0f}')}")
+    if result["cost"] is not None:
+        print(f"  API cost: {bounds(result['cost'], lambda cost: f'${cost:.2f}')}")
+    if result["generation_seconds"] is not None:
+        print(f"  Generation time: {bounds(result['generation_seconds'], format_duration)} at {result['tokens_per_second']:.0f} output tokens/s")
+
+
+def dry_run(handler, spec, title, sample_ids, formatted_inputs, engine="vllm", output_path=None, expected_output_tokens=None,
+            tokens_per_second=None, calibrate=0, input_price=None, output_price=None):
+    """
+    Tokenize a run's prompts and print its forecast instead of running it.
+    The expected output tokens per sample come from expected_output_tokens if given, else from
+    the calibration run, else from the usage in a previous run's outputs at output_path.
+    Args:
+        handler: Handler the inputs were formatted by (local handlers need an engine only to calibrate)
+        spec: The model's inference.model_map.Model_Spec
+        title: What is forecast, for the report
+        sample_ids: List of sample ids aligned with formatted_inputs
+        formatted_inputs: List of formatted inputs as returned by format_input
+        engine: Local engine name
+        output_path: Output file of the run, to read the usage of a previous run from
+        expected_output_tokens: Expected output tokens per sample
+        tokens_per_second: Measured output tokens per second of the model on its engine
+        calibrate: Number of prompts to generate to measure tokens_per_second (local models)
+        input_price: USD per million prompt tokens (defaults to the model's list price)
+        output_price: USD per million output tokens (defaults to the model's list price)
+    Returns:
+        Dict forecast
+    """
+    prompt_tokens, tokenizer_name = count_prompt_tokens(handler, formatted_inputs, engine=engine)
+    if calibrate and formatted_inputs:
+        tokens_per_second, calibrated_output_tokens = calibrate_throughput(handler, formatted_inputs, calibrate)
+        print(f"Calibration: {calibrated_output_tokens:.1f} output tokens per sample, {tokens_per_second:.0f} output tokens/s over {min(calibrate, len(formatted_inputs))} prompts")
+        if expected_output_tokens is None:
+            expected_output_tokens = calibrated_output_tokens
+    if expected_output_tokens is None and output_path is not None:
+        expected_output_tokens = mean_completion_tokens(output_path)
+    if spec.engine != "api":
+        # Local runs cost GPU time, not money
+        input_price = output_price = None
+    else:
+        input_price = input_price if input_price is not None else spec.input_price
+        output_price = output_price if output_price is not None else spec.output_price
+    result = forecast(sample_ids, prompt_tokens, handler.max_tokens, context_window=spec.context_window, expected_output_tokens=expected_output_tokens,
+                      input_price=input_price, output_price=output_price, tokens_per_second=tokens_per_second)
+    print_forecast(result, title, tokenizer_name)
+    return result
@@ -0,0 +1,142 @@
+import json
+import os
+
+
+def build_judge_prompt(history, name, parameters, functions):
+    """
+    Prompt asking the judge whether the assistant's last tool call is logically correct
+    given the conversation history and the available functions.
+    Args:
+        history: List of message dicts of the conversation so far
+        name: Name of the tool the assistant called
+        parameters: Arguments of the tool call
+        functions: List of tool definitions (OpenAI function/tool format)
+    Returns:
+        Prompt string
+    """
+    history_str = json.dumps(history, indent=4)
+    functions_str = json.dumps(functions, indent=4)
+    return f"""
+        You are an expert evaluator of AI assistant responses. Your task is to determine if an AI assistant has chosen the correct tool and parameters to respond to a user's request based on the provided conversation history and the available tools.
+
+        You must focus solely on the **logical correctness** and **appropriateness** of the tool call. You should assume that the tool call's syntax (function name, parameter types, etc.) has already been validated and is correct. Your evaluation should be based on whether the call makes sense in the context of the conversation.
+
+        **Context:**
+        ***
+        **Available Tools:**
+        ```json
+        {functions_str}
+        ```
+        ***
+        **Conversation History:**
+        ```
+        {history_str}
+        ```
+        ***
+        **Assistant's Tool Call to Evaluate:**
+        tool name: {name}
+        tool parameters: {json.dumps(parameters, indent=4)}
+        ***
+
+        **Evaluation Task:**
+
+        1.  **Analyze the Conversation History:** Understand the user's most recent request and the overall goal of the conversation.
+        2.  **Examine the Assistant's Tool Call:** Look at the specific tool chosen and the values of the parameters provided.
+        3.  **Assess Logical Correctness:**
+            { "- Is the chosen tool the most logical one to address the user's last message?" if len(functions)>1  else ""}
+            { "- Would another tool have been more appropriate?" if len(functions)>1  else ""}
+            - Are the parameter values correctly extracted or inferred from the conversation?
+
+        **Final Decision:**
+
+        Based on your analysis, is the assistant's tool call the correct and logical choice in this situation?
+
+        Respond with a JSON object containing two keys, first reason key then is_correct key.
+        - "reason": a brief, one-sentence explanation for your decision.
+        - "is_correct": a boolean value (true or false).
+
+        example output:
+        ```json
+        {{"reason": "The assistant chose the correct tool and parameters.", "is_correct": true}}
+        ```
+
+        start outputting now.
+        """
+
+
+def parse_verdict(text):
+    """Judge verdict dict (reason, is_correct) from the judge's reply, which may be wrapped in a ```json fence."""
+    text = text.strip().strip("`")
+    if text.startswith("json"):
+        text = text[4:].strip().strip("`").strip()
+    verdict = json.loads(text)
+    return {"reason": verdict.get("reason", "No reason provided."), "is_correct": bool(verdict.get("is_correct", True))}
+
+
+class LLM_Judge:
+    """
+    Judges tool calls with an OpenAI-compatible chat model (the OpenAI API, or a local server
+    through base_url). Requests run concurrently on the API engine under its rate limits,
+    and verdicts are kept in an optional response cache keyed by the judge model and the
+    history, tool call and functions judged, so each tool call is only judged once.
+    """
+    # Bump when the prompt or verdict parsing changes, so cached verdicts are not reused
+    version = "1"
+
+    def __init__(self, model="gpt-4o", base_url=None, api_key=None, cache=None, engine_config=None):
+        from inference.api_engine import API_Engine
+        self.model = model
+        self.base_url = base_url
+        self.api_key = api_key or os.environ.get("OPENAI_API_KEY") or ("EMPTY" if base_url else None)
+        self.cache = cache
+        config = {"requests_per_minute": 500, "tokens_per_minute": 200000}
+        config.update({k: v for k, v in (engine_config or {}).items() if v is not None})
+        self.engine = API_Engine(**config)
+        self.client = None
+
+    def create_client(self):
+        import openai
+        # Retries are handled by the engine so that they share its rate limits and backoff
+        return openai.AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=0)
+
+    async def judge_one(self, item):
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": "You are an expert evaluator of AI assistant tool calls. Respond only in JSON format."},
+                {"role": "user", "content": build_judge_prompt(item["history"], item["name"], item["parameters"], item["functions"])},
+            ],
+            temperature=0.0,
+        )
+        return parse_verdict(response.choices[0].message.content or "")
+
+    def judge_many(self, items):
+        """
+        Judge many tool calls.
+        Args:
+            items: List of dicts with history, name, parameters and functions
+        Returns:
+            List of verdicts ({"reason", "is_correct"}) aligned with items, None where judging failed
+        """
+        from inference.response_cache import make_cache_key
+        identity = {"judge": type(self).__name__, "version": self.version, "model": self.model}
+        keys = [make_cache_key(identity, item) for item in items]
+        verdicts = self.cache.get_many(keys) if self.cache is not None else {}
+        miss_keys = list(dict.fromkeys(key for key in keys if key not in verdicts))
+        miss_items = {key: item for key, item in zip(keys, items)}
+
+        def on_result(j, verdict):
+            if self.cache is not None and isinstance(verdict, dict):
+                self.cache.put_many([(miss_keys[j], verdict)])
+
+        def setup():
+            self.client = self.create_client()
+
+        if miss_keys:
+            try:
+                results = self.engine.run(self.judge_one, [miss_items[key] for key in miss_keys], setup=setup, on_result=on_result)
+            finally:
+                if self.cache is not None:
+                    self.cache.flush()
+            verdicts.update(zip(miss_keys, results))
+        return [verdicts[key] if isinstance(verdicts[key], dict) else None for key in keys]
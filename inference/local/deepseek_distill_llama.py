@@ -1,22 +1,20 @@
-from inference.model_handler import Base_Handler
-from jinja2 import Environment, FileSystemLoader
-from vllm import LLM, SamplingParams
-import os
-import torch
-from inference.sys_pmts import *
+from inference.model_handler import Local_Handler
+from inference.normalize import normalize_history, get_sys_prompt_mode
 
-class DeepSeek_Distill_Llama_Handler(Base_Handler):
-    def __init__(self, model_path="deepseek-ai/DeepSeek-R1-Distill-Llama-8B"):
-        super().__init__("deepseek_distill_llama")
-        self.model_path = model_path
-        self.llm = LLM(model=self.model_path, tensor_parallel_size=torch.cuda.device_count())
-        self.sampling_params = SamplingParams(temperature=0.0, max_tokens=4096)
+class DeepSeek_Distill_Llama_Handler(Local_Handler):
+    template_name = "deepseek_distill_llama.jinja"
+    tool_parser = "deepseek_distill"
+    reasons = True
+    max_tokens = 4096
 
-    def format_input(self, history, tools=None, tools_in_user_message=True, date_string="26 Jul 2024", add_generation_prompt=True, custom_tools=None, builtin_tools=None, time_elapsed_level=0, use_time_stamp=False, use_special_sys_prompt_naive=False, use_special_sys_prompt_rule=False):
+    def __init__(self, model_path="deepseek-ai/DeepSeek-R1-Distill-Llama-8B", enable_prefix_caching=False, engine="vllm", engine_config=None):
+        super().__init__("deepseek_distill_llama", model_path, enable_prefix_caching=enable_prefix_caching, engine=engine, engine_config=engine_config)
+
+    def build_prompt_context(self, history, tools=None, tools_in_user_message=True, date_string="26 Jul 2024", add_generation_prompt=True, custom_tools=None, builtin_tools=None, time_elapsed_level=0, use_time_stamp=False, use_special_sys_prompt_naive=False, use_special_sys_prompt_rule=False):
         """
-        Format the input history for DeepSeek Distill Llama using the Jinja template.
+        Build the Jinja template variables for a DeepSeek Distill Llama prompt.
         Args:
-            history: List of message dicts (role/content/tool_calls/etc)
+            history: List of message dicts (role/content/tool_calls/etc) or a Normalized_History
             tools: List of tool/function definitions (from the 'function' field in data)
             tools_in_user_message: Whether to include tools in user message (default True)
             date_string: Date string for prompt (default "26 Jul 2024")
@@ -24,30 +22,13 @@ class DeepSeek_Distill_Llama_Handler(Base_Handler):
             custom_tools: Custom tools (optional)
             builtin_tools: Builtin tools (optional)
         Returns:
-            Rendered prompt string
+            Dict of template variables
         """
-        env = Environment(loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), '../../templates')),
-                          trim_blocks=True, lstrip_blocks=True)
-        template = env.get_template('deepseek_distill_llama.jinja')
-        messages = []
-        sys_date_str = history[0]['time'].split('T')[0]
-        for msg in history:
-            m = {"role": msg["role"]}
-            time_string = msg['time'] if type(msg['time']) is str else msg['time'][time_elapsed_level]
-            if msg.get("content") is not None and "tool_calls" not in msg:
-                m["content"] = f"[{time_string}] " + msg["content"] if use_time_stamp else msg["content"]
-                if m["role"] == "system" and use_special_sys_prompt_naive:
-                    m["content"] = m["content"] + NAIVE
-                elif m["role"] == "system" and use_special_sys_prompt_rule:
-                    m["content"] = m["content"] + RULE
-            if "tool_calls" in msg:
-                m["tool_calls"] = msg["tool_calls"]
-                m["content"] = None
-            if msg["role"] == "tool" and "tool_call_id" in msg:
-                m["tool_call_id"] = msg["tool_call_id"]
-            messages.append(m)
+        history = normalize_history(history)
+        sys_date_str = history.history[0]['time'].split('T')[0]
+        messages = history.messages(time_elapsed_level, use_time_stamp, get_sys_prompt_mode(use_special_sys_prompt_naive, use_special_sys_prompt_rule), null_tool_call_content=True)
 
-        rendered = template.render(
+        return dict(
             bos_token="<|begin_of_text|>",
             eos_token="<|eot_id|>",
             messages=messages,
@@ -57,16 +38,3 @@ class DeepSeek_Distill_Llama_Handler(Base_Handler):
             add_generation_prompt=add_generation_prompt,
             custom_tools=custom_tools,
         )
-        return rendered
-
-    def run_inference(self, formatted_inputs):
-        """
-        Run batch inference using vllm.
-        Args:
-            formatted_inputs: List of formatted prompt strings
-        Returns:
-            List of output strings
-        """
-        # breakpoint()
-        outputs = self.llm.generate(formatted_inputs, self.sampling_params)
-        return [output.outputs[0].text.strip() if output.outputs else "" for output in outputs]
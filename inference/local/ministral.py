@@ -1,65 +1,32 @@
-from inference.model_handler import Base_Handler
-from jinja2 import Environment, FileSystemLoader
-from vllm import LLM, SamplingParams
-import os
-import torch
-from inference.sys_pmts import *
+from inference.model_handler import Local_Handler
+from inference.normalize import normalize_history, get_sys_prompt_mode
 
-class Ministral_Handler(Base_Handler):
-    def __init__(self, model_path="mistralai/Ministral-8B-Instruct-2410"):
-        super().__init__("ministral")
-        self.model_path = model_path
-        self.llm = LLM(model=self.model_path, tensor_parallel_size=torch.cuda.device_count())
-        self.sampling_params = SamplingParams(temperature=0.0, max_tokens=2048)
+class Ministral_Handler(Local_Handler):
+    template_name = "ministral.jinja"
+    tool_parser = "ministral"
 
-    def format_input(self, history, tools=None, add_generation_prompt=True, time_elapsed_level=0, use_time_stamp=False, use_special_sys_prompt_naive=False, use_special_sys_prompt_rule=False):
+    def __init__(self, model_path="mistralai/Ministral-8B-Instruct-2410", enable_prefix_caching=False, engine="vllm", engine_config=None):
+        super().__init__("ministral", model_path, enable_prefix_caching=enable_prefix_caching, engine=engine, engine_config=engine_config)
+
+    def build_prompt_context(self, history, tools=None, add_generation_prompt=True, time_elapsed_level=0, use_time_stamp=False, use_special_sys_prompt_naive=False, use_special_sys_prompt_rule=False):
         """
-        Format the input history for Ministral using the Jinja template.
+        Build the Jinja template variables for a Ministral prompt.
         Args:
-            history: List of message dicts (role/content/tool_calls/etc)
+            history: List of message dicts (role/content/tool_calls/etc) or a Normalized_History
             tools: List of tool/function definitions (from the 'function' field in data)
             add_generation_prompt: Whether to add assistant generation prompt (default True)
         Returns:
-            Rendered prompt string
+            Dict of template variables
         """
-        env = Environment(loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), '../../templates')),
-                          trim_blocks=True, lstrip_blocks=True)
-        template = env.get_template('ministral.jinja')
-        messages = []
-        for msg in history:
-            m = {"role": msg["role"]}
-            time_string = msg['time'] if type(msg['time']) is str else msg['time'][time_elapsed_level]
-            if msg.get("content") is not None and "tool_calls" not in msg:
-                m["content"] = f"[{time_string}] " + msg["content"] if use_time_stamp else msg["content"]
-                if m["role"] == "system" and use_special_sys_prompt_naive:
-                    m["content"] = m["content"] + NAIVE
-                elif m["role"] == "system" and use_special_sys_prompt_rule:
-                    m["content"] = m["content"] + RULE
-            if "tool_calls" in msg:
-                m["tool_calls"] = msg["tool_calls"]
-                m["content"] = None
-            if msg["role"] == "tool" and "tool_call_id" in msg:
-                m["tool_call_id"] = msg["tool_call_id"]
-                if len(msg["tool_call_id"]) != 9:
-                    raise ValueError(f"Tool call ID {msg['tool_call_id']} is not 9 characters long.")
-            messages.append(m)
-        rendered = template.render(
+        history = normalize_history(history)
+        messages = history.messages(time_elapsed_level, use_time_stamp, get_sys_prompt_mode(use_special_sys_prompt_naive, use_special_sys_prompt_rule), null_tool_call_content=True)
+        for m in messages:
+            if m["role"] == "tool" and "tool_call_id" in m and len(m["tool_call_id"]) != 9:
+                raise ValueError(f"Tool call ID {m['tool_call_id']} is not 9 characters long.")
+        return dict(
             bos_token="<s>",
             eos_token="</s>",
             messages=messages,
             tools=tools,
             add_generation_prompt=add_generation_prompt
         )
-        return rendered
-
-    def run_inference(self, formatted_inputs):
-        """
-        Run batch inference using vllm.
-        Args:
-            formatted_inputs: List of formatted prompt strings
-        Returns:
-            List of output strings
-        """
-        # breakpoint()
-        outputs = self.llm.generate(formatted_inputs, self.sampling_params)
-        return [output.outputs[0].text.strip() if output.outputs else "" for output in outputs]
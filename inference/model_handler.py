@@ -1,8 +1,19 @@
 from abc import ABC, abstractmethod
 
 class Base_Handler(ABC):
+    # Bump when a change to the handler changes its outputs, so cached responses are not reused
+    version = "2"
+
+    # Generation budget in tokens; None leaves it to the provider's default
+    max_tokens = None
+
     def __init__(self, model_name):
         self.model_name = model_name
+        self.response_cache = None
+
+    def set_max_tokens(self, max_tokens):
+        """Change the generation budget, e.g. per dataset from a budget file (see utils.resolve_max_tokens)."""
+        self.max_tokens = max_tokens
 
     @abstractmethod
     def format_input(self, history, *args, **kwargs):
@@ -10,6 +21,405 @@ class Base_Handler(ABC):
         pass
 
     @abstractmethod
-    def run_inference(self, formatted_inputs):
-        """Run inference on the formatted inputs (batch or single)."""
+    def _run_inference(self, formatted_inputs, on_result=None):
+        """Run inference on the formatted inputs (batch or single), calling on_result(index, output) as outputs complete."""
+        pass
+
+    def cache_identity(self):
+        """Everything besides the formatted request that determines the output, used in response cache keys."""
+        return {"handler": type(self).__name__, "version": self.version, "model": self.model_name}
+
+    def run_inference(self, formatted_inputs, on_result=None):
+        """
+        Run inference on the formatted inputs. When a response cache is attached, only
+        requests missing from it are sent (each distinct request once) and successful
+        outputs are stored as soon as they arrive.
+        Args:
+            formatted_inputs: List of formatted inputs as returned by format_input
+            on_result: Optional callback on_result(index, output), called once per input as soon as its output is available
+        Returns:
+            List of output records (see inference.tool_parsers.make_record) aligned with formatted_inputs
+        """
+        if self.response_cache is None:
+            return self._run_inference(formatted_inputs, on_result=on_result)
+        from inference.response_cache import make_cache_key
+        from inference.tool_parsers import is_error
+        identity = self.cache_identity()
+        keys = [make_cache_key(identity, formatted) for formatted in formatted_inputs]
+        results = self.response_cache.get_many(keys)
+        miss_indices = {}
+        for i, key in enumerate(keys):
+            if key in results:
+                if on_result is not None:
+                    on_result(i, results[key])
+            else:
+                miss_indices.setdefault(key, []).append(i)
+        miss_keys = list(miss_indices)
+
+        def on_miss(j, output):
+            key = miss_keys[j]
+            if not is_error(output):
+                self.response_cache.put_many([(key, output)])
+            if on_result is not None:
+                for i in miss_indices[key]:
+                    on_result(i, output)
+
+        if miss_keys:
+            try:
+                outputs = self._run_inference([formatted_inputs[miss_indices[key][0]] for key in miss_keys], on_result=on_miss)
+            finally:
+                self.response_cache.flush()
+            results.update(zip(miss_keys, outputs))
+        return [results[key] for key in keys]
+
+
+class Local_Handler(Base_Handler):
+    """
+    Shared engine setup, prompt rendering and batched generation for the handlers in inference/local.
+    The prompt format (template_name, tool_parser) belongs to the handler; generation is done by
+    the engine selected with engine ("vllm" or "fake", see inference.engines).
+    Subclasses set template_name and tool_parser (a key of inference.tool_parsers.TOOL_PARSERS),
+    implement build_prompt_context and may override max_tokens. Subclasses whose generation
+    starts inside a <think> block set reasons = True. With engine None the handler can only
+    render prompts, which is all a dry run needs.
+    """
+    template_name = None
+    tool_parser = None
+    reasons = False
+    max_tokens = 2048
+    stream_batch_size = 64
+    # Decision-only mode: stop text answers once the decision is known (see generate_decision_only)
+    decision_only = False
+    decision_chars = None
+    decision_tokens = 32
+    # Optional inference.prompt_cache.Prompt_Cache of rendered prompts and token ids
+    prompt_cache = None
+
+    def __init__(self, model_name, model_path, enable_prefix_caching=False, engine="vllm", engine_config=None):
+        super().__init__(model_name)
+        from inference.engines import make_engine
+        self.model_path = model_path
+        self.enable_prefix_caching = enable_prefix_caching
+        self._tokenizer_fingerprint = None
+        self.engine_name = engine
+        # The engine follows the vllm.LLM interface (see inference.engines.Local_Engine)
+        self.llm = make_engine(engine, self, **(engine_config or {})) if engine is not None else None
+        self.set_max_tokens(self.max_tokens)
+
+    def set_max_tokens(self, max_tokens):
+        super().set_max_tokens(max_tokens)
+        self.sampling_params = self.llm.make_sampling_params(temperature=0.0, max_tokens=max_tokens) if self.llm is not None else None
+
+    @abstractmethod
+    def build_prompt_context(self, history, *args, **kwargs):
+        """Build the template variables for one history."""
+        pass
+
+    def format_input(self, history, *args, **kwargs):
+        """Render the prompt for one history with the handler's chat template."""
+        from inference.templates import render_template
+        return render_template(self.template_name, self.build_prompt_context(history, *args, **kwargs))
+
+    def render_many(self, samples, config, num_workers=1):
+        """
+        Render the prompts for many samples with the same format_input settings.
+        Args:
+            samples: List of data samples (dicts with 'history' and optionally 'function')
+            config: Dict of format_input keyword arguments (time_elapsed_level, use_time_stamp, ...)
+            num_workers: Number of processes to render with
+        Returns:
+            List of rendered prompt strings aligned with samples, with the exception in place of any sample that failed to format
+        """
+        if self.prompt_cache is None:
+            return self._render_many(samples, config, num_workers)
+        from inference.prompt_cache import render_identity, make_prompt_key
+        identity = render_identity(self, config)
+        keys = [make_prompt_key(identity, sample) for sample in samples]
+        prompts = self.prompt_cache.get_prompts(keys)
+        misses = [i for i, key in enumerate(keys) if key not in prompts]
+        rendered = self._render_many([samples[i] for i in misses], config, num_workers)
+        self.prompt_cache.put_prompts((keys[i], prompt) for i, prompt in zip(misses, rendered) if not isinstance(prompt, Exception))
+        results = [prompts.get(key) for key in keys]
+        for i, prompt in zip(misses, rendered):
+            results[i] = prompt
+        return results
+
+    def _render_many(self, samples, config, num_workers=1):
+        from inference.templates import render_many
+        contexts = []
+        for sample in samples:
+            try:
+                contexts.append(self.build_prompt_context(sample["history"], tools=sample.get("function", None), **config))
+            except Exception as e:
+                contexts.append(e)
+        rendered = iter(render_many(self.template_name, [c for c in contexts if not isinstance(c, Exception)], num_workers=num_workers))
+        return [context if isinstance(context, Exception) else next(rendered) for context in contexts]
+
+    def cache_identity(self):
+        identity = super().cache_identity()
+        # Built from the handler's settings rather than sampling_params, which dry runs (no engine) do not have
+        identity.update(model_path=self.model_path, temperature=0.0, max_tokens=self.max_tokens)
+        if self.decision_only:
+            identity.update(decision_only=True, decision_chars=self.decision_chars)
+        if self.engine_name != "vllm":
+            identity.update(engine=self.engine_name)
+        return identity
+
+    def engine_inputs(self, prompts):
+        """
+        Prompts as submitted to the engine. With a prompt cache, each prompt's token ids are
+        looked up (prompts missing from the cache are tokenized in one batch, as vllm would,
+        and stored) and passed as {"prompt_token_ids": [...]} so the engine skips tokenization.
+        """
+        if self.prompt_cache is None:
+            return prompts
+        from inference.prompt_cache import tokenizer_fingerprint, make_token_key
+        tokenizer = self.llm.get_tokenizer()
+        if self._tokenizer_fingerprint is None:
+            self._tokenizer_fingerprint = tokenizer_fingerprint(tokenizer)
+        keys = [make_token_key(self._tokenizer_fingerprint, prompt) for prompt in prompts]
+        token_ids = self.prompt_cache.get_token_ids(keys)
+        misses = list(dict.fromkeys(i for i, key in enumerate(keys) if key not in token_ids))
+        if misses:
+            tokenized = tokenizer([prompts[i] for i in misses])["input_ids"]
+            token_ids.update((keys[i], list(ids)) for i, ids in zip(misses, tokenized))
+            self.prompt_cache.put_token_ids((keys[i], token_ids[keys[i]]) for i in misses)
+        return [{"prompt_token_ids": token_ids[key]} for key in keys]
+
+    def generate(self, prompts):
+        """
+        Generate completions for a list of prompts.
+        Returns:
+            (list of (text, finish_reason, usage) aligned with prompts, list of vllm RequestOutput of the prompts' first pass)
+        """
+        if self.decision_only:
+            return self.generate_decision_only(prompts)
+        outputs = self.llm.generate(self.engine_inputs(prompts), self.sampling_params)
+        return self.completion_results(outputs), outputs
+
+    def completion_results(self, outputs):
+        """(text, finish_reason, usage) of each request output."""
+        from inference.tool_parsers import make_usage
+        results = []
+        for output in outputs:
+            completion = output.outputs[0] if output.outputs else None
+            text = completion.text.strip() if completion is not None else ""
+            usage = make_usage(len(output.prompt_token_ids or []), len(completion.token_ids) if completion is not None else 0)
+            results.append((text, completion.finish_reason if completion is not None else None, usage))
+        return results
+
+    def generate_decision_only(self, prompts):
+        """
+        Generate in growing rounds (decision_tokens, then twice as many, ...) and decide after
+        each round from the text so far, outside any <think> block: once a tool call opener
+        appears the call is generated to the end (up to max_tokens) so it can be validated,
+        and once early_decision rules a call out (see there) the answer is cut short
+        with finish_reason "decision_only". Each round continues from the prompt and the
+        tokens generated so far, so with greedy decoding the tokens match a single full pass.
+        Returns:
+            Same as generate
+        """
+        from inference.tool_parsers import early_decision, make_usage
+        tokenizer = self.llm.get_tokenizer()
+        prompt_token_ids = [None] * len(prompts)
+        token_ids = [[] for _ in prompts]
+        finish_reasons = [None] * len(prompts)
+        first_outputs = None
+        pending = list(range(len(prompts)))
+        to_complete = []
+        round_tokens = self.decision_tokens
+
+        first_inputs = self.engine_inputs(prompts)
+
+        def run(indices, max_tokens):
+            inputs = [first_inputs[i] if prompt_token_ids[i] is None else {"prompt_token_ids": prompt_token_ids[i] + token_ids[i]} for i in indices]
+            params = [self.llm.make_sampling_params(temperature=self.sampling_params.temperature, max_tokens=max(1, min(max_tokens, self.max_tokens - len(token_ids[i])))) for i in indices]
+            outputs = self.llm.generate(inputs, params)
+            for i, output in zip(indices, outputs):
+                if prompt_token_ids[i] is None:
+                    prompt_token_ids[i] = list(output.prompt_token_ids or [])
+                token_ids[i].extend(output.outputs[0].token_ids)
+                finish_reasons[i] = output.outputs[0].finish_reason
+            return outputs
+
+        while pending:
+            outputs = run(pending, round_tokens)
+            if first_outputs is None:
+                first_outputs = outputs
+            still_pending = []
+            for i in pending:
+                if finish_reasons[i] == "stop" or len(token_ids[i]) >= self.max_tokens:
+                    continue
+                text = tokenizer.decode(token_ids[i], skip_special_tokens=True)
+                if self.reasons:
+                    if "</think>" not in text:
+                        still_pending.append(i)
+                        continue
+                    text = text.split("</think>", 1)[1]
+                decision = early_decision(self.tool_parser, text, self.decision_chars)
+                if decision == "tool":
+                    to_complete.append(i)
+                elif decision == "text":
+                    finish_reasons[i] = "decision_only"
+                else:
+                    still_pending.append(i)
+            pending = still_pending
+            round_tokens *= 2
+        if to_complete:
+            run(to_complete, self.max_tokens)
+        results = []
+        for i in range(len(prompts)):
+            text = tokenizer.decode(token_ids[i], skip_special_tokens=True).strip()
+            results.append((text, finish_reasons[i], make_usage(len(prompt_token_ids[i] or []), len(token_ids[i]))))
+        return results, first_outputs or []
+
+    def score_propensity(self, formatted_inputs, num_logprobs=20):
+        """
+        Tool call propensity from a single decode step: the probability mass of the first
+        generated token on tokens that open a tool call (tokens that are a prefix of, or start
+        with, one of the parser's TOOL_CALL_OPENERS, ignoring leading whitespace).
+        Only the num_logprobs most likely tokens are seen, so covered_mass (their total
+        probability) bounds how much mass the propensity could be missing.
+        Args:
+            formatted_inputs: List of formatted prompt strings
+            num_logprobs: Number of top next tokens to inspect (vllm's max_logprobs, 20 by default)
+        Returns:
+            List of dicts with propensity, covered_mass and top_tokens ([token, probability] pairs), aligned with formatted_inputs
+        """
+        import math
+        from inference.prefix_cache import order_by_shared_prefix
+        from inference.tool_parsers import TOOL_CALL_OPENERS
+        if self.reasons:
+            raise ValueError(f"{type(self).__name__} starts generation inside a <think> block, so its first token says nothing about tool use.")
+        openers = TOOL_CALL_OPENERS[self.tool_parser]
+
+        def opens_tool_call(token):
+            token = token.lstrip()
+            return token != "" and any(opener.startswith(token) or token.startswith(opener) for opener in openers)
+
+        order = order_by_shared_prefix(formatted_inputs) if self.enable_prefix_caching else list(range(len(formatted_inputs)))
+        params = self.llm.make_sampling_params(temperature=0.0, max_tokens=1, logprobs=num_logprobs)
+        outputs = self.llm.generate(self.engine_inputs([formatted_inputs[i] for i in order]), params)
+        scores = [None] * len(formatted_inputs)
+        for i, output in zip(order, outputs):
+            top = output.outputs[0].logprobs[0] if output.outputs and output.outputs[0].logprobs else {}
+            top_tokens = sorted(((logprob.decoded_token or "", math.exp(logprob.logprob)) for logprob in top.values()), key=lambda pair: -pair[1])
+            scores[i] = {
+                "propensity": sum(p for token, p in top_tokens if opens_tool_call(token)),
+                "covered_mass": sum(p for _, p in top_tokens),
+                "top_tokens": [[token, p] for token, p in top_tokens[:5]],
+            }
+        return scores
+
+    def _generate_batches(self, formatted_inputs, order, streaming):
+        """
+        Generate the prompts at order, in one batch or, when streaming, in micro-batches.
+        Yields:
+            (list of input indices, list of (text, finish_reason, usage), list of request outputs)
+        """
+        if not order:
+            return
+        if not streaming:
+            results, outputs = self.generate([formatted_inputs[i] for i in order])
+            yield order, results, outputs
+        elif self.decision_only:
+            # Decision rounds continue the whole micro-batch together
+            for start in range(0, len(order), self.stream_batch_size):
+                batch = order[start:start + self.stream_batch_size]
+                results, outputs = self.generate([formatted_inputs[i] for i in batch])
+                yield batch, results, outputs
+        else:
+            inputs = self.engine_inputs([formatted_inputs[i] for i in order])
+            for positions, outputs in self.llm.generate_stream(inputs, self.sampling_params, self.stream_batch_size):
+                yield [order[p] for p in positions], self.completion_results(outputs), outputs
+
+    def _run_inference(self, formatted_inputs, on_result=None):
+        """
+        Run batch inference on the engine.
+        With prefix caching enabled, prompts are submitted grouped by shared prefix and the
+        prefix cache hit rate is reported; outputs are always returned in input order.
+        With on_result, prompts are generated in micro-batches of stream_batch_size and
+        reported after each one; data parallel replicas report their micro-batches as each
+        one finishes (see Local_Engine.generate_stream).
+        Args:
+            formatted_inputs: List of formatted prompt strings
+            on_result: Optional callback on_result(index, output)
+        Returns:
+            List of output records
+        """
+        from inference.prefix_cache import order_by_shared_prefix, prefix_cache_stats
+        from inference.tool_parsers import parse_tool_output
+        if self.enable_prefix_caching:
+            order = order_by_shared_prefix(formatted_inputs)
+        else:
+            order = list(range(len(formatted_inputs)))
+        records = [None] * len(formatted_inputs)
+        all_outputs = []
+        for batch, results, outputs in self._generate_batches(formatted_inputs, order, streaming=on_result is not None):
+            all_outputs.extend(outputs)
+            for i, (text, finish_reason, usage) in zip(batch, results):
+                records[i] = parse_tool_output(self.tool_parser, text, finish_reason, usage)
+                if on_result is not None:
+                    on_result(i, records[i])
+        if self.enable_prefix_caching:
+            stats = prefix_cache_stats(all_outputs)
+            print(f"Prefix cache: {stats['cached_tokens']} of {stats['prompt_tokens']} prompt tokens served from cache "
+                  f"(hit rate {stats['hit_rate']:.2%}, {stats['cached_tokens']} prefill tokens saved)")
+        return records
+
+
+class API_Handler(Base_Handler):
+    """
+    Shared asyncio request engine for the handlers in inference/api.
+    Subclasses implement create_client and the coroutine infer_one, and may set per-provider
+    default rate limits; engine_config overrides them (see inference.api_engine.API_Engine).
+    """
+    requests_per_minute = None
+    tokens_per_minute = None
+    tool_choice = "auto"
+
+    def __init__(self, model_name, engine_config=None):
+        super().__init__(model_name)
+        from inference.api_engine import API_Engine
+        config = {"requests_per_minute": self.requests_per_minute, "tokens_per_minute": self.tokens_per_minute}
+        config.update({k: v for k, v in (engine_config or {}).items() if v is not None})
+        self.engine = API_Engine(**config)
+        self.client = None
+
+    def cache_identity(self):
+        identity = super().cache_identity()
+        identity.update(tool_choice=self.tool_choice)
+        if self.max_tokens is not None:
+            identity.update(max_tokens=self.max_tokens)
+        return identity
+
+    @abstractmethod
+    def create_client(self):
+        """Build the provider's async client. Called inside the event loop of each run."""
+        pass
+
+    @abstractmethod
+    async def infer_one(self, formatted):
+        """Send one formatted request and return its output record. Exceptions are retried or reported by the engine."""
         pass
+
+    def _run_inference(self, formatted_inputs, on_result=None):
+        """
+        Run batch inference concurrently under the engine's rate limits.
+        Args:
+            formatted_inputs: List of dicts as returned by format_input
+            on_result: Optional callback on_result(index, output), called as each request finishes
+        Returns:
+            List of output records, with an error record for failed requests
+        """
+        from inference.tool_parsers import error_record
+
+        def as_record(output):
+            # The engine reports failed requests as "[ERROR]: ..." strings
+            return output if isinstance(output, dict) else error_record(output)
+
+        def setup():
+            self.client = self.create_client()
+        outputs = self.engine.run(self.infer_one, formatted_inputs, setup=setup,
+                                  on_result=(lambda i, output: on_result(i, as_record(output))) if on_result is not None else None)
+        return [as_record(output) for output in outputs]
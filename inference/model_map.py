@@ -1,76 +1,83 @@
-# Maps model code to handler module name (without .py)
-MODEL_TO_HANDLER = {
-    # API models
-    "gpt-4.1-mini-2025-04-14-FC": "openai",
-    "gpt-4.1-nano-2025-04-14-FC": "openai",
-    "gpt-4.1-2025-04-14-FC": "openai",
-    "gpt-4o-mini-2024-07-18-FC": "openai",
-    "gpt-4o-2024-11-20-FC": "openai",
-    "o3-2025-04-16-FC": "openai",
-    "o4-mini-2025-04-16-FC": "openai",
-    "command-r": "cohere",
-    "command-r-plus": "cohere",
-    "command-a": "cohere",
-    "deepseek-chat": "deepseek",
+import importlib
 
-    # Local models
-    "meta-llama/Llama-3.1-8B-Instruct": "llama3_1",
-    "meta-llama/Llama-3.2-3B-Instruct": "llama3_2",
-    "Qwen/Qwen3-8B": "qwen3",
-    "Qwen/Qwen3-8B-reason": "qwen3_reason",
-    "Qwen/Qwen2.5-7B-Instruct": "qwen2_5",
-    "mistralai/Ministral-8B-Instruct-2410": "ministral",
-    "deepseek-ai/DeepSeek-R1-Distill-Qwen-7B": "deepseek_distill_qwen",
-    "deepseek-ai/DeepSeek-R1-Distill-Llama-8B": "deepseek_distill_llama",
 
-}
+class Model_Spec:
+    """
+    One registered model: its handler class, given as "module:Class" and imported only when
+    needed (so listing models or reading outputs never imports an SDK or vllm), its display
+    name, and the engine kind that runs it ("api" for inference.api handlers, "vllm" otherwise).
+    context_window (prompt plus generated tokens) and the API prices in USD per million input
+    and output tokens are used by dry runs to flag samples that do not fit and forecast cost.
+    cached_input_price is the price of prompt tokens served from the provider's prompt cache,
+    used for the spend in run telemetry.
+    """
+    def __init__(self, handler, short_name, context_window=None, input_price=None, output_price=None, cached_input_price=None):
+        self.handler = handler
+        self.short_name = short_name
+        self.context_window = context_window
+        self.input_price = input_price
+        self.output_price = output_price
+        self.cached_input_price = cached_input_price
 
-MODEL_TO_TOOLCALL_SIGNATURE = {
-    "gpt-4.1-mini-2025-04-14-FC": "ChatCompletionMessageToolCall",
-    "gpt-4.1-nano-2025-04-14-FC": "ChatCompletionMessageToolCall",
-    "gpt-4.1-2025-04-14-FC": "ChatCompletionMessageToolCall",
-    "gpt-4o-mini-2024-07-18-FC": "ChatCompletionMessageToolCall",
-    "gpt-4o-2024-11-20-FC": "ChatCompletionMessageToolCall",
-    "o3-2025-04-16-FC": "ChatCompletionMessageToolCall",
-    "o4-mini-2025-04-16-FC": "ChatCompletionMessageToolCall",
-    "command-r": "ToolCallV2",
-    "command-r-plus": "ToolCallV2",
-    "command-a": "ToolCallV2",
-    "deepseek-chat": "ChatCompletionMessageToolCall",
+    @property
+    def module(self):
+        return self.handler.split(":")[0]
 
+    @property
+    def handler_name(self):
+        """Handler module name without package, e.g. "openai" or "llama3_1"."""
+        return self.module.split(".")[-1]
 
-    "meta-llama/Llama-3.1-8B-Instruct": "\"name\"<AND>\"parameters\"",
-    "meta-llama/Llama-3.2-3B-Instruct": "\"name\"<AND>\"parameters\"",
-    "Qwen/Qwen3-8B": "<tool_call><AND></tool_call>",
-    "Qwen/Qwen2.5-7B-Instruct": "<tool_call><AND></tool_call>",
-    "mistralai/Ministral-8B-Instruct-2410": "\"arguments\"<AND>\"name\"",
-    "deepseek-ai/DeepSeek-R1-Distill-Qwen-7B": "<｜tool▁call▁begin｜><AND><｜tool▁call▁end｜>",
-    "deepseek-ai/DeepSeek-R1-Distill-Llama-8B": "<｜tool▁call▁begin｜><AND><｜tool▁call▁end｜>",
-}
+    @property
+    def engine(self):
+        return "api" if self.module.startswith("inference.api.") else "vllm"
 
+    def load_handler(self):
+        """Import and return the handler class."""
+        module_name, class_name = self.handler.split(":")
+        return getattr(importlib.import_module(module_name), class_name)
 
-MODEL_TO_SHORT_NAME = {
+    @property
+    def template(self):
+        """Chat template of a local handler (None for API models)."""
+        return self.load_handler().template_name if self.engine != "api" else None
+
+    @property
+    def tool_parser(self):
+        """
+        Key of inference.tool_parsers.TOOL_PARSERS for the model's raw text: the local
+        handler's tool_parser, or "repr" for API models (outputs saved as SDK reprs by earlier versions).
+        """
+        return self.load_handler().tool_parser if self.engine != "api" else "repr"
+
+
+# Model code -> Model_Spec. Prices are list prices at the time of writing; override them with --input_price/--output_price
+MODELS = {
     # API models
-    "gpt-4.1-mini-2025-04-14-FC": "gpt-4.1-mini",
-    "gpt-4.1-nano-2025-04-14-FC": "gpt-4.1-nano",
-    "gpt-4.1-2025-04-14-FC": "gpt-4.1",
-    "gpt-4o-mini-2024-07-18-FC": "gpt-4o-mini",
-    "gpt-4o-2024-11-20-FC": "gpt-4o",
-    "o3-2025-04-16-FC": "o3",
-    "o4-mini-2025-04-16-FC": "o4-mini",
-    "command-r": "command-r",
-    "command-r-plus": "command-r-plus",
-    "command-a": "command-a",
-    "deepseek-chat": "deepseek-chat",
+    "gpt-4.1-mini-2025-04-14-FC": Model_Spec("inference.api.openai:OpenAI_Handler", "gpt-4.1-mini", context_window=1047576, input_price=0.4, output_price=1.6, cached_input_price=0.1),
+    "gpt-4.1-nano-2025-04-14-FC": Model_Spec("inference.api.openai:OpenAI_Handler", "gpt-4.1-nano", context_window=1047576, input_price=0.1, output_price=0.4, cached_input_price=0.025),
+    "gpt-4.1-2025-04-14-FC": Model_Spec("inference.api.openai:OpenAI_Handler", "gpt-4.1", context_window=1047576, input_price=2.0, output_price=8.0, cached_input_price=0.5),
+    "gpt-4o-mini-2024-07-18-FC": Model_Spec("inference.api.openai:OpenAI_Handler", "gpt-4o-mini", context_window=128000, input_price=0.15, output_price=0.6, cached_input_price=0.075),
+    "gpt-4o-2024-11-20-FC": Model_Spec("inference.api.openai:OpenAI_Handler", "gpt-4o", context_window=128000, input_price=2.5, output_price=10.0, cached_input_price=1.25),
+    "o3-2025-04-16-FC": Model_Spec("inference.api.openai:OpenAI_Handler", "o3", context_window=200000, input_price=2.0, output_price=8.0, cached_input_price=0.5),
+    "o4-mini-2025-04-16-FC": Model_Spec("inference.api.openai:OpenAI_Handler", "o4-mini", context_window=200000, input_price=1.1, output_price=4.4, cached_input_price=0.275),
+    "command-r": Model_Spec("inference.api.cohere:Cohere_Handler", "command-r", context_window=128000, input_price=0.15, output_price=0.6),
+    "command-r-plus": Model_Spec("inference.api.cohere:Cohere_Handler", "command-r-plus", context_window=128000, input_price=2.5, output_price=10.0),
+    "command-a": Model_Spec("inference.api.cohere:Cohere_Handler", "command-a", context_window=256000, input_price=2.5, output_price=10.0),
+    "deepseek-chat": Model_Spec("inference.api.deepseek:DeepSeek_Handler", "deepseek-chat", context_window=64000, input_price=0.27, output_price=1.1, cached_input_price=0.07),
 
     # Local models
-    "meta-llama/Llama-3.1-8B-Instruct": "Llama-3.1-8B",
-    "meta-llama/Llama-3.2-3B-Instruct": "Llama-3.2-3B",
-    "Qwen/Qwen3-8B": "Qwen-3-8B\n(no reasoning)",
-    "Qwen/Qwen3-8B-reason": "Qwen-3-8B\n(with reasoning)",
-    "Qwen/Qwen2.5-7B-Instruct": "Qwen-2.5-7B",
-    "mistralai/Ministral-8B-Instruct-2410": "Ministral-8B",
-    "deepseek-ai/DeepSeek-R1-Distill-Qwen-7B": "DeepSeek-R1-Distill-Qwen-7B",
-    "deepseek-ai/DeepSeek-R1-Distill-Llama-8B": "DeepSeek-R1-Distill-Llama-8B",
+    "meta-llama/Llama-3.1-8B-Instruct": Model_Spec("inference.local.llama3_1:Llama3_1_Handler", "Llama-3.1-8B", context_window=131072),
+    "meta-llama/Llama-3.2-3B-Instruct": Model_Spec("inference.local.llama3_2:Llama3_2_Handler", "Llama-3.2-3B", context_window=131072),
+    "Qwen/Qwen3-8B": Model_Spec("inference.local.qwen3:Qwen3_Handler", "Qwen-3-8B\n(no reasoning)", context_window=32768),
+    "Qwen/Qwen3-8B-reason": Model_Spec("inference.local.qwen3_reason:Qwen3_Handler", "Qwen-3-8B\n(with reasoning)", context_window=32768),
+    "Qwen/Qwen2.5-7B-Instruct": Model_Spec("inference.local.qwen2_5:Qwen2_5_Handler", "Qwen-2.5-7B", context_window=32768),
+    "mistralai/Ministral-8B-Instruct-2410": Model_Spec("inference.local.ministral:Ministral_Handler", "Ministral-8B", context_window=32768),
+    "deepseek-ai/DeepSeek-R1-Distill-Qwen-7B": Model_Spec("inference.local.deepseek_distill_qwen:DeepSeek_distill_Qwen_Handler", "DeepSeek-R1-Distill-Qwen-7B", context_window=131072),
+    "deepseek-ai/DeepSeek-R1-Distill-Llama-8B": Model_Spec("inference.local.deepseek_distill_llama:DeepSeek_Distill_Llama_Handler", "DeepSeek-R1-Distill-Llama-8B", context_window=131072),
 
 }
+
+# Derived views kept for existing callers
+MODEL_TO_HANDLER = {model: spec.handler_name for model, spec in MODELS.items()}
+MODEL_TO_SHORT_NAME = {model: spec.short_name for model, spec in MODELS.items()}
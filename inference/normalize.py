@@ -0,0 +1,128 @@
+from inference.sys_pmts import NAIVE, RULE
+
+SYS_PROMPT_SUFFIX = {"none": "", "naive": NAIVE, "rule": RULE}
+TIME_ELAPSED_LEVELS = (0, 1, 2)
+
+
+def get_sys_prompt_mode(use_special_sys_prompt_naive=False, use_special_sys_prompt_rule=False):
+    """Map the handlers' special system prompt flags to one of 'none', 'naive' or 'rule'."""
+    if use_special_sys_prompt_naive:
+        return "naive"
+    if use_special_sys_prompt_rule:
+        return "rule"
+    return "none"
+
+
+class Normalized_History:
+    """
+    A trajectory walked once, from which the chat messages for any prompt variant
+    (time elapsed level x time stamp on/off x system prompt mode) are built on demand.
+    Message dicts that do not change between variants are shared between them, so the
+    returned messages must be treated as read-only.
+    """
+    def __init__(self, history):
+        self.history = history
+        self.entries = []
+        for msg in history:
+            times = msg['time'] if type(msg['time']) is not str else (msg['time'],) * len(TIME_ELAPSED_LEVELS)
+            self.entries.append((
+                msg["role"],
+                msg.get("content") if "tool_calls" not in msg else None,
+                tuple(times),
+                msg.get("tool_calls"),
+                msg.get("tool_call_id") if msg["role"] == "tool" else None,
+            ))
+        self._messages = {}
+        self._variants = {}
+
+    def _message(self, index, time_string, sys_prompt, null_tool_call_content):
+        key = (index, time_string, sys_prompt, null_tool_call_content)
+        m = self._messages.get(key)
+        if m is None:
+            role, content, _, tool_calls, tool_call_id = self.entries[index]
+            m = {"role": role}
+            if content is not None:
+                m["content"] = f"[{time_string}] " + content if time_string is not None else content
+                if role == "system":
+                    m["content"] = m["content"] + SYS_PROMPT_SUFFIX[sys_prompt]
+            if tool_calls is not None:
+                m["tool_calls"] = tool_calls
+                if null_tool_call_content:
+                    m["content"] = None
+            if tool_call_id is not None:
+                m["tool_call_id"] = tool_call_id
+            self._messages[key] = m
+        return m
+
+    def messages(self, time_elapsed_level=0, use_time_stamp=False, sys_prompt="none", null_tool_call_content=False):
+        """
+        Chat messages for one prompt variant.
+        Args:
+            time_elapsed_level: Which entry of a message's 'time' list to use
+            use_time_stamp: Whether to prefix message contents with [time]
+            sys_prompt: 'none', 'naive' or 'rule', appended to the system message
+            null_tool_call_content: Set content to None on assistant tool call messages (chat templates) instead of omitting it (APIs)
+        Returns:
+            List of message dicts
+        """
+        if not use_time_stamp:
+            # Without time stamps every elapse level renders the same messages
+            time_elapsed_level = 0
+        key = (time_elapsed_level, use_time_stamp, sys_prompt, null_tool_call_content)
+        messages = self._variants.get(key)
+        if messages is None:
+            messages = [
+                self._message(i, entry[2][time_elapsed_level] if use_time_stamp else None, sys_prompt if entry[0] == "system" else "none", null_tool_call_content)
+                for i, entry in enumerate(self.entries)
+            ]
+            self._variants[key] = messages
+        return messages
+
+    def variants(self, null_tool_call_content=False):
+        """
+        Chat messages for every prompt variant.
+        Returns:
+            Dict keyed by (time_elapsed_level, use_time_stamp, sys_prompt)
+        """
+        return {
+            (level, use_time_stamp, sys_prompt): self.messages(level, use_time_stamp, sys_prompt, null_tool_call_content)
+            for level in TIME_ELAPSED_LEVELS
+            for use_time_stamp in (False, True)
+            for sys_prompt in SYS_PROMPT_SUFFIX
+        }
+
+
+def normalize_history(history):
+    """Wrap a raw history list in a Normalized_History, passing already normalized histories through."""
+    if isinstance(history, Normalized_History):
+        return history
+    return Normalized_History(history)
+
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def parse_time(time_string):
+    from datetime import datetime, timezone
+    return datetime.fromisoformat(time_string.replace("Z", "+00:00")).astimezone(timezone.utc)
+
+
+def shift_final_user_turn(history, elapsed_seconds):
+    """
+    Counterfactual copy of a raw history in which the final user turn is sent elapsed_seconds
+    after the message before it. The shifted time replaces the turn's per-level time list, so
+    every time_elapsed_level renders it the same way; all other messages are shared with history.
+    Args:
+        history: List of message dicts with 'time' (a string, or a list with one entry per elapse level)
+        elapsed_seconds: Time between the previous message and the final user turn
+    Returns:
+        List of message dicts
+    """
+    from datetime import timedelta
+    index = max(i for i, msg in enumerate(history) if msg["role"] == "user")
+    if index == 0:
+        raise ValueError("The final user turn has no previous message to measure elapsed time from.")
+    previous = history[index - 1]["time"]
+    previous = previous if type(previous) is str else previous[0]
+    shifted = dict(history[index], time=(parse_time(previous) + timedelta(seconds=elapsed_seconds)).strftime(TIME_FORMAT))
+    return history[:index] + [shifted] + history[index + 1:]
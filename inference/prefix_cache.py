@@ -0,0 +1,49 @@
+def order_by_shared_prefix(prompts):
+    """
+    Order prompts so that prompts sharing a rendered prefix are sent back-to-back.
+    Sorting the rendered strings places every group of prompts with a common prefix
+    next to each other (the system prompt and tool block first, then the shared turns),
+    so vllm's prefix cache still holds those blocks when the next prompt is scheduled.
+    Args:
+        prompts: List of formatted prompt strings
+    Returns:
+        List of indices into prompts, in submission order
+    """
+    return sorted(range(len(prompts)), key=prompts.__getitem__)
+
+
+def shared_prefix_len(a, b):
+    """Length of the common prefix of two token id sequences."""
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def prefix_cache_stats(outputs, block_size=16):
+    """
+    Compute prefix cache hit statistics from vllm request outputs.
+    Uses the per-request num_cached_tokens reported by vllm when available, and otherwise
+    estimates it from the full blocks shared with the previously submitted prompt.
+    Args:
+        outputs: List of vllm RequestOutput, in submission order
+        block_size: KV cache block size used for the estimate
+    Returns:
+        Dict with prompt_tokens, cached_tokens and hit_rate
+    """
+    prompt_tokens = 0
+    cached_tokens = 0
+    previous = None
+    for output in outputs:
+        token_ids = output.prompt_token_ids or []
+        prompt_tokens += len(token_ids)
+        num_cached = getattr(output, "num_cached_tokens", None)
+        if num_cached is None:
+            num_cached = 0
+            if previous is not None:
+                num_cached = shared_prefix_len(previous, token_ids) // block_size * block_size
+        cached_tokens += num_cached
+        previous = token_ids
+    hit_rate = cached_tokens / prompt_tokens if prompt_tokens > 0 else 0
+    return {"prompt_tokens": prompt_tokens, "cached_tokens": cached_tokens, "hit_rate": hit_rate}
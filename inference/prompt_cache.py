@@ -0,0 +1,160 @@
+import hashlib
+import inspect
+import json
+import mmap
+import os
+import sqlite3
+import sys
+from array import array
+
+
+def _hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8") if isinstance(part, str) else part)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def render_identity(handler, config):
+    """
+    Everything besides the sample that determines a rendered prompt: the handler, the contents
+    of its template, the source of its build_prompt_context (so changed defaults invalidate the
+    cache), the message normalization and system prompt texts it builds on (inference.normalize
+    and inference.sys_pmts, both their source and the suffixes in use) and the format_input settings.
+    """
+    from inference import normalize, sys_pmts
+    from inference.templates import TEMPLATE_DIR
+    with open(os.path.join(TEMPLATE_DIR, handler.template_name), "rb") as f:
+        template_hash = hashlib.sha256(f.read()).hexdigest()
+    source_hash = _hash(inspect.getsource(type(handler).build_prompt_context))
+    normalize_hash = _hash(inspect.getsource(normalize), inspect.getsource(sys_pmts),
+                           json.dumps(normalize.SYS_PROMPT_SUFFIX, sort_keys=True), normalize.TIME_FORMAT)
+    return _hash(json.dumps({
+        "handler": type(handler).__name__, "version": handler.version, "template": handler.template_name,
+        "template_hash": template_hash, "source_hash": source_hash, "normalize_hash": normalize_hash, "config": config,
+    }, sort_keys=True, default=str))
+
+
+def make_prompt_key(identity, sample):
+    """Key of one sample's rendered prompt under a render_identity."""
+    history = sample["history"]
+    # Normalized histories keep the raw message list they were built from
+    history = getattr(history, "history", history)
+    return _hash(identity, json.dumps([history, sample.get("function")], sort_keys=True, ensure_ascii=False, default=str))
+
+
+def tokenizer_fingerprint(tokenizer):
+    """Hash of a tokenizer's full definition (vocabulary, merges, special tokens, post-processing) when available."""
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        return _hash(type(tokenizer).__name__, backend.to_str())
+    return _hash(type(tokenizer).__name__, str(getattr(tokenizer, "name_or_path", "")), str(len(getattr(tokenizer, "vocab", ()) or ())))
+
+
+def make_token_key(fingerprint, prompt):
+    """Key of a prompt's token ids under a tokenizer_fingerprint."""
+    return _hash(fingerprint, prompt)
+
+
+class Prompt_Cache:
+    """
+    On-disk cache of rendered prompts and their token ids, for local runs that render and
+    tokenize the same prompts again. The data is appended to two flat files, prompts.bin
+    (UTF-8 text) and tokens.bin (little-endian uint32 token ids), that are memory-mapped for
+    reading; a SQLite index maps each key to its offset and length. Entries are never
+    rewritten, so a stale entry simply stops being looked up once its key changes.
+    """
+    TABLES = {"prompts": "prompts.bin", "tokens": "tokens.bin"}
+
+    def __init__(self, directory):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.hits = {table: 0 for table in self.TABLES}
+        self.misses = {table: 0 for table in self.TABLES}
+        self.maps = {}
+        self.conn = sqlite3.connect(os.path.join(directory, "index.db"), timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        for table in self.TABLES:
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, offset INTEGER NOT NULL, length INTEGER NOT NULL)")
+
+    def _view(self, table, end):
+        """Read-only memory map of a table's data file covering at least end bytes (remapped as the file grows)."""
+        view = self.maps.get(table)
+        if view is None or len(view) < end:
+            if view is not None:
+                view.close()
+            with open(os.path.join(self.directory, self.TABLES[table]), "rb") as f:
+                view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[table] = view
+        return view
+
+    def _get_many(self, table, keys):
+        locations = {}
+        unique_keys = list(dict.fromkeys(keys))
+        for i in range(0, len(unique_keys), 500):
+            chunk = unique_keys[i:i + 500]
+            rows = self.conn.execute(f"SELECT key, offset, length FROM {table} WHERE key IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+            locations.update((key, (offset, length)) for key, offset, length in rows)
+        self.hits[table] += sum(1 for key in keys if key in locations)
+        self.misses[table] += sum(1 for key in keys if key not in locations)
+        if not locations:
+            return {}
+        view = self._view(table, max(offset + length for offset, length in locations.values()))
+        return {key: view[offset:offset + length] for key, (offset, length) in locations.items()}
+
+    def _put_many(self, table, items):
+        items = dict(items)
+        if not items:
+            return
+        # The write lock on the index serializes appends from concurrent processes; the data is
+        # written before the index rows that point to it, so a crash leaves no dangling entry
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = []
+            with open(os.path.join(self.directory, self.TABLES[table]), "ab") as f:
+                offset = f.seek(0, os.SEEK_END)
+                for key, blob in items.items():
+                    f.write(blob)
+                    rows.append((key, offset, len(blob)))
+                    offset += len(blob)
+            self.conn.executemany(f"INSERT OR IGNORE INTO {table} (key, offset, length) VALUES (?, ?, ?)", rows)
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def get_prompts(self, keys):
+        """Return {key: rendered prompt} for the keys found in the cache."""
+        return {key: blob.decode("utf-8") for key, blob in self._get_many("prompts", keys).items()}
+
+    def put_prompts(self, items):
+        """Store (key, rendered prompt) pairs."""
+        self._put_many("prompts", ((key, prompt.encode("utf-8")) for key, prompt in items))
+
+    def get_token_ids(self, keys):
+        """Return {key: list of token ids} for the keys found in the cache."""
+        found = {}
+        for key, blob in self._get_many("tokens", keys).items():
+            ids = array("I", blob)
+            if sys.byteorder == "big":
+                ids.byteswap()
+            found[key] = ids.tolist()
+        return found
+
+    def put_token_ids(self, items):
+        """Store (key, token ids) pairs."""
+        def pack(token_ids):
+            ids = array("I", token_ids)
+            if sys.byteorder == "big":
+                ids.byteswap()
+            return ids.tobytes()
+        self._put_many("tokens", ((key, pack(token_ids)) for key, token_ids in items))
+
+    def summary(self):
+        sizes = {table: os.path.getsize(os.path.join(self.directory, file)) if os.path.exists(os.path.join(self.directory, file)) else 0
+                 for table, file in self.TABLES.items()}
+        return (f"Prompt cache: rendered prompts {self.hits['prompts']} hits, {self.misses['prompts']} misses; "
+                f"token ids {self.hits['tokens']} hits, {self.misses['tokens']} misses "
+                f"({sum(sizes.values()) / 2 ** 20:.1f} MB) in {self.directory}")
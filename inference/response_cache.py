@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+
+def make_cache_key(identity, formatted):
+    """
+    Content hash of one request.
+    Args:
+        identity: Dict describing everything besides the payload that determines the output (handler, version, model, sampling params)
+        formatted: The formatted request as produced by format_input (prompt string or API payload dict)
+    Returns:
+        Hex digest
+    """
+    blob = json.dumps({"identity": identity, "request": formatted}, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class Response_Cache:
+    """
+    On-disk cache of model outputs keyed by make_cache_key, stored in SQLite.
+    When the stored outputs exceed max_bytes the least recently used entries are evicted.
+    Writes are buffered and committed flush_size at a time (and on flush, get_many and summary);
+    the total size is kept up to date by triggers in a one-row table, so eviction checks do not
+    scan the table.
+    """
+    def __init__(self, path, max_bytes=None, flush_size=64):
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.path = path
+        self.max_bytes = max_bytes
+        self.flush_size = flush_size
+        self.hits = 0
+        self.misses = 0
+        self.pending = {}
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses_size (id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER NOT NULL)")
+        # Caches created before the size table get it filled once
+        self.conn.execute("INSERT OR IGNORE INTO responses_size (id, total) SELECT 0, COALESCE(SUM(size), 0) FROM responses")
+        self.conn.execute("CREATE TRIGGER IF NOT EXISTS responses_insert AFTER INSERT ON responses BEGIN UPDATE responses_size SET total = total + NEW.size; END")
+        self.conn.execute("CREATE TRIGGER IF NOT EXISTS responses_update AFTER UPDATE OF size ON responses BEGIN UPDATE responses_size SET total = total + NEW.size - OLD.size; END")
+        self.conn.execute("CREATE TRIGGER IF NOT EXISTS responses_delete AFTER DELETE ON responses BEGIN UPDATE responses_size SET total = total - OLD.size; END")
+        self.conn.commit()
+
+    def get_many(self, keys):
+        """Return {key: output} for the keys found in the cache, and count hits and misses."""
+        self.flush()
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        for i in range(0, len(unique_keys), 500):
+            chunk = unique_keys[i:i + 500]
+            rows = self.conn.execute(f"SELECT key, value FROM responses WHERE key IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+            found.update((key, json.loads(value)) for key, value in rows)
+        if found:
+            now = time.time()
+            self.conn.executemany("UPDATE responses SET last_access = ? WHERE key = ?", [(now, key) for key in found])
+            self.conn.commit()
+        self.hits += sum(1 for key in keys if key in found)
+        self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def put_many(self, items):
+        """Buffer (key, output) pairs; they are written once flush_size of them are pending."""
+        for key, output in items:
+            self.pending[key] = output
+        if len(self.pending) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """Write the pending outputs in one transaction, then evict down to max_bytes."""
+        if not self.pending:
+            return
+        now = time.time()
+        rows = []
+        for key, output in self.pending.items():
+            value = json.dumps(output, ensure_ascii=False)
+            rows.append((key, value, len(value.encode("utf-8")), now))
+        # An upsert rather than INSERT OR REPLACE, whose implicit delete would not fire the size trigger
+        self.conn.executemany("INSERT INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?) "
+                              "ON CONFLICT (key) DO UPDATE SET value = excluded.value, size = excluded.size, last_access = excluded.last_access", rows)
+        self.conn.commit()
+        self.pending = {}
+        self.evict()
+
+    def total_bytes(self):
+        return self.conn.execute("SELECT total FROM responses_size").fetchone()[0]
+
+    def evict(self):
+        if self.max_bytes is None:
+            return
+        excess = self.total_bytes() - self.max_bytes
+        if excess <= 0:
+            return
+        freed = 0
+        stale = []
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            stale.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+        self.conn.commit()
+
+    def summary(self):
+        self.flush()
+        entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return (f"Response cache: {self.hits} hits, {self.misses} misses, "
+                f"{entries} entries ({self.total_bytes() / 2 ** 20:.1f} MB) in {self.path}")
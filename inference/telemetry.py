@@ -0,0 +1,169 @@
+import asyncio
+import json
+import os
+from datetime import datetime, timezone
+
+ERROR_TYPES = ("rate_limit", "server", "timeout", "connection", "deadline", "context_length", "bad_request", "auth", "not_found", "invalid_response", "other")
+
+
+def classify_error(e):
+    """
+    Error type of a failed request, one of ERROR_TYPES: the HTTP status when the SDK exposes one,
+    otherwise the kind of exception. Requests rejected for their length are told apart from
+    other bad requests by the provider's message.
+    """
+    from inference.api_engine import get_status_code
+    status = get_status_code(e)
+    name = type(e).__name__
+    if status == 429:
+        return "rate_limit"
+    if status in (401, 403):
+        return "auth"
+    if status == 404:
+        return "not_found"
+    if status in (400, 413, 422):
+        message = str(e).lower()
+        if any(phrase in message for phrase in ("context length", "context_length", "context window", "maximum context", "too many tokens", "too long")):
+            return "context_length"
+        return "bad_request"
+    if status is not None and status >= 500:
+        return "server"
+    if status == 408 or isinstance(e, asyncio.TimeoutError) or "Timeout" in name:
+        return "timeout"
+    if isinstance(e, ConnectionError) or "Connection" in name:
+        return "connection"
+    return "other"
+
+
+def request_cost(usage, input_price, output_price, cached_input_price=None):
+    """
+    USD cost of one request from its usage, or None when the prices or the usage are unknown.
+    Cached prompt tokens are billed at cached_input_price (input_price if not given); reasoning
+    tokens are part of completion_tokens and billed as output.
+    """
+    if not usage or input_price is None or output_price is None:
+        return None
+    prompt_tokens = usage.get("prompt_tokens") or 0
+    cached_tokens = usage.get("cached_tokens") or 0
+    cached_price = cached_input_price if cached_input_price is not None else input_price
+    return ((prompt_tokens - cached_tokens) * input_price + cached_tokens * cached_price + (usage.get("completion_tokens") or 0) * output_price) / 1e6
+
+
+class Telemetry_Trace:
+    """
+    Per-request trace of an API run, appended to a JSONL file as requests finish. Each line has
+    the request's wall-clock start and end, time spent waiting for the rate limits and the
+    concurrency limit (queue_wait) and in backoff, the latency of its last attempt, the number
+    of retries, prompt/completion/cached/reasoning tokens, cost, and the error type of each failed
+    attempt, and whether the request was hedged and the hedge answered first. Lines carry the
+    run's start time, so a resumed run appends to the same file.
+    """
+    def __init__(self, path, model=None, input_price=None, output_price=None, cached_input_price=None):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.model = model
+        self.input_price = input_price
+        self.output_price = output_price
+        self.cached_input_price = cached_input_price
+        self.run = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        self.records = []
+        self.file = open(path, "a", encoding="utf-8")
+
+    def record(self, index, start, end, result, queue_wait=0.0, latency=None, backoff=0.0, retries=0, attempt_errors=(), error_type=None, hedged=False, hedge_won=False):
+        """
+        Add one finished request.
+        Args:
+            index: Position of the request in the engine run
+            start, end: Wall-clock time the request was queued and finished (seconds since the epoch)
+            result: The request's output record, or "[ERROR]: ..." string
+            queue_wait: Seconds spent waiting for rate and concurrency limits, over all attempts
+            latency: Seconds of the last attempt's API call
+            backoff: Seconds slept between attempts
+            retries: Number of attempts after the first
+            attempt_errors: Error type of each failed attempt
+            error_type: Error type of the request if it failed
+            hedged: Whether a duplicate of the request was sent after it ran past the hedging threshold
+            hedge_won: Whether the duplicate answered first
+        """
+        usage = result.get("usage") if isinstance(result, dict) else None
+        failed = not isinstance(result, dict) or result.get("decision") == "error"
+        if failed and error_type is None:
+            error_type = "invalid_response" if isinstance(result, dict) else "other"
+        record = {
+            "run": self.run, "model": self.model, "index": index,
+            "start": round(start, 3), "end": round(end, 3), "queue_wait": round(queue_wait, 3),
+            "latency": round(latency, 3) if latency is not None else None, "backoff": round(backoff, 3), "retries": retries,
+            "status": "error" if failed else "ok", "error_type": error_type if failed else None, "attempt_errors": list(attempt_errors),
+            "hedged": hedged, "hedge_won": hedge_won,
+            "prompt_tokens": (usage or {}).get("prompt_tokens"), "completion_tokens": (usage or {}).get("completion_tokens"),
+            "cached_tokens": (usage or {}).get("cached_tokens"), "reasoning_tokens": (usage or {}).get("reasoning_tokens"),
+            "cost": request_cost(usage, self.input_price, self.output_price, self.cached_input_price),
+        }
+        self.records.append(record)
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def summary(self):
+        """
+        Summary of the requests traced in this run.
+        Returns:
+            Dict with request and error counts (errors and failed attempts by type), latency and
+            queue wait percentiles of successful requests, hedged requests, throughput over the
+            run's wall time, token totals and spend
+        """
+        from inference.forecast import percentile
+        records = self.records
+        ok = [record for record in records if record["status"] == "ok"]
+        latencies = sorted(record["latency"] for record in ok if record["latency"] is not None)
+        queue_waits = sorted(record["queue_wait"] for record in ok)
+        wall = max((record["end"] for record in records), default=0) - min((record["start"] for record in records), default=0)
+        errors = {}
+        attempt_errors = {}
+        for record in records:
+            if record["error_type"] is not None:
+                errors[record["error_type"]] = errors.get(record["error_type"], 0) + 1
+            for error_type in record["attempt_errors"]:
+                attempt_errors[error_type] = attempt_errors.get(error_type, 0) + 1
+        tokens = {key: sum(record[key] or 0 for record in records) for key in ("prompt_tokens", "completion_tokens", "cached_tokens", "reasoning_tokens")}
+        costs = [record["cost"] for record in records if record["cost"] is not None]
+        return {
+            "num_requests": len(records),
+            "num_ok": len(ok),
+            "errors": errors,
+            "attempt_errors": attempt_errors,
+            "retries": sum(record["retries"] for record in records),
+            "hedged": sum(1 for record in records if record.get("hedged")),
+            "hedge_wins": sum(1 for record in records if record.get("hedge_won")),
+            "latency": {f"p{q}": percentile(latencies, q) for q in (50, 95, 99)},
+            "queue_wait": {f"p{q}": percentile(queue_waits, q) for q in (50, 95, 99)},
+            "wall_seconds": wall,
+            "requests_per_second": len(ok) / wall if wall > 0 else None,
+            "output_tokens_per_second": tokens["completion_tokens"] / wall if wall > 0 else None,
+            "tokens": tokens,
+            "cost": sum(costs) if costs else None,
+        }
+
+    def format_summary(self):
+        summary = self.summary()
+        lines = [f"Telemetry: {summary['num_ok']} of {summary['num_requests']} requests succeeded in {summary['wall_seconds']:.1f}s, {summary['retries']} retries"]
+        if summary["errors"]:
+            lines.append("  Errors: " + ", ".join(f"{error_type} {count}" for error_type, count in sorted(summary["errors"].items(), key=lambda item: -item[1])))
+        if summary["attempt_errors"]:
+            lines.append("  Failed attempts: " + ", ".join(f"{error_type} {count}" for error_type, count in sorted(summary["attempt_errors"].items(), key=lambda item: -item[1])))
+        lines.append("  Latency: " + ", ".join(f"{q} {value:.2f}s" for q, value in summary["latency"].items())
+                     + "; queue wait: " + ", ".join(f"{q} {value:.2f}s" for q, value in summary["queue_wait"].items()))
+        if summary["hedged"]:
+            lines.append(f"  Hedged: {summary['hedged']} requests ({summary['hedged'] / max(1, summary['num_requests']):.1%}), the duplicate answered first for {summary['hedge_wins']}")
+        if summary["requests_per_second"] is not None:
+            lines.append(f"  Throughput: {summary['requests_per_second']:.2f} requests/s, {summary['output_tokens_per_second']:.0f} output tokens/s")
+        tokens = summary["tokens"]
+        lines.append(f"  Tokens: {tokens['prompt_tokens']} prompt ({tokens['cached_tokens']} cached), {tokens['completion_tokens']} completion ({tokens['reasoning_tokens']} reasoning)")
+        if summary["cost"] is not None:
+            lines.append(f"  Spend: ${summary['cost']:.4f} (${summary['cost'] / max(1, summary['num_requests']):.6f} per request)")
+        lines.append(f"  Trace: {self.path}")
+        return "\n".join(lines)
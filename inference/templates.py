@@ -0,0 +1,64 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from jinja2 import Environment, FileSystemLoader
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../templates')
+
+
+@lru_cache(maxsize=None)
+def get_environment():
+    """The process-wide Jinja environment for templates/*.jinja."""
+    return Environment(loader=FileSystemLoader(TEMPLATE_DIR), trim_blocks=True, lstrip_blocks=True, auto_reload=False)
+
+
+@lru_cache(maxsize=None)
+def get_template(template_name):
+    """Load and compile a chat template once per process."""
+    return get_environment().get_template(template_name)
+
+
+def render_template(template_name, context):
+    """Render one prompt from a dict of template variables."""
+    return get_template(template_name).render(**context)
+
+
+def _render_chunk(template_name, contexts):
+    rendered = []
+    for context in contexts:
+        try:
+            rendered.append(render_template(template_name, context))
+        except Exception as e:
+            rendered.append(e)
+    return rendered
+
+
+_pools = {}
+
+
+def get_pool(num_workers):
+    """Process pool kept for the lifetime of the process, so repeated render_many calls do not respawn workers."""
+    if num_workers not in _pools:
+        _pools[num_workers] = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn"))
+    return _pools[num_workers]
+
+
+def render_many(template_name, contexts, num_workers=1, chunksize=64):
+    """
+    Render many prompts with the same template, optionally across a process pool.
+    Workers are spawned rather than forked so this is safe after the engine has been
+    started, and each worker compiles the template once.
+    Args:
+        template_name: File name of the template under templates/
+        contexts: List of dicts of template variables
+        num_workers: Number of worker processes (1 renders in this process)
+        chunksize: Number of prompts sent to a worker at a time
+    Returns:
+        List of rendered prompt strings, with the exception in place of any prompt that failed to render
+    """
+    if num_workers <= 1 or len(contexts) <= chunksize:
+        return _render_chunk(template_name, contexts)
+    chunks = [contexts[i:i + chunksize] for i in range(0, len(contexts), chunksize)]
+    results = get_pool(num_workers).map(_render_chunk, [template_name] * len(chunks), chunks)
+    return [rendered for chunk in results for rendered in chunk]
@@ -0,0 +1,226 @@
+import ast
+import json
+import re
+
+
+def make_record(decision, tool_calls=None, text="", finish_reason=None, usage=None, parse_error=None):
+    """
+    Structured output record saved for every sample.
+    Args:
+        decision: "tool" if the model attempted a tool call, "text" if it answered in text, "error" if the request failed
+        tool_calls: List of {"name": ..., "arguments": ...} dicts, arguments parsed from JSON
+        text: Raw generated text (or the error message)
+        finish_reason: Why generation stopped, as reported by vllm or the provider
+        usage: Dict with prompt_tokens and completion_tokens (plus cached_tokens and reasoning_tokens when the provider reports them), when known
+        parse_error: Why an attempted tool call could not be parsed
+    Returns:
+        Dict output record
+    """
+    record = {"decision": decision, "tool_calls": tool_calls or [], "text": text, "finish_reason": finish_reason, "usage": usage}
+    if parse_error is not None:
+        record["parse_error"] = parse_error
+    return record
+
+
+def error_record(message):
+    """Record for a failed request; message is kept in text with the usual [ERROR] prefix."""
+    message = str(message)
+    return make_record("error", text=message if message.startswith("[ERROR]") else f"[ERROR]: {message}")
+
+
+def is_error(output):
+    """True for failed requests, for both output records and plain string outputs of earlier versions."""
+    if isinstance(output, dict):
+        return output.get("decision") == "error"
+    return output == "" or "[ERROR]" in output
+
+
+def make_usage(prompt_tokens, completion_tokens, cached_tokens=None, reasoning_tokens=None):
+    """Usage dict; cached_tokens (prompt tokens served from the provider's cache) and reasoning_tokens (part of completion_tokens) only when reported."""
+    if prompt_tokens is None and completion_tokens is None:
+        return None
+    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+    if cached_tokens is not None:
+        usage["cached_tokens"] = cached_tokens
+    if reasoning_tokens is not None:
+        usage["reasoning_tokens"] = reasoning_tokens
+    return usage
+
+
+def make_tool_call(name, arguments):
+    """Tool call dict; arguments given as a JSON string are parsed (raises ValueError if they are not valid JSON)."""
+    if isinstance(arguments, str):
+        arguments = json.loads(arguments)
+    return {"name": name, "arguments": arguments}
+
+
+def parse_llama(text):
+    # {"name": function name, "parameters": dictionary of argument name and its value}
+    function_call = json.loads(text)
+    return [make_tool_call(function_call["name"], function_call["parameters"])]
+
+
+def parse_qwen(text):
+    # <tool_call>\n{"name": <function-name>, "arguments": <args-json-object>}\n</tool_call>, once per call
+    tool_calls = []
+    for block in text.split("<tool_call>")[1:]:
+        function_call = json.loads(block.split("</tool_call>")[0].strip())
+        tool_calls.append(make_tool_call(function_call["name"], function_call["arguments"]))
+    return tool_calls
+
+
+def parse_ministral(text):
+    # [{"name": ..., "arguments": ...}, ...]
+    return [make_tool_call(function_call["name"], function_call["arguments"]) for function_call in json.loads(text)]
+
+
+def parse_deepseek_distill(text):
+    # <｜tool▁call▁begin｜>function<｜tool▁sep｜>name\n```json\narguments\n```<｜tool▁call▁end｜>, once per call
+    tool_calls = []
+    for block in text.split("<｜tool▁call▁begin｜>")[1:]:
+        block = block.split("<｜tool▁call▁end｜>")[0].split("<｜tool▁sep｜>", 1)[1]
+        name, arguments = block.split("```json", 1)
+        tool_calls.append(make_tool_call(name.strip(), arguments.strip().rstrip("`").strip()))
+    return tool_calls
+
+
+_REPR_FIELD = re.compile(r"""\b(name|arguments)=('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")""")
+
+
+def parse_repr(text):
+    """
+    Tool calls from the str() of an SDK tool call list, as saved by earlier versions of the API
+    handlers (OpenAI ChatCompletionMessage(Function)ToolCall and Cohere ToolCallV2). Only the
+    quoted name/arguments string literals are read; nothing is evaluated.
+    """
+    tool_calls = []
+    fields = {}
+    for key, literal in _REPR_FIELD.findall(text):
+        fields[key] = ast.literal_eval(literal)
+        if len(fields) == 2:
+            tool_calls.append(make_tool_call(fields["name"], fields["arguments"]))
+            fields = {}
+    if not tool_calls:
+        raise ValueError("No tool call found in output.")
+    return tool_calls
+
+
+# Parser name -> (substrings that mark a tool call attempt, parse function)
+TOOL_PARSERS = {
+    "llama": (['"name"', '"parameters"'], parse_llama),
+    "qwen": (["<tool_call>", "</tool_call>"], parse_qwen),
+    "ministral": (['"arguments"', '"name"'], parse_ministral),
+    "deepseek_distill": (["<｜tool▁call▁begin｜>", "<｜tool▁call▁end｜>"], parse_deepseek_distill),
+    "repr": (["Function("], parse_repr),
+}
+
+
+def format_tool_call(parser_name, name, arguments):
+    """A tool call in the model's native syntax, as the parser expects it (used by the fake engine)."""
+    if parser_name == "llama":
+        return json.dumps({"name": name, "parameters": arguments})
+    if parser_name == "qwen":
+        return "<tool_call>\n" + json.dumps({"name": name, "arguments": arguments}) + "\n</tool_call>"
+    if parser_name == "ministral":
+        return json.dumps([{"name": name, "arguments": arguments}])
+    if parser_name == "deepseek_distill":
+        return ("<｜tool▁calls▁begin｜><｜tool▁call▁begin｜>function<｜tool▁sep｜>" + name + "\n```json\n"
+                + json.dumps(arguments) + "\n```<｜tool▁call▁end｜><｜tool▁calls▁end｜>")
+    raise ValueError(f"No native tool call syntax for parser {parser_name}")
+
+
+# Parser name -> strings that open a tool call, used by decision-only generation
+TOOL_CALL_OPENERS = {
+    "llama": ["{", "<|python_tag|>"],
+    "qwen": ["<tool_call>"],
+    "ministral": ["[", "[TOOL_CALLS]"],
+    "deepseek_distill": ["<｜tool▁calls▁begin｜>", "<｜tool▁call▁begin｜>"],
+}
+
+# Parsers whose tool calls open the reply; the others find a call anywhere in the text
+ANCHORED_OPENERS = {"llama", "ministral"}
+
+
+def early_decision(parser_name, text, decision_chars=None):
+    """
+    Decision for partially generated text: "tool" once a tool call opener appears, "text" once
+    the reply can no longer become a tool call, None while still undecided.
+    For ANCHORED_OPENERS the opener must start the reply, so the first character that does not
+    continue an opener decides "text". The other parsers count a call anywhere in the reply (as
+    parse_tool_output does), so they only decide "text" after decision_chars characters without
+    an opener; with decision_chars None the reply is generated to the end, giving the same
+    decision as a full run.
+    """
+    text = text.lstrip()
+    openers = TOOL_CALL_OPENERS[parser_name]
+    if parser_name in ANCHORED_OPENERS:
+        if any(text.startswith(opener) for opener in openers):
+            return "tool"
+        if text and not any(opener.startswith(text) for opener in openers):
+            return "text"
+        return None
+    if any(opener in text for opener in openers):
+        return "tool"
+    if decision_chars is not None and len(text) >= decision_chars:
+        return "text"
+    return None
+
+
+def parse_tool_output(parser_name, text, finish_reason=None, usage=None):
+    """
+    Build the output record for raw generated text.
+    The output counts as a tool call attempt when it contains all of the parser's signatures;
+    if the attempt cannot be parsed, the record keeps decision "tool" with a parse_error.
+    Args:
+        parser_name: Key of TOOL_PARSERS
+        text: Raw generated text
+        finish_reason: Why generation stopped
+        usage: Dict with prompt_tokens and completion_tokens
+    Returns:
+        Dict output record
+    """
+    if text == "" or "[ERROR]" in text:
+        return error_record(text or "empty output")
+    signatures, parse = TOOL_PARSERS[parser_name]
+    if not all(signature in text for signature in signatures):
+        return make_record("text", text=text, finish_reason=finish_reason, usage=usage)
+    try:
+        return make_record("tool", parse(text), text, finish_reason, usage)
+    except Exception as e:
+        return make_record("tool", [], text, finish_reason, usage, parse_error=f"{type(e).__name__}: {e}")
+
+
+def api_record(text, tool_calls, finish_reason=None, usage=None):
+    """
+    Build the output record for a provider response.
+    Args:
+        text: Text content of the response, or None
+        tool_calls: List of (name, JSON arguments string) pairs, or None
+        finish_reason: Provider finish reason
+        usage: Dict with prompt_tokens and completion_tokens
+    Returns:
+        Dict output record
+    """
+    # A reply with both text and tool calls counts as a text answer, as the handlers always scored it
+    if text:
+        return make_record("text", text=text, finish_reason=finish_reason, usage=usage)
+    if tool_calls:
+        try:
+            return make_record("tool", [make_tool_call(name, arguments) for name, arguments in tool_calls], "", finish_reason, usage)
+        except ValueError as e:
+            return make_record("tool", [], "", finish_reason, usage, parse_error=f"{type(e).__name__}: {e}")
+    return error_record("empty response")
+
+
+def openai_record(choice, usage=None):
+    """Output record for an OpenAI-compatible chat completion choice and its response usage."""
+    message = choice.message
+    tool_calls = [(tool_call.function.name, tool_call.function.arguments) for tool_call in message.tool_calls or []]
+    if usage is not None:
+        cached_tokens = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None)
+        if cached_tokens is None:
+            # DeepSeek reports its context cache hits separately
+            cached_tokens = getattr(usage, "prompt_cache_hit_tokens", None)
+        reasoning_tokens = getattr(getattr(usage, "completion_tokens_details", None), "reasoning_tokens", None)
+        usage = make_usage(usage.prompt_tokens, usage.completion_tokens, cached_tokens=cached_tokens, reasoning_tokens=reasoning_tokens)
+    return api_record(message.content, tool_calls, choice.finish_reason, usage)
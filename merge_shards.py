@@ -0,0 +1,109 @@
+import os
+import re
+import json
+import argparse
+from utils import get_shard_config_path, save_outputs
+
+SHARD_PATTERN = re.compile(r"^(?P<base>.+)-shard(?P<index>\d+)of(?P<num_shards>\d+)\.json$")
+
+
+def find_shard_groups(output_dir):
+    """
+    Group the shard outputs under output_dir by the canonical output they belong to.
+    Returns:
+        Dict of (canonical output path, num_shards) -> {shard index: shard output path}
+    """
+    groups = {}
+    for root, _, files in os.walk(output_dir):
+        for file in sorted(files):
+            match = SHARD_PATTERN.match(file)
+            if match is None:
+                continue
+            canonical_path = os.path.join(root, match.group("base") + ".json")
+            groups.setdefault((canonical_path, int(match.group("num_shards"))), {})[int(match.group("index"))] = os.path.join(root, file)
+    return groups
+
+
+def merge_group(canonical_path, num_shards, shard_paths):
+    """
+    Merge the outputs of all shards of one run into its canonical output file.
+    Every shard must be present with its config, all shards must have run with the same
+    config, and every planned sample must have exactly one output. Outputs are written in
+    data file order.
+    Returns:
+        List of problems; the canonical file is only written when there are none
+    """
+    problems = []
+    missing = [index for index in range(num_shards) if index not in shard_paths]
+    if missing:
+        return [f"missing shards {', '.join(map(str, missing))} of {num_shards}"]
+    configs = {}
+    for index, path in shard_paths.items():
+        config_path = get_shard_config_path(path)
+        if not os.path.exists(config_path):
+            problems.append(f"shard {index} has no config {config_path}")
+            continue
+        with open(config_path, "r") as f:
+            configs[index] = json.load(f)
+    if problems:
+        return problems
+    shared = {key: value for key, value in configs[0].items() if key not in ("shard_index", "samples")}
+    for index, config in configs.items():
+        differing = sorted(key for key in set(shared) | set(config) if key not in ("shard_index", "samples") and config.get(key) != shared.get(key))
+        if differing:
+            problems.append(f"shard {index} ran with a different {', '.join(differing)} than shard 0")
+
+    positions = {}
+    outputs = {}
+    for index, path in sorted(shard_paths.items()):
+        for position, sample_id in configs[index]["samples"]:
+            if sample_id in positions:
+                problems.append(f"sample {sample_id} is planned in more than one shard")
+            positions[sample_id] = position
+        with open(path, "r") as f:
+            shard_outputs = json.load(f)
+        planned = {sample_id for _, sample_id in configs[index]["samples"]}
+        for item in shard_outputs:
+            if item["id"] in outputs:
+                problems.append(f"sample {item['id']} has more than one output (shard {index})")
+            elif item["id"] not in planned:
+                problems.append(f"sample {item['id']} in shard {index} was not planned for it")
+            outputs[item["id"]] = item["output"]
+        missing_ids = sorted(planned - {item["id"] for item in shard_outputs})
+        if missing_ids:
+            problems.append(f"shard {index} has no output for {len(missing_ids)} samples: {', '.join(missing_ids[:5])}" + (" ..." if len(missing_ids) > 5 else ""))
+    if problems:
+        return problems
+    sample_ids = sorted(outputs, key=lambda sample_id: positions[sample_id])
+    save_outputs(canonical_path, sample_ids, [outputs[sample_id] for sample_id in sample_ids])
+    return []
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the shard outputs of sharded runs (--num_shards/--shard_index or --shard) into their canonical output files.")
+    parser.add_argument("--output_dir", type=str, default="outputs", help="Directory searched (recursively) for -shard<i>of<N> outputs.")
+    parser.add_argument("--overwrite", action="store_true", help="Replace canonical output files that already exist.")
+    parser.add_argument("--remove_shards", action="store_true", help="Delete the shard outputs and configs once merged.")
+    args = parser.parse_args()
+    groups = find_shard_groups(args.output_dir)
+    if not groups:
+        print(f"No shard outputs found in {args.output_dir}")
+    failed = 0
+    for (canonical_path, num_shards), shard_paths in sorted(groups.items()):
+        if os.path.exists(canonical_path) and not args.overwrite:
+            print(f"Skipping {canonical_path}: it already exists (use --overwrite to replace it)")
+            continue
+        problems = merge_group(canonical_path, num_shards, shard_paths)
+        if problems:
+            failed += 1
+            print(f"Cannot merge {num_shards} shards into {canonical_path}:")
+            for problem in problems:
+                print(f"  - {problem}")
+            continue
+        print(f"Merged {num_shards} shards into {canonical_path}")
+        if args.remove_shards:
+            for path in shard_paths.values():
+                os.remove(path)
+                os.remove(get_shard_config_path(path))
+    if failed:
+        raise SystemExit(1)
@@ -0,0 +1,371 @@
+import argparse
+import email
+import email.policy
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils import parse_duration
+
+# Messages rendered with --use_time_stamp start with "[<time>] "
+TIME_STAMP = re.compile(r"^\[(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}Z)\] ")
+
+
+def message_text(message):
+    """Text content of an OpenAI or Cohere v2 message (a string, or a list of text parts)."""
+    content = message.get("content")
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content or ""
+
+
+def elapsed_before_last_user(messages):
+    """
+    Seconds between the time stamp of the last user message and the latest time stamp before it,
+    or None when the messages carry no time stamps.
+    """
+    from inference.normalize import parse_time
+    stamps = []
+    for message in messages:
+        match = TIME_STAMP.match(message_text(message))
+        stamps.append(parse_time(match.group(1)) if match else None)
+    last_user = max((i for i, message in enumerate(messages) if message.get("role") == "user"), default=None)
+    if last_user is None or stamps[last_user] is None:
+        return None
+    previous = next((stamp for stamp in reversed(stamps[:last_user]) if stamp is not None), None)
+    if previous is None:
+        return None
+    return (stamps[last_user] - previous).total_seconds()
+
+
+class Mock_Rules:
+    """
+    Scripted decision between calling a tool and answering in text. Requests without tools are
+    always answered in text. Otherwise, by rule:
+        tools: always call the first tool (with empty arguments)
+        text: always answer in text
+        rate: call a tool for a tool_call_rate share of requests, chosen from a hash of the messages
+        elapsed: call a tool when the final user turn comes at least elapsed_threshold seconds
+            after the message before it (from the time stamps; requests without them call a tool)
+    """
+    RULES = ("tools", "text", "rate", "elapsed")
+
+    def __init__(self, rule="tools", tool_call_rate=0.5, elapsed_threshold=3600.0):
+        if rule not in self.RULES:
+            raise ValueError(f"Unknown rule {rule}; choose from {', '.join(self.RULES)}")
+        self.rule = rule
+        self.tool_call_rate = tool_call_rate
+        self.elapsed_threshold = elapsed_threshold
+
+    def calls_tool(self, messages, tools):
+        if not tools or self.rule == "text":
+            return False
+        if self.rule == "rate":
+            digest = hashlib.sha256(json.dumps(messages, sort_keys=True).encode("utf-8")).digest()
+            return int.from_bytes(digest[:8], "big") / 2 ** 64 < self.tool_call_rate
+        if self.rule == "elapsed":
+            elapsed = elapsed_before_last_user(messages)
+            return elapsed is None or elapsed >= self.elapsed_threshold
+        return True
+
+
+class Mock_Faults:
+    """
+    Injected latency and failures. Every chat request first waits a latency drawn from
+    latency_dist with mean latency ("fixed", "uniform" on [0, 2 * latency], "exponential", or
+    "lognormal" with log standard deviation latency_sigma), then fails with a 429 (with a
+    Retry-After of retry_after seconds) with probability rate_429, with a 500, 502 or 503 with
+    probability rate_5xx, or succeeds; a slow_rate share of successful responses trickles its
+    body out over slow_seconds. Requests beyond max_in_flight concurrent ones get a 429 at once.
+    """
+    DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+    def __init__(self, latency=0.0, latency_dist="fixed", latency_sigma=0.5, rate_429=0.0, retry_after=1.0, rate_5xx=0.0,
+                 slow_rate=0.0, slow_seconds=5.0, max_in_flight=None, seed=None):
+        if latency_dist not in self.DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution {latency_dist}; choose from {', '.join(self.DISTRIBUTIONS)}")
+        self.latency = latency
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.rate_5xx = rate_5xx
+        self.slow_rate = slow_rate
+        self.slow_seconds = slow_seconds
+        self.max_in_flight = max_in_flight
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sample_latency(self):
+        if self.latency <= 0:
+            return 0.0
+        if self.latency_dist == "uniform":
+            return self.random.uniform(0, 2 * self.latency)
+        if self.latency_dist == "exponential":
+            return self.random.expovariate(1 / self.latency)
+        if self.latency_dist == "lognormal":
+            # Parameterized so that the mean is latency
+            return self.random.lognormvariate(math.log(self.latency) - self.latency_sigma ** 2 / 2, self.latency_sigma)
+        return self.latency
+
+    def draw(self):
+        """
+        Returns:
+            (latency in seconds, HTTP error status or None, seconds to trickle the response body over)
+        """
+        with self.lock:
+            latency = self.sample_latency()
+            u = self.random.random()
+            if u < self.rate_429:
+                return latency, 429, 0.0
+            if u < self.rate_429 + self.rate_5xx:
+                return latency, self.random.choice((500, 502, 503)), 0.0
+            return latency, None, self.slow_seconds if self.random.random() < self.slow_rate else 0.0
+
+
+def make_tool_call_id():
+    return f"call_{uuid.uuid4().hex[:8]}"
+
+
+def fake_chat_completion(body, rules=None):
+    """
+    Scripted OpenAI chat completion for a request body: a call of the first tool with empty
+    arguments or a text answer, as decided by rules (by default, a tool call whenever tools are given).
+    """
+    rules = rules or Mock_Rules()
+    message = {"role": "assistant", "content": None}
+    finish_reason = "tool_calls"
+    if rules.calls_tool(body.get("messages", []), body.get("tools")):
+        name = body["tools"][0]["function"]["name"]
+        message["tool_calls"] = [{"id": make_tool_call_id(), "type": "function", "function": {"name": name, "arguments": "{}"}}]
+    else:
+        message["content"] = "This is a mock response."
+        finish_reason = "stop"
+    prompt_tokens = len(json.dumps(body.get("messages", []))) // 4
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "mock"),
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 10, "total_tokens": prompt_tokens + 10,
+                  "prompt_tokens_details": {"cached_tokens": 0}, "completion_tokens_details": {"reasoning_tokens": 0}},
+    }
+
+
+def fake_cohere_chat(body, rules=None):
+    """Scripted Cohere v2 chat response for a request body, decided like fake_chat_completion."""
+    rules = rules or Mock_Rules()
+    if rules.calls_tool(body.get("messages", []), body.get("tools")):
+        name = body["tools"][0]["function"]["name"]
+        message = {"role": "assistant", "tool_plan": f"I will call {name}.",
+                   "tool_calls": [{"id": make_tool_call_id(), "type": "function", "function": {"name": name, "arguments": "{}"}}]}
+        finish_reason = "TOOL_CALL"
+    else:
+        message = {"role": "assistant", "content": [{"type": "text", "text": "This is a mock response."}]}
+        finish_reason = "COMPLETE"
+    input_tokens = len(json.dumps(body.get("messages", []))) // 4
+    tokens = {"input_tokens": input_tokens, "output_tokens": 10}
+    return {"id": uuid.uuid4().hex, "finish_reason": finish_reason, "message": message, "usage": {"billed_units": tokens, "tokens": tokens}}
+
+
+class Mock_State:
+    """Files, batches and request counters held in memory by the mock server."""
+    def __init__(self, batch_delay=1.0, rules=None, faults=None):
+        self.batch_delay = batch_delay
+        self.rules = rules or Mock_Rules()
+        self.faults = faults or Mock_Faults()
+        self.files = {}
+        self.batches = {}
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.stats = {"requests": 0, "ok": 0, "tool_calls": 0, "rate_limited": 0, "concurrency_limited": 0, "server_errors": 0, "slow": 0, "peak_in_flight": 0}
+
+    def count(self, **increments):
+        with self.lock:
+            for key, value in increments.items():
+                self.stats[key] += value
+
+    def add_file(self, content, filename, purpose):
+        file_id = f"file-{uuid.uuid4().hex}"
+        with self.lock:
+            self.files[file_id] = {
+                "content": content,
+                "meta": {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()), "filename": filename, "purpose": purpose},
+            }
+        return self.files[file_id]["meta"]
+
+    def create_batch(self, input_file_id, endpoint, completion_window):
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        batch = {
+            "id": batch_id, "object": "batch", "endpoint": endpoint, "input_file_id": input_file_id,
+            "completion_window": completion_window, "status": "validating", "created_at": int(time.time()),
+            "output_file_id": None, "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        with self.lock:
+            self.batches[batch_id] = batch
+        threading.Thread(target=self._process_batch, args=(batch_id,), daemon=True).start()
+        return batch
+
+    def _process_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        lines = [line for line in self.files[batch["input_file_id"]]["content"].decode("utf-8").splitlines() if line.strip()]
+        batch["request_counts"]["total"] = len(lines)
+        batch["status"] = "in_progress"
+        time.sleep(self.batch_delay)
+        outputs = []
+        for line in lines:
+            request = json.loads(line)
+            response = {"status_code": 200, "request_id": uuid.uuid4().hex, "body": fake_chat_completion(request["body"], self.rules)}
+            outputs.append(json.dumps({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": request["custom_id"], "response": response, "error": None}))
+            batch["request_counts"]["completed"] += 1
+        batch["output_file_id"] = self.add_file(("\n".join(outputs) + "\n").encode("utf-8"), "output.jsonl", "batch_output")["id"]
+        batch["status"] = "completed"
+        batch["completed_at"] = int(time.time())
+
+
+class Mock_Handler(BaseHTTPRequestHandler):
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, obj, status=200, headers=None, trickle=0.0):
+        data = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if trickle > 0:
+            # A slow stream: the body arrives in ten pieces spread over trickle seconds
+            step = max(1, math.ceil(len(data) / 10))
+            for start in range(0, len(data), step):
+                self.wfile.write(data[start:start + step])
+                self.wfile.flush()
+                time.sleep(trickle / 10)
+        else:
+            self.wfile.write(data)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _send_error(self, status, message, cohere=False, headers=None):
+        kind = {429: "rate_limit_error", 500: "server_error", 502: "server_error", 503: "server_error"}.get(status, "invalid_request_error")
+        self._send_json({"message": message} if cohere else {"error": {"message": message, "type": kind, "code": None}}, status=status, headers=headers)
+
+    def _serve_chat(self, body, cohere=False):
+        """Answer a chat request (OpenAI chat completions or Cohere v2 chat) after the injected latency and faults."""
+        state = self.state
+        faults = state.faults
+        with state.lock:
+            state.in_flight += 1
+            state.stats["requests"] += 1
+            state.stats["peak_in_flight"] = max(state.stats["peak_in_flight"], state.in_flight)
+            over_limit = faults.max_in_flight is not None and state.in_flight > faults.max_in_flight
+        try:
+            if over_limit:
+                state.count(concurrency_limited=1)
+                self._send_error(429, "Too many concurrent requests", cohere=cohere, headers={"Retry-After": str(faults.retry_after)})
+                return
+            latency, status, trickle = faults.draw()
+            time.sleep(latency)
+            if status == 429:
+                state.count(rate_limited=1)
+                self._send_error(429, "Rate limit reached", cohere=cohere, headers={"Retry-After": str(faults.retry_after)})
+                return
+            if status is not None:
+                state.count(server_errors=1)
+                self._send_error(status, "The server had an error while processing your request", cohere=cohere)
+                return
+            response = fake_cohere_chat(body, state.rules) if cohere else fake_chat_completion(body, state.rules)
+            called = bool(response["message"].get("tool_calls")) if cohere else bool(response["choices"][0]["message"].get("tool_calls"))
+            state.count(ok=1, tool_calls=int(called), slow=int(trickle > 0))
+            self._send_json(response, trickle=trickle)
+        finally:
+            with state.lock:
+                state.in_flight -= 1
+
+    def do_POST(self):
+        path = self.path.split("?")[0].rstrip("/")
+        body = self._read_body()
+        if path.endswith("/chat/completions"):
+            self._serve_chat(json.loads(body))
+        elif path.endswith("/v2/chat"):
+            self._serve_chat(json.loads(body), cohere=True)
+        elif path.endswith("/files"):
+            message = email.message_from_bytes(b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + body, policy=email.policy.HTTP)
+            content, filename, purpose = b"", "upload.jsonl", "batch"
+            for part in message.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                if name == "file":
+                    content, filename = part.get_payload(decode=True), part.get_filename() or filename
+                elif name == "purpose":
+                    purpose = part.get_payload(decode=True).decode("utf-8")
+            self._send_json(self.state.add_file(content, filename, purpose))
+        elif path.endswith("/batches"):
+            request = json.loads(body)
+            if request["input_file_id"] not in self.state.files:
+                self._send_json({"error": {"message": "No such file", "type": "invalid_request_error"}}, status=404)
+                return
+            self._send_json(self.state.create_batch(request["input_file_id"], request["endpoint"], request.get("completion_window", "24h")))
+        else:
+            self._send_json({"error": {"message": f"Unknown endpoint {path}", "type": "invalid_request_error"}}, status=404)
+
+    def do_GET(self):
+        parts = self.path.split("?")[0].rstrip("/").split("/")
+        if parts[-1] == "stats":
+            with self.state.lock:
+                self._send_json(dict(self.state.stats, in_flight=self.state.in_flight))
+        elif len(parts) >= 2 and parts[-2] == "batches" and parts[-1] in self.state.batches:
+            self._send_json(self.state.batches[parts[-1]])
+        elif len(parts) >= 3 and parts[-1] == "content" and parts[-3] == "files" and parts[-2] in self.state.files:
+            data = self.state.files[parts[-2]]["content"]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self._send_json({"error": {"message": f"Unknown endpoint {self.path}", "type": "invalid_request_error"}}, status=404)
+
+
+def make_server(host="127.0.0.1", port=8000, batch_delay=1.0, rules=None, faults=None):
+    """Build (but do not start) a mock server; serve it with server.serve_forever()."""
+    handler = type("Bound_Mock_Handler", (Mock_Handler,), {"state": Mock_State(batch_delay=batch_delay, rules=rules, faults=faults)})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI/DeepSeek chat completions, Cohere v2 chat, and OpenAI files and batches endpoints, with scripted answers and injected faults. "
+                                                 "Point the handlers at it with --base_url http://<host>:<port>/v1 (OpenAI, DeepSeek) or http://<host>:<port> (Cohere).")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to bind.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to bind.")
+    parser.add_argument("--batch_delay", type=float, default=1.0, help="Seconds a batch stays in progress before it completes.")
+    parser.add_argument("--rule", type=str, default="tools", choices=Mock_Rules.RULES, help="How requests with tools are answered: always a tool call, always text, a --tool_call_rate share of tool calls, or tool calls after --elapsed_threshold.")
+    parser.add_argument("--tool_call_rate", type=float, default=0.5, help="With --rule rate, share of requests answered with a tool call.")
+    parser.add_argument("--elapsed_threshold", type=str, default="1h", help="With --rule elapsed, call a tool when the final user turn comes at least this long after the message before it, e.g. 30m, 1d.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Mean seconds before each chat response.")
+    parser.add_argument("--latency_dist", type=str, default="fixed", choices=Mock_Faults.DISTRIBUTIONS, help="Distribution of the response latency.")
+    parser.add_argument("--latency_sigma", type=float, default=0.5, help="With --latency_dist lognormal, standard deviation of the log latency.")
+    parser.add_argument("--rate_429", type=float, default=0.0, help="Share of chat requests rejected with a 429.")
+    parser.add_argument("--retry_after", type=float, default=1.0, help="Retry-After seconds sent with 429s.")
+    parser.add_argument("--rate_5xx", type=float, default=0.0, help="Share of chat requests failed with a 500, 502 or 503.")
+    parser.add_argument("--slow_rate", type=float, default=0.0, help="Share of chat responses whose body is sent slowly.")
+    parser.add_argument("--slow_seconds", type=float, default=5.0, help="Seconds a slow response body takes to arrive.")
+    parser.add_argument("--max_in_flight", type=int, default=None, help="Reject chat requests beyond this many concurrent ones with a 429.")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the latency and fault draws.")
+    args = parser.parse_args()
+    rules = Mock_Rules(args.rule, tool_call_rate=args.tool_call_rate, elapsed_threshold=parse_duration(args.elapsed_threshold))
+    faults = Mock_Faults(latency=args.latency, latency_dist=args.latency_dist, latency_sigma=args.latency_sigma, rate_429=args.rate_429, retry_after=args.retry_after,
+                         rate_5xx=args.rate_5xx, slow_rate=args.slow_rate, slow_seconds=args.slow_seconds, max_in_flight=args.max_in_flight, seed=args.seed)
+    server = make_server(args.host, args.port, batch_delay=args.batch_delay, rules=rules, faults=faults)
+    print(f"Mock API server listening on http://{args.host}:{args.port}/v1 (request counters at /stats)")
+    server.serve_forever()
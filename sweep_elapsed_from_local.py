@@ -0,0 +1,141 @@
+import os
+import json
+import argparse
+from utils import iter_data, iter_chunks, parse_shard, get_data_name, parse_duration, format_elapsed, log_spaced
+from eval_from_local import get_handler
+from inference.response_cache import Response_Cache
+from inference.prompt_cache import Prompt_Cache
+from inference.normalize import shift_final_user_turn
+from inference.tool_parsers import is_error
+
+
+def get_curve_path(output_dir, model, data_path, sys_prompt, shard=None):
+    """Where the elapsed-time curve of a model on a data file is saved (next to the model's regular outputs)."""
+    model_dir = model.split('/')[-1]
+    suffix = f"-shard{shard[0]}of{shard[1]}" if shard else ""
+    sys_prompt_suffix = f"-{sys_prompt}" if sys_prompt != "none" else ""
+    return os.path.join(output_dir, model_dir, f"{model_dir}-{get_data_name(data_path)}{sys_prompt_suffix}{suffix}-elapsed_curve.json")
+
+
+def summarize_curve(grid, values):
+    """
+    Aggregate curve over samples.
+    Args:
+        grid: List of elapsed seconds
+        values: Dict of sample id -> list aligned with grid of 1/0 tool call decisions or propensities (None where the request failed)
+    Returns:
+        List of {"elapsed", "label", "tool_call_rate", "num_samples"} aligned with grid
+    """
+    curve = []
+    for j, seconds in enumerate(grid):
+        point = [sample_values[j] for sample_values in values.values() if sample_values[j] is not None]
+        curve.append({
+            "elapsed": seconds,
+            "label": format_elapsed(seconds),
+            "tool_call_rate": sum(point) / len(point) if point else None,
+            "num_samples": len(point),
+        })
+    return curve
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure a local model's tool call rate as a continuous function of the time elapsed before the final user turn.")
+    parser.add_argument("--data", type=str, default="data/preferTool_elapse_0.json", help="Path to data JSON file.")
+    parser.add_argument("--model", type=str, default="meta-llama/Llama-3.1-8B-Instruct", help="Model code (will be mapped to handler).")
+    parser.add_argument("--elapsed_min", type=str, default="1m", help="Smallest elapsed time of the grid, e.g. 30s, 1m, 2h, 1d.")
+    parser.add_argument("--elapsed_max", type=str, default="6mo", help="Largest elapsed time of the grid (a month is 30 days).")
+    parser.add_argument("--num_points", type=int, default=12, help="Number of log-spaced elapsed times from --elapsed_min to --elapsed_max.")
+    parser.add_argument("--elapsed", type=str, nargs="+", default=None, help="Explicit grid of elapsed times, instead of the log-spaced one.")
+    parser.add_argument("--sys_prompt", type=str, default="none", choices=["none", "naive", "rule"], help="Special system prompt to use.")
+    parser.add_argument("--output_dir", type=str, default="outputs", help="Directory to save output JSON files.")
+    parser.add_argument("--render_workers", type=int, default=1, help="Number of processes used to render prompts.")
+    parser.add_argument("--engine", type=str, default="vllm", choices=["vllm", "fake"], help="Inference engine. 'fake' returns scripted outputs on CPU, for running and profiling the pipeline without GPUs.")
+    parser.add_argument("--data_parallel_size", type=int, default=1, help="Run this many engine replicas, each in its own process on its own GPUs, and split the prompts between them (one replica if there are not enough GPUs).")
+    parser.add_argument("--gpus_per_replica", type=int, default=None, help="With --data_parallel_size, GPUs (tensor parallel size) of each replica; defaults to an even split of the visible GPUs.")
+    parser.add_argument("--fake_tool_call_rate", type=float, default=0.5, help="Share of prompts the fake engine answers with a tool call.")
+    parser.add_argument("--fake_latency", type=float, default=0.0, help="Seconds the fake engine spends per generate call.")
+    parser.add_argument("--fake_tokens_per_second", type=float, default=None, help="Decode throughput of the fake engine (unlimited by default).")
+    parser.add_argument("--score_propensity", action="store_true", help="Use the next-token tool call propensity instead of generating, for a smoother curve.")
+    parser.add_argument("--decision_only", action="store_true", help="Stop text answers as soon as it is clear the model is not calling a tool.")
+    parser.add_argument("--decision_chars", type=int, default=None, help="With --decision_only, for parsers that find a tool call anywhere in the reply (qwen, deepseek_distill), cut a text answer after this many characters without a tool call opener. By default such answers are generated to the end, so the decision matches a full run.")
+    parser.add_argument("--max_tokens", type=int, default=None, help="Generation budget per sample (defaults to the handler's max_tokens).")
+    parser.add_argument("--response_cache", type=str, default=None, help="Path of a SQLite response cache; requests already in it are not sent again.")
+    parser.add_argument("--prompt_cache", type=str, default=None, help="Directory of an on-disk cache of rendered prompts and token ids; prompts already in it are neither rendered nor tokenized again.")
+    parser.add_argument("--shard", type=str, default=None, help="Only run shard i of N of the data file, given as i/N (0-based).")
+    parser.add_argument("--ids", type=str, nargs="+", default=None, help="Only run the samples with these ids.")
+    args = parser.parse_args()
+    if args.elapsed:
+        grid = sorted(parse_duration(elapsed) for elapsed in args.elapsed)
+    else:
+        grid = log_spaced(parse_duration(args.elapsed_min), parse_duration(args.elapsed_max), args.num_points)
+    engine_config = {"data_parallel_size": args.data_parallel_size, "gpus_per_replica": args.gpus_per_replica}
+    if args.engine == "fake":
+        engine_config.update({"tool_call_rate": args.fake_tool_call_rate, "latency": args.fake_latency, "tokens_per_second": args.fake_tokens_per_second})
+    # Prompts of a trajectory differ only in the final timestamp, so all but the first are mostly served from the prefix cache
+    handler = get_handler(args.model, model_path=args.model, enable_prefix_caching=True, engine=args.engine, engine_config=engine_config)
+    if args.max_tokens:
+        handler.set_max_tokens(args.max_tokens)
+    handler.decision_only = args.decision_only
+    handler.decision_chars = args.decision_chars
+    if args.response_cache:
+        handler.response_cache = Response_Cache(args.response_cache)
+    if args.prompt_cache:
+        handler.prompt_cache = Prompt_Cache(args.prompt_cache)
+    shard = parse_shard(args.shard) if args.shard else None
+    config = dict(
+        time_elapsed_level=0,
+        use_time_stamp=True,
+        use_special_sys_prompt_naive=args.sys_prompt == "naive",
+        use_special_sys_prompt_rule=args.sys_prompt == "rule"
+    )
+
+    # Each trajectory's counterfactuals are rendered together and stay adjacent in the prompt list
+    sample_ids = []
+    formatted_prompts = []
+    prompt_points = []
+    for chunk in iter_chunks(iter_data(args.data, shard=shard, ids=args.ids), max(1, 1024 // len(grid))):
+        variants = []
+        for sample in chunk:
+            for j, seconds in enumerate(grid):
+                variants.append((len(sample_ids), j, dict(sample, history=shift_final_user_turn(sample["history"], seconds))))
+            sample_ids.append(sample.get('id', 'N/A'))
+        for (i, j, variant), formatted in zip(variants, handler.render_many([variant for _, _, variant in variants], config, num_workers=args.render_workers)):
+            if isinstance(formatted, Exception):
+                print(f"Error formatting sample {sample_ids[i]} at {format_elapsed(grid[j])}: {formatted}")
+                continue
+            formatted_prompts.append(formatted)
+            prompt_points.append((i, j))
+    print(f"Rendered {len(formatted_prompts)} prompts: {len(sample_ids)} trajectories x {len(grid)} elapsed times")
+
+    values = [[None] * len(grid) for _ in sample_ids]
+    if args.score_propensity:
+        for (i, j), score in zip(prompt_points, handler.score_propensity(formatted_prompts)):
+            values[i][j] = score["propensity"]
+    else:
+        for (i, j), output in zip(prompt_points, handler.run_inference(formatted_prompts)):
+            values[i][j] = None if is_error(output) else int(output["decision"] == "tool")
+    if handler.response_cache is not None:
+        print(handler.response_cache.summary())
+    if handler.prompt_cache is not None:
+        print(handler.prompt_cache.summary())
+
+    per_sample = dict(zip(sample_ids, values))
+    curve = summarize_curve(grid, per_sample)
+    print(f"{'elapsed':>8}  {'propensity' if args.score_propensity else 'tool call rate':>14}  samples")
+    for point in curve:
+        rate = f"{point['tool_call_rate']:.2%}" if point["tool_call_rate"] is not None else "-"
+        print(f"{point['label']:>8}  {rate:>14}  {point['num_samples']}")
+    output_path = get_curve_path(args.output_dir, args.model, args.data, args.sys_prompt, shard=shard)
+    if not os.path.exists(os.path.dirname(output_path)):
+        os.makedirs(os.path.dirname(output_path))
+    with open(output_path, "w") as f:
+        json.dump({
+            "model": args.model,
+            "data": args.data,
+            "sys_prompt": args.sys_prompt,
+            "measure": "propensity" if args.score_propensity else "tool_call_rate",
+            "grid": grid,
+            "curve": curve,
+            "samples": per_sample,
+        }, f, indent=4)
+    print(f"Curve saved to {output_path}")
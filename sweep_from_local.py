@@ -0,0 +1,159 @@
+import os
+import argparse
+from utils import load_data, get_data_name, get_output_path, save_outputs, get_propensity_path, load_budget, resolve_max_tokens
+from eval_from_local import get_handler
+from inference.response_cache import Response_Cache
+from inference.prompt_cache import Prompt_Cache
+from inference.normalize import normalize_history
+from inference.model_map import MODELS
+from inference.forecast import dry_run
+
+SYS_PROMPT_MODES = ["none", "naive", "rule"]
+
+
+def build_cells(data_paths, time_elapsed_levels, time_stamp_modes, sys_prompt_modes):
+    """
+    Expand the experiment matrix into cells, one per output file.
+    Without time stamps the elapse level does not change the prompt, so each data file
+    gets a single notime cell per system prompt mode.
+    """
+    cells = []
+    for data_path in data_paths:
+        for sys_prompt in sys_prompt_modes:
+            for use_time_stamp in time_stamp_modes:
+                levels = time_elapsed_levels if use_time_stamp else time_elapsed_levels[:1]
+                for level in levels:
+                    cells.append({
+                        "data": data_path,
+                        "time_elapsed_level": level,
+                        "use_time_stamp": use_time_stamp,
+                        "sys_prompt": sys_prompt,
+                    })
+    return cells
+
+
+def get_cell_output_dir(output_dir, sys_prompt):
+    """Cells with a special system prompt are written to a subdirectory named after it."""
+    return output_dir if sys_prompt == "none" else os.path.join(output_dir, sys_prompt)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate local LLM function calling over an experiment matrix with a single engine.")
+    parser.add_argument("--data", type=str, nargs="+", default=["data/preferTool_elapse_0.json"], help="Paths to data JSON files.")
+    parser.add_argument("--model", type=str, default="meta-llama/Llama-3.1-8B-Instruct", help="Model code (will be mapped to handler).")
+    parser.add_argument("--time_elapsed_levels", type=int, nargs="+", default=[0, 1, 2], choices=[0, 1, 2], help="Time elapsed levels to sweep when time stamps are used.")
+    parser.add_argument("--time_stamp", type=str, nargs="+", default=["on", "off"], choices=["on", "off"], help="Whether to sweep prompts with time stamps, without, or both.")
+    parser.add_argument("--sys_prompts", type=str, nargs="+", default=SYS_PROMPT_MODES, choices=SYS_PROMPT_MODES, help="Special system prompts to sweep. Outputs for naive/rule go to <output_dir>/naive and <output_dir>/rule.")
+    parser.add_argument("--output_dir", type=str, default="outputs", help="Directory to save output JSON files.")
+    parser.add_argument("--enable_prefix_caching", action="store_true", help="Enable vllm automatic prefix caching, submit prompts grouped by shared prefix and report the cache hit rate.")
+    parser.add_argument("--render_workers", type=int, default=1, help="Number of processes used to render prompts.")
+    parser.add_argument("--engine", type=str, default="vllm", choices=["vllm", "fake"], help="Inference engine. 'fake' returns scripted outputs on CPU, for running and profiling the pipeline without GPUs.")
+    parser.add_argument("--data_parallel_size", type=int, default=1, help="Run this many engine replicas, each in its own process on its own GPUs, and split the prompts between them (one replica if there are not enough GPUs).")
+    parser.add_argument("--gpus_per_replica", type=int, default=None, help="With --data_parallel_size, GPUs (tensor parallel size) of each replica; defaults to an even split of the visible GPUs.")
+    parser.add_argument("--fake_tool_call_rate", type=float, default=0.5, help="Share of prompts the fake engine answers with a tool call.")
+    parser.add_argument("--fake_latency", type=float, default=0.0, help="Seconds the fake engine spends per generate call.")
+    parser.add_argument("--fake_tokens_per_second", type=float, default=None, help="Decode throughput of the fake engine (unlimited by default).")
+    parser.add_argument("--score_propensity", action="store_true", help="Instead of generating, score each prompt's tool call propensity from the next-token distribution and save it to <output>-propensity.json.")
+    parser.add_argument("--decision_only", action="store_true", help="Stop text answers as soon as it is clear the model is not calling a tool; tool calls are still generated in full (for attempt-rate metrics).")
+    parser.add_argument("--decision_chars", type=int, default=None, help="With --decision_only, for parsers that find a tool call anywhere in the reply (qwen, deepseek_distill), cut a text answer after this many characters without a tool call opener. By default such answers are generated to the end, so the decision matches a full run.")
+    parser.add_argument("--response_cache", type=str, default=None, help="Path of a SQLite response cache; requests already in it are not sent again.")
+    parser.add_argument("--response_cache_max_mb", type=float, default=None, help="Evict least recently used cache entries beyond this size.")
+    parser.add_argument("--prompt_cache", type=str, default=None, help="Directory of an on-disk cache of rendered prompts and token ids; prompts already in it are neither rendered nor tokenized again.")
+    parser.add_argument("--max_tokens", type=int, default=None, help="Generation budget per sample (defaults to the budget file, then the handler's max_tokens).")
+    parser.add_argument("--budget_file", type=str, default=None, help="JSON file of generation budgets per model and data file (see utils.load_budget).")
+    parser.add_argument("--dry_run", action="store_true", help="Only render and tokenize the prompts of the whole matrix and report token counts, samples exceeding the context window and the projected generation time; nothing is generated.")
+    parser.add_argument("--calibrate", type=int, default=0, help="With --dry_run, generate this many prompts to measure throughput and output length (loads the engine).")
+    parser.add_argument("--expected_output_tokens", type=float, default=None, help="With --dry_run, expected output tokens per sample (defaults to the calibration).")
+    parser.add_argument("--tokens_per_second", type=float, default=None, help="With --dry_run, measured output tokens per second of the model, for the generation time forecast.")
+    args = parser.parse_args()
+    time_stamp_modes = [mode == "on" for mode in dict.fromkeys(args.time_stamp)]
+    cells = build_cells(args.data, sorted(set(args.time_elapsed_levels)), time_stamp_modes, list(dict.fromkeys(args.sys_prompts)))
+    engine_config = {"data_parallel_size": args.data_parallel_size, "gpus_per_replica": args.gpus_per_replica}
+    if args.engine == "fake":
+        engine_config.update({"tool_call_rate": args.fake_tool_call_rate, "latency": args.fake_latency, "tokens_per_second": args.fake_tokens_per_second})
+    # A dry run only needs the engine to calibrate
+    engine = None if args.dry_run and not args.calibrate else args.engine
+    handler = get_handler(args.model, model_path=args.model, enable_prefix_caching=args.enable_prefix_caching, engine=engine, engine_config=engine_config)
+    budget = load_budget(args.budget_file) if args.budget_file else {}
+    for cell in cells:
+        cell["max_tokens"] = args.max_tokens or resolve_max_tokens(budget, args.model, cell["data"], handler.max_tokens)
+    handler.decision_only = args.decision_only
+    handler.decision_chars = args.decision_chars
+    if args.response_cache:
+        handler.response_cache = Response_Cache(args.response_cache, max_bytes=args.response_cache_max_mb * 2 ** 20 if args.response_cache_max_mb else None)
+    if args.prompt_cache:
+        handler.prompt_cache = Prompt_Cache(args.prompt_cache)
+
+    # Render every cell, keeping one copy of each byte-identical prompt.
+    # Each trajectory is normalized once and shared by all of its cells.
+    datasets = {
+        data_path: [dict(sample, history=normalize_history(sample["history"])) for sample in load_data(data_path)]
+        for data_path in args.data
+    }
+    unique_prompts = []
+    prompt_to_index = {}
+    prompt_labels = []
+    num_rendered = 0
+    for cell in cells:
+        cell["sample_ids"] = []
+        cell["prompt_indices"] = []
+        config = dict(
+            time_elapsed_level=cell["time_elapsed_level"],
+            use_time_stamp=cell["use_time_stamp"],
+            use_special_sys_prompt_naive=cell["sys_prompt"] == "naive",
+            use_special_sys_prompt_rule=cell["sys_prompt"] == "rule"
+        )
+        samples = datasets[cell["data"]]
+        for sample, formatted in zip(samples, handler.render_many(samples, config, num_workers=args.render_workers)):
+            if isinstance(formatted, Exception):
+                print(f"Error formatting sample {sample.get('id', 'N/A')}: {formatted}")
+                continue
+            num_rendered += 1
+            if formatted not in prompt_to_index:
+                prompt_to_index[formatted] = len(unique_prompts)
+                unique_prompts.append(formatted)
+                prompt_labels.append(f"{get_data_name(cell['data'])}/{sample.get('id', 'N/A')}")
+            cell["sample_ids"].append(sample.get('id', 'N/A'))
+            cell["prompt_indices"].append(prompt_to_index[formatted])
+    print(f"Rendered {num_rendered} prompts over {len(cells)} cells, {len(unique_prompts)} unique")
+
+    # Each unique prompt is generated once, with the largest budget of the cells it belongs to
+    prompt_budgets = [0] * len(unique_prompts)
+    for cell in cells:
+        for i in cell["prompt_indices"]:
+            prompt_budgets[i] = max(prompt_budgets[i], cell["max_tokens"])
+    budget_groups = {}
+    for i, max_tokens in enumerate(prompt_budgets):
+        budget_groups.setdefault(max_tokens, []).append(i)
+
+    if args.dry_run:
+        for max_tokens, indices in budget_groups.items():
+            handler.set_max_tokens(max_tokens)
+            dry_run(handler, MODELS[args.model], f"{args.model}, {len(indices)} unique prompts with max_tokens {max_tokens}", [prompt_labels[i] for i in indices],
+                    [unique_prompts[i] for i in indices], engine=args.engine, expected_output_tokens=args.expected_output_tokens,
+                    tokens_per_second=args.tokens_per_second, calibrate=args.calibrate)
+        raise SystemExit
+
+    if args.score_propensity:
+        outputs = handler.score_propensity(unique_prompts)
+    else:
+        outputs = [None] * len(unique_prompts)
+        for max_tokens, indices in budget_groups.items():
+            handler.set_max_tokens(max_tokens)
+            for i, output in zip(indices, handler.run_inference([unique_prompts[i] for i in indices])):
+                outputs[i] = output
+    if handler.response_cache is not None:
+        print(handler.response_cache.summary())
+    if handler.prompt_cache is not None:
+        print(handler.prompt_cache.summary())
+
+    for cell in cells:
+        output_dir = get_cell_output_dir(args.output_dir, cell["sys_prompt"])
+        output_path = get_output_path(output_dir, args.model, cell["data"], cell["time_elapsed_level"], cell["use_time_stamp"])
+        cell_outputs = [outputs[i] for i in cell["prompt_indices"]]
+        if args.score_propensity:
+            output_path = get_propensity_path(output_path)
+            mean = sum(score["propensity"] for score in cell_outputs) / len(cell_outputs) if cell_outputs else 0
+            print(f"Mean tool call propensity: {mean:.4f} ({os.path.basename(output_path)})")
+        save_outputs(output_path, cell["sample_ids"], cell_outputs)
+        print(f"Outputs saved to {output_path}")
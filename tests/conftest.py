@@ -0,0 +1,20 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+
+def run_script(script, *args, env=None, timeout=300):
+    """Run one of the repository's scripts from the repository root and return the completed process."""
+    return subprocess.run([sys.executable, script, *map(str, args)], cwd=REPO_DIR, env={**os.environ, **(env or {})},
+                          capture_output=True, text=True, timeout=timeout)
+
+
+@pytest.fixture
+def output_dir(tmp_path):
+    return tmp_path / "outputs"
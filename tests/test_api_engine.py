@@ -0,0 +1,103 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from inference.api_engine import API_Engine, AIMD_Limiter, Token_Bucket, get_retry_after, is_retryable
+
+
+class Status_Error(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def test_token_bucket_waits_for_refill():
+    async def main():
+        bucket = Token_Bucket(600)  # 10 per second, capacity 100
+        await bucket.acquire(100)
+        start = time.monotonic()
+        await bucket.acquire(2)
+        return time.monotonic() - start
+    assert 0.1 < asyncio.run(main()) < 1.0
+
+
+def test_token_bucket_try_acquire_does_not_wait():
+    async def main():
+        bucket = Token_Bucket(60)
+        taken = [bucket.try_acquire(1) for _ in range(20)]
+        return taken
+    taken = asyncio.run(main())
+    assert taken[:10] == [True] * 10
+    assert not any(taken[10:])
+
+
+def test_aimd_limiter_grows_and_cuts_on_throttling():
+    async def main():
+        limiter = AIMD_Limiter(4, 8)
+        for _ in range(8):
+            await limiter.acquire()
+            await limiter.release(latency=0.01)
+        grown = limiter.limit
+        await limiter.acquire()
+        await limiter.release(throttled=True)
+        return grown, limiter.limit
+    grown, cut = asyncio.run(main())
+    assert grown > 4
+    assert cut == grown * 0.5
+
+
+def test_retry_after_headers():
+    assert get_retry_after(Status_Error(429, {"Retry-After": "3"})) == 3.0
+    assert get_retry_after(Status_Error(429, {"retry-after-ms": "250"})) == 0.25
+    assert get_retry_after(Status_Error(429)) is None
+    assert get_retry_after(SimpleNamespace(response=SimpleNamespace(headers={"retry-after": "1.5"}))) == 1.5
+
+
+def test_retryable_errors():
+    assert is_retryable(Status_Error(429))
+    assert is_retryable(Status_Error(503))
+    assert is_retryable(asyncio.TimeoutError())
+    assert not is_retryable(Status_Error(400))
+    assert not is_retryable(ValueError("bad"))
+
+
+def test_engine_retries_and_honors_retry_after():
+    attempts = {}
+
+    async def call(payload):
+        attempts[payload] = attempts.get(payload, 0) + 1
+        if attempts[payload] == 1:
+            raise Status_Error(429, {"retry-after": "0.2"})
+        return f"ok {payload}"
+
+    engine = API_Engine(backoff_base=0.01, backoff_max=0.01)
+    start = time.monotonic()
+    results = engine.run(call, [0, 1, 2])
+    assert results == ["ok 0", "ok 1", "ok 2"]
+    assert attempts == {0: 2, 1: 2, 2: 2}
+    assert time.monotonic() - start >= 0.2
+
+
+def test_engine_reports_final_errors_in_order():
+    async def call(payload):
+        if payload == 1:
+            raise Status_Error(400)
+        return payload
+
+    seen = []
+    results = API_Engine().run(call, [0, 1, 2], on_result=lambda i, output: seen.append(i))
+    assert results[0] == 0 and results[2] == 2
+    assert results[1].startswith("[ERROR]")
+    assert sorted(seen) == [0, 1, 2]
+
+
+def test_engine_deadline():
+    async def call(payload):
+        await asyncio.sleep(5)
+        return payload
+
+    start = time.monotonic()
+    results = API_Engine(deadline=0.3).run(call, [0, 1])
+    assert all(result.startswith("[ERROR]: deadline") for result in results)
+    assert time.monotonic() - start < 2
@@ -0,0 +1,119 @@
+import json
+import sqlite3
+
+from conftest import run_script
+from inference.prompt_cache import Prompt_Cache, make_prompt_key, render_identity
+from inference.response_cache import Response_Cache, make_cache_key
+from test_eval_local import DATA, MODEL, load_outputs, output_file
+
+
+def table_bytes(cache):
+    return cache.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+
+def test_cache_key_depends_on_identity_and_request():
+    identity = {"handler": "Llama_Handler", "version": "2", "model": "m"}
+    key = make_cache_key(identity, {"messages": [{"role": "user", "content": "hi"}]})
+    assert key == make_cache_key(dict(identity), {"messages": [{"role": "user", "content": "hi"}]})
+    assert key != make_cache_key(dict(identity, version="3"), {"messages": [{"role": "user", "content": "hi"}]})
+    assert key != make_cache_key(identity, {"messages": [{"role": "user", "content": "hello"}]})
+
+
+def test_writes_are_batched(tmp_path):
+    cache = Response_Cache(str(tmp_path / "cache.db"), flush_size=4)
+    for i in range(3):
+        cache.put_many([(f"k{i}", {"text": i})])
+    other = Response_Cache(str(tmp_path / "cache.db"))
+    assert other.get_many(["k0"]) == {}
+    cache.put_many([("k3", {"text": 3})])
+    assert other.get_many(["k0", "k3"]) == {"k0": {"text": 0}, "k3": {"text": 3}}
+    # Pending outputs are visible to the cache that holds them
+    cache.put_many([("k4", {"text": 4})])
+    assert cache.get_many(["k4"]) == {"k4": {"text": 4}}
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_tracked_size_and_eviction(tmp_path):
+    cache = Response_Cache(str(tmp_path / "cache.db"), max_bytes=1000, flush_size=1)
+    for i in range(30):
+        cache.put_many([(f"k{i}", {"text": "x" * 100})])
+        assert cache.total_bytes() == table_bytes(cache)
+        assert cache.total_bytes() <= 1000
+    # Replacing an entry adjusts the total by the difference
+    cache.put_many([("k29", {"text": "y"})])
+    assert cache.total_bytes() == table_bytes(cache)
+    # The least recently used entries went first
+    assert cache.get_many(["k0", "k29"]).keys() == {"k29"}
+
+
+def test_opens_caches_without_size_table(tmp_path):
+    path = str(tmp_path / "cache.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)")
+    conn.execute("INSERT INTO responses VALUES ('old', '\"x\"', 3, 0)")
+    conn.commit()
+    conn.close()
+    cache = Response_Cache(path)
+    assert cache.total_bytes() == 3
+    assert cache.get_many(["old"]) == {"old": "x"}
+
+
+def test_rerun_is_served_from_cache(tmp_path):
+    args = ["--engine", "fake", "--model", MODEL, "--data", DATA, "--response_cache", tmp_path / "cache.db"]
+    first = run_script("eval_from_local.py", *args, "--output_dir", tmp_path / "a")
+    second = run_script("eval_from_local.py", *args, "--output_dir", tmp_path / "b")
+    assert first.returncode == 0 and second.returncode == 0, first.stderr + second.stderr
+    with open(DATA) as f:
+        num_samples = len(json.load(f))
+    assert f"0 hits, {num_samples} misses" in first.stdout
+    assert f"{num_samples} hits, 0 misses" in second.stdout
+
+
+def test_prompt_cache_round_trip(tmp_path):
+    cache = Prompt_Cache(str(tmp_path / "prompts"))
+    cache.put_prompts([("a", "first prompt ✓"), ("b", "second")])
+    cache.put_token_ids([("a", [1, 2, 2 ** 32 - 1]), ("b", [])])
+    reopened = Prompt_Cache(str(tmp_path / "prompts"))
+    assert reopened.get_prompts(["a", "b", "c"]) == {"a": "first prompt ✓", "b": "second"}
+    assert reopened.get_token_ids(["a", "b"]) == {"a": [1, 2, 2 ** 32 - 1], "b": []}
+    # Entries appended after the files were mapped are read too
+    reopened.put_prompts([("c", "third")])
+    assert reopened.get_prompts(["c"]) == {"c": "third"}
+    assert reopened.hits["prompts"] == 3 and reopened.misses["prompts"] == 1
+
+
+def test_prompt_keys_follow_settings_and_sample():
+    from eval_from_local import get_handler
+    handler = get_handler(MODEL, model_path=MODEL, engine=None)
+    config = {"time_elapsed_level": 0, "use_time_stamp": True, "use_special_sys_prompt_naive": False, "use_special_sys_prompt_rule": False}
+    identity = render_identity(handler, config)
+    assert identity == render_identity(handler, dict(config))
+    assert identity != render_identity(handler, dict(config, use_time_stamp=False))
+    sample = {"history": [{"role": "user", "content": "hi"}], "function": []}
+    assert make_prompt_key(identity, sample) != make_prompt_key(identity, dict(sample, history=[{"role": "user", "content": "hello"}]))
+
+
+def test_rerun_is_rendered_from_prompt_cache(tmp_path):
+    args = ["--engine", "fake", "--model", MODEL, "--data", DATA, "--prompt_cache", tmp_path / "prompts"]
+    first = run_script("eval_from_local.py", *args, "--output_dir", tmp_path / "a")
+    second = run_script("eval_from_local.py", *args, "--output_dir", tmp_path / "b")
+    assert first.returncode == 0 and second.returncode == 0, first.stderr + second.stderr
+    with open(DATA) as f:
+        num_samples = len(json.load(f))
+    assert f"rendered prompts {num_samples} hits, 0 misses; token ids {num_samples} hits, 0 misses" in second.stdout
+    assert load_outputs(output_file(tmp_path / "a")) == load_outputs(output_file(tmp_path / "b"))
+
+
+def test_edited_system_prompt_misses_prompt_cache(tmp_path, monkeypatch):
+    from eval_from_local import get_handler
+    from inference import normalize
+    handler = get_handler(MODEL, model_path=MODEL, engine=None)
+    handler.prompt_cache = Prompt_Cache(str(tmp_path / "prompts"))
+    config = {"time_elapsed_level": 0, "use_time_stamp": True, "use_special_sys_prompt_naive": False, "use_special_sys_prompt_rule": True}
+    with open(DATA) as f:
+        samples = json.load(f)[:3]
+    cached = handler.render_many(samples, config)
+    monkeypatch.setitem(normalize.SYS_PROMPT_SUFFIX, "rule", normalize.SYS_PROMPT_SUFFIX["rule"] + " Edited.")
+    edited = handler.render_many(samples, config)
+    assert handler.prompt_cache.misses["prompts"] == 2 * len(samples)
+    assert all("Edited." in prompt and prompt != before for prompt, before in zip(edited, cached))
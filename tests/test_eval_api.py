@@ -0,0 +1,102 @@
+import json
+import threading
+
+import pytest
+
+from conftest import run_script
+from mock_api_server import Mock_Faults, Mock_Rules, make_server
+
+DATA = "data/preferTool_elapse_0.json"
+MODEL = "gpt-4o-mini-2024-07-18-FC"
+
+
+@pytest.fixture
+def mock_server():
+    """Start mock API servers on free ports; yields a function taking make_server's rules/faults and returning the base URL."""
+    servers = []
+
+    def start(**kwargs):
+        server = make_server(port=0, batch_delay=0.2, **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def base_url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def output_file(output_dir, suffix=".json"):
+    return output_dir / MODEL / f"{MODEL}-preferTool_elapse_0-notime{suffix}"
+
+
+def eval_api(server, output_dir, *args):
+    result = run_script("eval_from_api.py", "--model", MODEL, "--data", DATA, "--base_url", base_url(server), "--output_dir", output_dir, *args,
+                        env={"OPENAI_API_KEY": "mock"})
+    assert result.returncode == 0, result.stdout + result.stderr
+    return result
+
+
+def load_outputs(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def test_api_run_with_trace(mock_server, output_dir):
+    server = mock_server()
+    result = eval_api(server, output_dir)
+    outputs = load_outputs(output_file(output_dir))
+    with open(DATA) as f:
+        assert [item["id"] for item in outputs] == [sample["id"] for sample in json.load(f)]
+    assert all(item["output"]["decision"] == "tool" for item in outputs)
+    assert all(item["output"]["usage"]["cached_tokens"] == 0 for item in outputs)
+    with open(output_file(output_dir, "-trace.jsonl")) as f:
+        records = [json.loads(line) for line in f]
+    assert sorted(record["index"] for record in records) == list(range(len(outputs)))
+    assert all(record["status"] == "ok" and record["cost"] is not None for record in records)
+    assert "Telemetry: %d of %d requests succeeded" % (len(outputs), len(outputs)) in result.stdout
+
+
+def test_api_run_retries_injected_faults(mock_server, output_dir):
+    server = mock_server(faults=Mock_Faults(rate_429=0.2, retry_after=0, rate_5xx=0.1, seed=1))
+    eval_api(server, output_dir, "--max_retries", "10")
+    outputs = load_outputs(output_file(output_dir))
+    assert all(item["output"]["decision"] == "tool" for item in outputs)
+    with open(output_file(output_dir, "-trace.jsonl")) as f:
+        records = [json.loads(line) for line in f]
+    attempt_errors = {error_type for record in records for error_type in record["attempt_errors"]}
+    assert {"rate_limit", "server"} <= attempt_errors
+    assert sum(record["retries"] for record in records) > 0
+    assert server.RequestHandlerClass.state.stats["requests"] > len(outputs)
+
+
+def test_api_resume(mock_server, tmp_path):
+    server = mock_server(rules=Mock_Rules("text"))
+    eval_api(server, tmp_path / "full")
+    full = load_outputs(output_file(tmp_path / "full"))
+    checkpoint = output_file(tmp_path / "resumed", ".partial.jsonl")
+    checkpoint.parent.mkdir(parents=True)
+    with open(checkpoint, "w") as f:
+        for item in full[:10]:
+            f.write(json.dumps(item) + "\n")
+    requests_before = server.RequestHandlerClass.state.stats["requests"]
+    result = eval_api(server, tmp_path / "resumed", "--resume")
+    assert "Resuming: 10 samples already finished" in result.stdout
+    assert server.RequestHandlerClass.state.stats["requests"] - requests_before == len(full) - 10
+    assert [item["id"] for item in load_outputs(output_file(tmp_path / "resumed"))] == [item["id"] for item in full]
+
+
+def test_batch_run(mock_server, output_dir):
+    server = mock_server()
+    eval_api(server, output_dir, "--batch", "--batch_poll_interval", "0.1")
+    outputs = load_outputs(output_file(output_dir))
+    assert all(item["output"]["decision"] == "tool" for item in outputs)
+    batch_files = list(output_file(output_dir, "-batches").iterdir())
+    assert len(batch_files) == 1
+    with open(batch_files[0]) as f:
+        assert sum(1 for _ in f) == len(outputs)
+    assert not output_file(output_dir, "-trace.jsonl").exists()
@@ -0,0 +1,97 @@
+import json
+import time
+from types import SimpleNamespace
+
+from conftest import run_script
+from inference.engines import Data_Parallel_Engine
+
+DATA = "data/preferTool_elapse_0.json"
+MODEL = "meta-llama/Llama-3.1-8B-Instruct"
+
+
+def output_file(output_dir, suffix=""):
+    return output_dir / "Llama-3.1-8B-Instruct" / f"Llama-3.1-8B-Instruct-preferTool_elapse_0-notime{suffix}.json"
+
+
+def eval_fake(output_dir, *args):
+    result = run_script("eval_from_local.py", "--engine", "fake", "--model", MODEL, "--data", DATA, "--output_dir", output_dir, *args)
+    assert result.returncode == 0, result.stderr
+    return result
+
+
+def load_outputs(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def test_fake_run(output_dir):
+    eval_fake(output_dir)
+    outputs = load_outputs(output_file(output_dir))
+    with open(DATA) as f:
+        sample_ids = [sample["id"] for sample in json.load(f)]
+    assert [item["id"] for item in outputs] == sample_ids
+    decisions = {item["output"]["decision"] for item in outputs}
+    assert decisions <= {"tool", "text"} and decisions
+    for item in outputs:
+        if item["output"]["decision"] == "tool":
+            assert item["output"]["tool_calls"] and "parse_error" not in item["output"]
+    assert not output_file(output_dir, ".partial").with_suffix(".jsonl").exists()
+
+
+def test_fake_run_is_deterministic(tmp_path):
+    eval_fake(tmp_path / "a")
+    eval_fake(tmp_path / "b", "--decision_only")
+    eval_fake(tmp_path / "c")
+    assert load_outputs(output_file(tmp_path / "a")) == load_outputs(output_file(tmp_path / "c"))
+    decision_only = load_outputs(output_file(tmp_path / "b"))
+    assert [item["output"]["decision"] for item in decision_only] == [item["output"]["decision"] for item in load_outputs(output_file(tmp_path / "a"))]
+
+
+def test_resume(tmp_path):
+    eval_fake(tmp_path / "full")
+    full = load_outputs(output_file(tmp_path / "full"))
+    # An interrupted run: half of the samples in the checkpoint, one of them failed, plus a torn last line
+    checkpoint = output_file(tmp_path / "resumed", ".partial").with_suffix(".jsonl")
+    checkpoint.parent.mkdir(parents=True)
+    finished = full[:len(full) // 2]
+    marked = dict(finished[0]["output"], text="kept from the checkpoint")
+    with open(checkpoint, "w") as f:
+        f.write(json.dumps({"id": finished[0]["id"], "output": marked}) + "\n")
+        for item in finished[1:-1]:
+            f.write(json.dumps(item) + "\n")
+        f.write(json.dumps({"id": finished[-1]["id"], "output": {"decision": "error", "tool_calls": [], "text": "[ERROR]: timeout"}}) + "\n")
+        f.write('{"id": "torn')
+    result = eval_fake(tmp_path / "resumed", "--resume")
+    assert f"Resuming: {len(finished) - 1} samples already finished" in result.stdout
+    resumed = load_outputs(output_file(tmp_path / "resumed"))
+    assert [item["id"] for item in resumed] == [item["id"] for item in full]
+    assert resumed[0]["output"]["text"] == "kept from the checkpoint"
+    assert resumed[1:] == full[1:]
+    assert not checkpoint.exists()
+
+
+def test_data_parallel_matches_single_engine(tmp_path):
+    for args in ([], ["--decision_only", "--max_tokens", "40"]):
+        eval_fake(tmp_path / "single", *args)
+        eval_fake(tmp_path / "replicas", "--data_parallel_size", "2", *args)
+        assert load_outputs(output_file(tmp_path / "replicas")) == load_outputs(output_file(tmp_path / "single"))
+
+
+def test_data_parallel_streams_chunks_as_replicas_finish():
+    spec = SimpleNamespace(model_path=MODEL, enable_prefix_caching=False, tool_parser="llama", reasons=False)
+    engine = Data_Parallel_Engine("fake", spec, 2, latency=0.2)
+    try:
+        prompts = [f"prompt {i}" for i in range(12)]
+        params = engine.make_sampling_params(max_tokens=16)
+        start = time.monotonic()
+        arrivals = [(time.monotonic() - start, positions) for positions, _ in engine.generate_stream(prompts, params, 3)]
+        assert sorted(p for _, positions in arrivals for p in positions) == list(range(12))
+        # Two replicas, four chunks: the first two arrive after one round, well before the last
+        assert arrivals[1][0] < arrivals[-1][0] - 0.15
+        # Stopping early leaves no stale replies for the next call
+        stream = engine.generate_stream(prompts, params, 3)
+        next(stream)
+        stream.close()
+        assert [output.outputs[0].text for output in engine.generate(prompts, params)] == [output.outputs[0].text for output in engine.generate(prompts, params)]
+    finally:
+        engine.close()
@@ -0,0 +1,63 @@
+import asyncio
+import json
+import time
+
+from inference.api_engine import API_Engine
+from inference.telemetry import Telemetry_Trace
+
+
+def make_call(slow, slow_seconds=5):
+    """Call that answers in 10 ms, except the first attempt at each payload in slow, which hangs for slow_seconds."""
+    attempts = {}
+
+    async def call(payload):
+        attempts[payload] = attempts.get(payload, 0) + 1
+        if payload in slow and attempts[payload] == 1:
+            await asyncio.sleep(slow_seconds)
+            return f"slow {payload}"
+        await asyncio.sleep(0.01)
+        return f"fast {payload}"
+    return call, attempts
+
+
+def test_hedge_wins_over_straggler(tmp_path):
+    call, attempts = make_call(slow={29})
+    engine = API_Engine(initial_concurrency=1, max_concurrency=1, hedge_percentile=90, hedge_budget=0.5, hedge_min_samples=5)
+    engine.trace = Telemetry_Trace(str(tmp_path / "trace.jsonl"))
+    start = time.monotonic()
+    results = engine.run(call, list(range(30)))
+    engine.trace.close()
+    assert time.monotonic() - start < 3
+    assert results[29] == "fast 29"
+    assert attempts[29] == 2
+    assert engine.hedge_stats["hedged"] == 1 and engine.hedge_stats["hedge_wins"] == 1
+    records = [json.loads(line) for line in open(tmp_path / "trace.jsonl")]
+    assert [record["index"] for record in records if record["hedged"]] == [29]
+    assert engine.trace.summary()["hedge_wins"] == 1
+
+
+def test_no_hedging_before_min_samples():
+    call, attempts = make_call(slow={0})
+    engine = API_Engine(hedge_percentile=90, hedge_budget=1.0, hedge_min_samples=5, deadline=1)
+    results = engine.run(call, [0])
+    assert results[0].startswith("[ERROR]: deadline")
+    assert attempts[0] == 1
+    assert engine.hedge_stats["hedged"] == 0
+
+
+def test_hedges_capped_by_budget():
+    slow = set(range(20, 30))
+    call, attempts = make_call(slow=slow, slow_seconds=0.3)
+    engine = API_Engine(initial_concurrency=1, max_concurrency=1, hedge_percentile=90, hedge_budget=0.1, hedge_min_samples=5)
+    engine.run(call, list(range(30)))
+    assert engine.hedge_stats["hedged"] <= 0.1 * engine.hedge_stats["calls"]
+    assert engine.hedge_stats["no_budget"] > 0
+    assert sum(1 for payload in slow if attempts[payload] == 2) == engine.hedge_stats["hedged"]
+
+
+def test_hedging_off_by_default():
+    call, attempts = make_call(slow=set())
+    engine = API_Engine()
+    engine.run(call, list(range(30)))
+    assert all(count == 1 for count in attempts.values())
+    assert engine.hedge_stats["hedged"] == 0
@@ -0,0 +1,49 @@
+import json
+import os
+
+from conftest import run_script
+from test_eval_local import DATA, eval_fake, load_outputs, output_file
+from utils import get_shard_config_path, shard_samples
+
+
+def test_sharded_dry_run(output_dir):
+    eval_fake(output_dir, "--dry_run", "--num_shards", "2", "--shard_index", "0")
+    config_path = get_shard_config_path(str(output_file(output_dir, "-shard0of2")))
+    with open(config_path) as f:
+        config = json.load(f)
+    assert config["num_shards"] == 2 and config["shard_index"] == 0
+    assert config["handler"]["temperature"] == 0.0
+    assert not output_file(output_dir, "-shard0of2").exists()
+
+
+def test_balanced_shards_partition_the_data():
+    with open(DATA) as f:
+        sample_ids = [sample["id"] for sample in json.load(f)]
+    shards = [shard_samples(DATA, (i, 3), balanced=True) for i in range(3)]
+    planned = sorted(sample_id for shard in shards for _, sample_id in shard)
+    assert planned == sorted(sample_ids)
+    sizes = [len(shard) for shard in shards]
+    assert max(sizes) - min(sizes) <= len(sample_ids) // 3
+
+
+def test_merge_shards(tmp_path):
+    eval_fake(tmp_path / "full")
+    for i in range(3):
+        eval_fake(tmp_path / "sharded", "--num_shards", "3", "--shard_index", str(i))
+    result = run_script("merge_shards.py", "--output_dir", tmp_path / "sharded", "--remove_shards")
+    assert result.returncode == 0, result.stdout
+    assert load_outputs(output_file(tmp_path / "sharded")) == load_outputs(output_file(tmp_path / "full"))
+    assert sorted(os.listdir(output_file(tmp_path / "sharded").parent)) == [output_file(tmp_path / "sharded").name]
+
+
+def test_merge_refuses_incomplete_or_mismatched_shards(tmp_path):
+    for i in range(2):
+        eval_fake(tmp_path, "--num_shards", "3", "--shard_index", str(i))
+    result = run_script("merge_shards.py", "--output_dir", tmp_path)
+    assert result.returncode == 1
+    assert "missing shards 2 of 3" in result.stdout
+    eval_fake(tmp_path, "--num_shards", "3", "--shard_index", "2", "--max_tokens", "8")
+    result = run_script("merge_shards.py", "--output_dir", tmp_path)
+    assert result.returncode == 1
+    assert "shard 2 ran with a different handler than shard 0" in result.stdout
+    assert not output_file(tmp_path).exists()
@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from inference.telemetry import Telemetry_Trace, classify_error, request_cost
+
+
+class Status_Error(Exception):
+    def __init__(self, status_code, message=""):
+        super().__init__(message or f"status {status_code}")
+        self.status_code = status_code
+
+
+@pytest.mark.parametrize("error, error_type", [
+    (Status_Error(429), "rate_limit"),
+    (Status_Error(401), "auth"),
+    (Status_Error(404), "not_found"),
+    (Status_Error(400, "This model's maximum context length is 128000 tokens"), "context_length"),
+    (Status_Error(400, "Invalid tool schema"), "bad_request"),
+    (Status_Error(503), "server"),
+    (asyncio.TimeoutError(), "timeout"),
+    (ConnectionResetError(), "connection"),
+    (ValueError("odd"), "other"),
+])
+def test_classify_error(error, error_type):
+    assert classify_error(error) == error_type
+
+
+def test_request_cost():
+    usage = {"prompt_tokens": 1000, "completion_tokens": 200, "cached_tokens": 400}
+    assert request_cost(usage, 2.0, 8.0, 0.5) == pytest.approx((600 * 2.0 + 400 * 0.5 + 200 * 8.0) / 1e6)
+    assert request_cost(usage, 2.0, 8.0) == pytest.approx((1000 * 2.0 + 200 * 8.0) / 1e6)
+    assert request_cost(usage, None, 8.0) is None
+    assert request_cost(None, 2.0, 8.0) is None
+
+
+def test_trace_summary(tmp_path):
+    trace = Telemetry_Trace(str(tmp_path / "trace.jsonl"), input_price=1.0, output_price=2.0)
+    ok = {"decision": "text", "usage": {"prompt_tokens": 100, "completion_tokens": 10}}
+    trace.record(0, 0.0, 1.0, ok, latency=1.0, retries=1, attempt_errors=["rate_limit"])
+    trace.record(1, 0.5, 2.0, ok, latency=1.5, hedged=True, hedge_won=True)
+    trace.record(2, 0.5, 2.0, "[ERROR]: boom", error_type="server", attempt_errors=["server"])
+    trace.close()
+    summary = trace.summary()
+    assert (summary["num_requests"], summary["num_ok"], summary["retries"]) == (3, 2, 1)
+    assert summary["errors"] == {"server": 1}
+    assert summary["attempt_errors"] == {"rate_limit": 1, "server": 1}
+    assert (summary["hedged"], summary["hedge_wins"]) == (1, 1)
+    assert summary["wall_seconds"] == 2.0
+    assert summary["cost"] == pytest.approx(2 * (100 * 1.0 + 10 * 2.0) / 1e6)
+    with open(tmp_path / "trace.jsonl") as f:
+        assert sum(1 for _ in f) == 3
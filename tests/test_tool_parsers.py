@@ -0,0 +1,106 @@
+import pytest
+
+from inference.tool_parsers import TOOL_PARSERS, api_record, early_decision, format_tool_call, is_error, parse_tool_output
+
+NATIVE_PARSERS = ["llama", "qwen", "ministral", "deepseek_distill"]
+ARGUMENTS = {"city": "Paris", "nights": 2, "options": {"breakfast": True, "tags": ["quiet", "view"]}}
+
+
+def test_every_parser_is_covered():
+    assert set(TOOL_PARSERS) == set(NATIVE_PARSERS) | {"repr"}
+
+
+@pytest.mark.parametrize("parser_name", NATIVE_PARSERS)
+def test_round_trip(parser_name):
+    text = format_tool_call(parser_name, "book_hotel", ARGUMENTS)
+    record = parse_tool_output(parser_name, text, finish_reason="stop", usage={"prompt_tokens": 10, "completion_tokens": 5})
+    assert record["decision"] == "tool"
+    assert record["tool_calls"] == [{"name": "book_hotel", "arguments": ARGUMENTS}]
+    assert "parse_error" not in record
+    assert record["finish_reason"] == "stop"
+    assert record["usage"] == {"prompt_tokens": 10, "completion_tokens": 5}
+
+
+@pytest.mark.parametrize("parser_name", NATIVE_PARSERS)
+def test_opener_decides_tool(parser_name):
+    text = format_tool_call(parser_name, "book_hotel", ARGUMENTS)
+    assert early_decision(parser_name, text[:40]) == "tool"
+    assert early_decision(parser_name, "I can answer that without any tools. " * 3, decision_chars=64) == "text"
+
+
+@pytest.mark.parametrize("parser_name", ["llama", "ministral"])
+def test_anchored_opener_must_start_reply(parser_name):
+    assert early_decision(parser_name, "  ") is None
+    assert early_decision("llama", "<|python") is None
+    assert early_decision(parser_name, "I") == "text"
+    assert early_decision(parser_name, 'Use {"a": 1} or [1]') == "text"
+
+
+def decision_only(parser_name, text, decision_chars=None, step=8):
+    """Decision of a decision-only run that generates text in rounds of step characters."""
+    for end in range(step, len(text) + step, step):
+        decision = early_decision(parser_name, text[:end], decision_chars)
+        if decision is not None:
+            return decision
+    return parse_tool_output(parser_name, text)["decision"]
+
+
+@pytest.mark.parametrize("parser_name", ["qwen", "deepseek_distill"])
+def test_preamble_before_call_matches_full_run(parser_name):
+    text = "Let me look up the available hotels in Paris for your stay first.\n\n" + format_tool_call(parser_name, "book_hotel", ARGUMENTS)
+    assert parse_tool_output(parser_name, text)["decision"] == "tool"
+    assert decision_only(parser_name, text) == "tool"
+    # The old 64-character cut would have called this a text answer
+    assert early_decision(parser_name, text[:64]) is None
+
+
+@pytest.mark.parametrize("parser_name", NATIVE_PARSERS)
+def test_text_answer(parser_name):
+    record = parse_tool_output(parser_name, "The hotel is booked for two nights.")
+    assert record["decision"] == "text"
+    assert record["tool_calls"] == []
+
+
+@pytest.mark.parametrize("parser_name", NATIVE_PARSERS)
+def test_truncated_call_keeps_attempt(parser_name):
+    text = format_tool_call(parser_name, "book_hotel", ARGUMENTS)
+    # Cut inside the arguments but after every signature of a tool call attempt
+    signatures = TOOL_PARSERS[parser_name][0]
+    cut = text.replace('"Paris"', '"Par')
+    if not all(signature in cut for signature in signatures):
+        pytest.skip("the syntax's signatures close the call")
+    record = parse_tool_output(parser_name, cut, finish_reason="length")
+    assert record["decision"] == "tool"
+    assert record["tool_calls"] == []
+    assert "parse_error" in record
+
+
+def test_parallel_calls():
+    text = format_tool_call("qwen", "book_hotel", ARGUMENTS) + "\n" + format_tool_call("qwen", "get_weather", {"city": "Paris"})
+    record = parse_tool_output("qwen", text)
+    assert [tool_call["name"] for tool_call in record["tool_calls"]] == ["book_hotel", "get_weather"]
+
+
+def test_repr_of_sdk_tool_calls():
+    text = ("[ChatCompletionMessageToolCall(id='call_1', function=Function(arguments='{\"city\": \"Paris\", \"nights\": 2}', "
+            "name='book_hotel'), type='function')]")
+    record = parse_tool_output("repr", text)
+    assert record["decision"] == "tool"
+    assert record["tool_calls"] == [{"name": "book_hotel", "arguments": {"city": "Paris", "nights": 2}}]
+
+
+def test_errors():
+    assert is_error(parse_tool_output("llama", ""))
+    assert is_error(parse_tool_output("llama", "[ERROR]: timed out"))
+    assert is_error("[ERROR]: old string output")
+    assert not is_error("plain text output")
+
+
+def test_api_record_text_takes_precedence():
+    assert api_record("Let me check.", [("book_hotel", '{"city": "Paris"}')])["decision"] == "text"
+    record = api_record("", [("book_hotel", '{"city": "Paris"}')])
+    assert record["decision"] == "tool"
+    assert record["tool_calls"] == [{"name": "book_hotel", "arguments": {"city": "Paris"}}]
+    invalid = api_record(None, [("book_hotel", "{not json")])
+    assert invalid["decision"] == "tool" and "parse_error" in invalid
+    assert is_error(api_record(None, None))
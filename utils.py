@@ -1,9 +1,332 @@
+import os
+import re
 import json
+import gzip
+import bz2
+import lzma
+from itertools import islice
 
-def load_data(path):
-    with open(path, "r") as f:
-        data = json.load(f)
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+DATA_EXTENSIONS = (".jsonl.gz", ".jsonl.bz2", ".jsonl.xz", ".json.gz", ".json.bz2", ".json.xz", ".jsonl", ".json")
+_ID_PATTERN = re.compile(r'"id"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+def get_data_name(data_path):
+    """Data file name without directory and extension, as used in output file names."""
+    name = data_path.split('/')[-1]
+    for ext in DATA_EXTENSIONS:
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+def resolve_data_path(data):
+    """Accept a data path with or without its extension (get_metric.py takes names like data/preferTool_elapse_2)."""
+    if os.path.exists(data):
+        return data
+    for ext in DATA_EXTENSIONS:
+        if os.path.exists(data + ext):
+            return data + ext
+    raise FileNotFoundError(f"No data file found for {data}")
+
+def open_data_file(path, mode="rt"):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    if path.endswith(".bz2"):
+        return bz2.open(path, mode)
+    if path.endswith(".xz"):
+        return lzma.open(path, mode)
+    return open(path, mode)
+
+def parse_shard(shard):
+    """Parse a 'i/N' shard spec into (i, N)."""
+    index, num_shards = (int(x) for x in shard.split("/"))
+    if not 0 <= index < num_shards:
+        raise ValueError(f"Invalid shard {shard}: expected i/N with 0 <= i < N")
+    return index, num_shards
+
+def iter_data(path, shard=None, ids=None):
+    """
+    Lazily yield the samples of a dataset.
+    Accepts a JSON list (or single sample) or JSONL file, optionally .gz/.bz2/.xz compressed.
+    JSONL records outside the shard, or whose line does not contain any requested id, are skipped
+    without being parsed. JSON lists are streamed with ijson when it is installed, and parsed
+    whole otherwise.
+    Args:
+        path: Path to the data file
+        shard: Optional (index, num_shards); keeps records index, index + num_shards, ...
+        ids: Optional collection of sample ids to keep
+    """
+    ids = set(ids) if ids is not None else None
+    if ".jsonl" in os.path.basename(path):
+        with open_data_file(path) as f:
+            position = 0
+            for line in f:
+                if not line.strip():
+                    continue
+                position += 1
+                if shard is not None and (position - 1) % shard[1] != shard[0]:
+                    continue
+                if ids is not None and not any(candidate in ids for candidate in _ID_PATTERN.findall(line)):
+                    continue
+                sample = _json_loads(line)
+                if ids is None or sample.get('id') in ids:
+                    yield sample
+        return
+
+    try:
+        import ijson
+    except ImportError:
+        ijson = None
+    if ijson is not None:
+        with open_data_file(path, "rb") as f:
+            first = f.read(1)
+            while first.isspace():
+                first = f.read(1)
+        if first == b"[":
+            with open_data_file(path, "rb") as f:
+                samples = ijson.items(f, "item", use_float=True)
+                yield from _select(samples, shard, ids)
+            return
+    with open_data_file(path) as f:
+        data = _json_loads(f.read())
     # If the file is a dict with a single sample, wrap in a list
     if isinstance(data, dict):
         data = [data]
-    return data
+    yield from _select(data, shard, ids)
+
+def _select(samples, shard, ids):
+    for position, sample in enumerate(samples):
+        if shard is not None and position % shard[1] != shard[0]:
+            continue
+        if ids is not None and sample.get('id') not in ids:
+            continue
+        yield sample
+
+# Nominal generation cost of a sample in prompt characters, so balanced shards also even out the number of samples
+SAMPLE_GENERATION_COST = 2048
+
+def plan_shards(path, num_shards, balanced=True):
+    """
+    Deterministic partition of a data file into shards, so that nodes can each run one
+    shard without coordinating. Balanced partitioning assigns samples longest first to the
+    shard with the least work so far (prompt length in characters plus SAMPLE_GENERATION_COST);
+    otherwise shard i gets samples i, i + num_shards, ... Sample ids must be unique.
+    Args:
+        path: Path to the data file
+        num_shards: Number of shards
+        balanced: Whether to balance shards by prompt length
+    Returns:
+        List of num_shards lists of (position in the data file, sample id), in data order
+    """
+    import heapq
+    samples = []
+    seen = set()
+    for position, sample in enumerate(iter_data(path)):
+        sample_id = sample.get('id')
+        if sample_id is None or sample_id in seen:
+            raise ValueError(f"Sample {position} of {path} has a {'missing' if sample_id is None else 'duplicate'} id; sharding needs unique ids.")
+        seen.add(sample_id)
+        cost = len(json.dumps([sample["history"], sample.get("function")], ensure_ascii=False)) + SAMPLE_GENERATION_COST if balanced else 0
+        samples.append((position, sample_id, cost))
+    shards = [[] for _ in range(num_shards)]
+    if balanced:
+        loads = [(0, index) for index in range(num_shards)]
+        for position, sample_id, cost in sorted(samples, key=lambda sample: (-sample[2], sample[0])):
+            load, index = heapq.heappop(loads)
+            shards[index].append((position, sample_id))
+            heapq.heappush(loads, (load + cost, index))
+    else:
+        for position, sample_id, _ in samples:
+            shards[position % num_shards].append((position, sample_id))
+    return [sorted(shard) for shard in shards]
+
+def parse_shard_args(shard=None, num_shards=None, shard_index=None):
+    """
+    The shard to run from either --shard i/N (round-robin) or --num_shards/--shard_index (length-balanced).
+    Returns:
+        ((index, num_shards), balanced), or (None, False) when not sharding
+    """
+    if num_shards is None and shard_index is None:
+        return (parse_shard(shard) if shard else None), False
+    if shard:
+        raise ValueError("Use either --shard or --num_shards/--shard_index, not both.")
+    if num_shards is None or shard_index is None:
+        raise ValueError("--num_shards and --shard_index must be given together.")
+    return parse_shard(f"{shard_index}/{num_shards}"), True
+
+def shard_samples(path, shard, balanced, ids=None):
+    """The (position, id) pairs planned for one shard of a data file (see plan_shards), restricted to ids if given."""
+    planned = plan_shards(path, shard[1], balanced=balanced)[shard[0]]
+    if ids is not None:
+        ids = set(ids)
+        planned = [(position, sample_id) for position, sample_id in planned if sample_id in ids]
+    return planned
+
+def load_data(path, shard=None, ids=None):
+    return list(iter_data(path, shard=shard, ids=ids))
+
+def iter_chunks(iterable, size):
+    """Yield lists of up to size consecutive items."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def get_output_path(output_dir, model, data_path, time_elapsed_level, use_time_stamp, shard=None):
+    """
+    Path of the output file for one model x data file x elapse level run, in the layout read by get_metric.py.
+    Shard runs get a -shard<i>of<N> suffix.
+    """
+    model_dir = model.split('/')[-1]
+    if use_time_stamp:
+        output_file = f"{model_dir}-{get_data_name(data_path)}-{time_elapsed_level}"
+    else:
+        output_file = f"{model_dir}-{get_data_name(data_path)}-notime"
+    if shard is not None:
+        output_file += f"-shard{shard[0]}of{shard[1]}"
+    return os.path.join(output_dir, model_dir, output_file + ".json")
+
+def save_outputs(output_path, sample_ids, outputs):
+    output_data = [{"id": sample_ids[i], "output": outputs[i]} for i in range(len(outputs))]
+    if not os.path.exists(os.path.dirname(output_path)):
+        os.makedirs(os.path.dirname(output_path))
+    with open(output_path, 'w') as f:
+        json.dump(output_data, f, indent=4)
+
+def get_checkpoint_path(output_path):
+    """Append-only JSONL file that collects outputs while a run is in progress."""
+    return output_path[:-len(".json")] + ".partial.jsonl"
+
+def get_trace_path(output_path):
+    """Per-request API telemetry trace (JSONL) kept next to the output file."""
+    return output_path[:-len(".json")] + "-trace.jsonl"
+
+def get_batch_dir(output_path):
+    """Directory next to the output file where a Batch API run keeps its request JSONL files."""
+    return output_path[:-len(".json")] + "-batches"
+
+def get_propensity_path(output_path):
+    """Where --score_propensity saves the propensity scores of a run."""
+    return os.path.splitext(output_path)[0] + "-propensity.json"
+
+def get_shard_config_path(output_path):
+    """Where a shard run records its settings and planned samples, for merge_shards.py."""
+    return os.path.splitext(output_path)[0] + "-config.json"
+
+def save_shard_config(output_path, config):
+    config_path = get_shard_config_path(output_path)
+    if not os.path.exists(os.path.dirname(config_path)):
+        os.makedirs(os.path.dirname(config_path))
+    with open(config_path, "w") as f:
+        json.dump(config, f, indent=4, default=str)
+
+def load_checkpoint(checkpoint_path):
+    """
+    Read the records written to a checkpoint so far. A truncated last line left by a crash is ignored,
+    and a sample written more than once (e.g. retried after an error) keeps its latest output.
+    Returns:
+        Dict of sample id -> output
+    """
+    outputs = {}
+    if not os.path.exists(checkpoint_path):
+        return outputs
+    with open(checkpoint_path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            outputs[record["id"]] = record["output"]
+    return outputs
+
+class Checkpoint_Writer:
+    """Appends one JSON line per finished sample and flushes it, so a crash loses at most the samples in flight."""
+    def __init__(self, checkpoint_path, resume=False):
+        if not os.path.exists(os.path.dirname(checkpoint_path)):
+            os.makedirs(os.path.dirname(checkpoint_path))
+        needs_newline = False
+        if resume and os.path.exists(checkpoint_path) and os.path.getsize(checkpoint_path) > 0:
+            with open(checkpoint_path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+        self.f = open(checkpoint_path, "a" if resume else "w")
+        if needs_newline:
+            self.f.write("\n")
+
+    def write(self, sample_id, output):
+        self.f.write(json.dumps({"id": sample_id, "output": output}) + "\n")
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def finalize_outputs(checkpoint_path, output_path, sample_ids):
+    """
+    Write the outputs collected in a checkpoint to output_path in the JSON layout read by get_metric.py,
+    ordered by sample_ids, and remove the checkpoint.
+    """
+    outputs = load_checkpoint(checkpoint_path)
+    finished_ids = [sample_id for sample_id in sample_ids if sample_id in outputs]
+    missing = len(sample_ids) - len(finished_ids)
+    if missing:
+        print(f"Warning: {missing} samples have no output in {checkpoint_path}")
+    save_outputs(output_path, finished_ids, [outputs[sample_id] for sample_id in finished_ids])
+    os.remove(checkpoint_path)
+
+def load_budget(budget_path):
+    """
+    Read a generation budget file: a JSON object mapping a model code (or "*" for every model)
+    to an object mapping a data name (or "default") to max_tokens, e.g.
+    {"*": {"preferNoTool_elapse_0": 512}, "Qwen/Qwen3-8B-reason": {"default": 8192}}
+    """
+    with open(budget_path, "r") as f:
+        return json.load(f)
+
+def resolve_max_tokens(budget, model, data_path, default):
+    """
+    Generation budget of a model on a data file. The most specific entry wins: the model's
+    entry for the data, then the "*" entry for the data, then the model's default, then the
+    "*" default, then default (the handler's max_tokens).
+    """
+    data_name = get_data_name(data_path)
+    model_budget = budget.get(model, {})
+    any_budget = budget.get("*", {})
+    for entry in (model_budget.get(data_name), any_budget.get(data_name), model_budget.get("default"), any_budget.get("default")):
+        if entry is not None:
+            return int(entry)
+    return default
+
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800, "mo": 2592000, "y": 31536000}
+
+def parse_duration(duration):
+    """Seconds in a duration such as 90, 30s, 5m, 2h, 3d, 1w, 6mo or 1y (a month is 30 days)."""
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)(s|m|h|d|w|mo|y)?", duration.strip())
+    if match is None:
+        raise ValueError(f"Invalid duration {duration}; use a number of seconds or a number followed by one of {', '.join(DURATION_UNITS)}.")
+    return float(match.group(1)) * DURATION_UNITS[match.group(2) or "s"]
+
+def format_elapsed(seconds):
+    """Short label of a duration in its largest whole unit, e.g. 5m, 2.5h or 6mo."""
+    for unit, size in sorted(DURATION_UNITS.items(), key=lambda item: -item[1]):
+        if seconds >= size:
+            value = seconds / size
+            return f"{value:.0f}{unit}" if abs(value - round(value)) < 0.05 else f"{value:.1f}{unit}"
+    return f"{seconds:.0f}s"
+
+def log_spaced(start, stop, num):
+    """num values from start to stop evenly spaced on a log scale."""
+    if num == 1:
+        return [start]
+    return [start * (stop / start) ** (i / (num - 1)) for i in range(num)]